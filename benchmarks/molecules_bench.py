@@ -0,0 +1,58 @@
+"""Compare the cell list extract_molecules against soprano's Molecules on
+supercells of the ethanol test structure, from about 100 to 20k atoms.
+soprano computes all pair distances, so it's only run on the smaller ones."""
+
+import os
+import sys
+import time
+import numpy as np
+from soprano.properties.linkage import Molecules
+
+path = os.path.split(__file__)[0]
+
+sys.path.append(os.path.join(path, '..'))
+
+from ccpncdb.utils import (read_magres_file, extract_molecules,  # noqa: E402
+                           extract_formula)
+
+MAX_REFERENCE = 2000
+
+
+def soprano_molecules(magres):
+    # The original implementation
+    mols = Molecules.get(magres)
+    syms = np.array(magres.get_chemical_symbols())
+    return [extract_formula(symbols=syms[m.indices]) for m in mols]
+
+
+def timeit(func, *args, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+if __name__ == '__main__':
+
+    with open(os.path.join(path, '../tests/data/ethanol.magres')) as f:
+        cell = read_magres_file(f)['Atoms']
+
+    print('{0:>8} {1:>12} {2:>12} {3:>8}'.format('atoms', 'soprano',
+                                                 'cell list', 'speedup'))
+    for reps in [(2, 2, 3), (3, 3, 3), (5, 5, 5), (8, 8, 8), (13, 13, 13)]:
+        atoms = cell.repeat(reps)
+        n = len(atoms)
+
+        new = extract_molecules(atoms)
+        assert len(new) == np.prod(reps)
+        t_new = timeit(extract_molecules, atoms)
+
+        if n <= MAX_REFERENCE:
+            assert soprano_molecules(atoms) == new
+            t_ref = timeit(soprano_molecules, atoms, repeat=1)
+            print('{0:>8} {1:>11.4f}s {2:>11.4f}s {3:>7.1f}x'.format(
+                n, t_ref, t_new, t_ref/t_new))
+        else:
+            print('{0:>8} {1:>12} {2:>11.4f}s'.format(n, '-', t_new))
@@ -0,0 +1,66 @@
+"""Compare the batched extract_nmrdata against the per-tensor NMRTensor path
+on random supercells of increasing size."""
+
+import os
+import sys
+import time
+import numpy as np
+from ase import Atoms
+from soprano.nmr import NMRTensor
+
+path = os.path.split(__file__)[0]
+
+sys.path.append(os.path.join(path, '..'))
+
+from ccpncdb.utils import extract_nmrdata, extract_tensdata  # noqa: E402
+
+
+def random_cell(n, seed=0):
+    rng = np.random.default_rng(seed)
+    symbols = rng.choice(['H', 'C', 'N', 'O'], size=n)
+    atoms = Atoms(symbols=symbols, positions=rng.random((n, 3))*10,
+                  cell=np.eye(3)*10, pbc=True)
+    atoms.set_array('ms', rng.normal(size=(n, 3, 3))*100)
+    atoms.set_array('efg', rng.normal(size=(n, 3, 3)))
+    return atoms
+
+
+def per_tensor_nmrdata(magres):
+    # The original implementation, one NMRTensor per atom
+    symbols = np.array(magres.get_chemical_symbols())
+    sp = {s: np.where(symbols == s) for s in set(symbols)}
+    species = sorted(sp.keys())
+    nmrdata = [{'species': s} for s in species]
+    for tag in ('ms', 'efg'):
+        tens = np.empty(len(magres), dtype=object)
+        tens[:] = [NMRTensor(T) for T in magres.get_array(tag)]
+        for i, s in enumerate(species):
+            nmrdata[i][tag] = [extract_tensdata(T) for T in tens[sp[s]]]
+    return nmrdata
+
+
+def timeit(func, *args, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+if __name__ == '__main__':
+
+    print('{0:>8} {1:>12} {2:>12} {3:>8}'.format('atoms', 'per-tensor',
+                                                 'batched', 'speedup'))
+    for n in (100, 500, 2000, 10000):
+        atoms = random_cell(n)
+
+        ref = per_tensor_nmrdata(atoms)
+        new = extract_nmrdata(atoms)
+        for r, d in zip(ref, new):
+            assert r['ms'] == d['ms'] and r['efg'] == d['efg']
+
+        t_ref = timeit(per_tensor_nmrdata, atoms)
+        t_new = timeit(extract_nmrdata, atoms)
+        print('{0:>8} {1:>11.4f}s {2:>11.4f}s {3:>7.1f}x'.format(
+            n, t_ref, t_new, t_ref/t_new))
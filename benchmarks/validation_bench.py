@@ -0,0 +1,75 @@
+"""Compare record validation through the schema library against the
+compiled validators (strict, and spot checking the automatic arrays) on
+records of random cells of increasing size."""
+
+import os
+import sys
+import time
+from datetime import datetime
+import numpy as np
+from ase import Atoms
+
+path = os.path.split(__file__)[0]
+
+sys.path.append(os.path.join(path, '..'))
+
+from ccpncdb.magresdb import auto_rdata  # noqa: E402
+from ccpncdb.schemas import (magresRecordSchema, validate_with,  # noqa: E402
+                             _validate_with_schema, magresRecordValidator)
+
+
+def random_record(n, seed=0):
+    rng = np.random.default_rng(seed)
+    symbols = rng.choice(['H', 'C', 'N', 'O'], size=n)
+    # Sparse enough for the molecules to stay small
+    side = (n*20.0)**(1.0/3.0)
+    atoms = Atoms(symbols=symbols, positions=rng.random((n, 3))*side,
+                  cell=np.eye(3)*side, pbc=True)
+    atoms.set_array('ms', rng.normal(size=(n, 3, 3))*100)
+    atoms.set_array('efg', rng.normal(size=(n, 3, 3)))
+
+    rdata = {
+        'chemname': 'Random cell',
+        'orcid': {'path': '0000-0000-0000-0000', 'host': 'none',
+                  'uri': '0000-0000-0000-0000'},
+        'id': 'NONE',
+        'type': 'magres',
+        'visible': True,
+        'chemname_tokens': ['random', 'cell'],
+        'chemname_trigrams': ['ran', 'and', 'ndo', 'dom'],
+        'version_trigrams': [],
+        'last_modified': datetime.utcnow(),
+        'immutable_id': '0000000',
+        'version_count': 0,
+        'last_version': None
+    }
+    rdata.update(auto_rdata(atoms))
+    return rdata
+
+
+def timeit(func, *args, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+if __name__ == '__main__':
+
+    print('{0:>8} {1:>12} {2:>12} {3:>12} {4:>8}'.format(
+        'atoms', 'schema', 'compiled', 'sampled', 'speedup'))
+    for n in (100, 500, 2000, 10000):
+        rdata = random_record(n)
+
+        ref = _validate_with_schema(rdata, magresRecordSchema)
+        assert ref.result
+        assert validate_with(rdata, magresRecordSchema) == ref
+        assert magresRecordValidator.validate(rdata) == ref
+
+        t_ref = timeit(_validate_with_schema, rdata, magresRecordSchema)
+        t_cmp = timeit(validate_with, rdata, magresRecordSchema)
+        t_smp = timeit(magresRecordValidator.validate, rdata)
+        print('{0:>8} {1:>11.4f}s {2:>11.4f}s {3:>11.4f}s {4:>7.0f}x'.format(
+            n, t_ref, t_cmp, t_smp, t_ref/t_smp))
@@ -4,8 +4,8 @@ import zipfile
 import tarfile
 from io import StringIO
 from collections import namedtuple
-from ccpncdb.utils import get_schema_keys
-from ccpncdb.schemas import magresRecordSchemaUser, magresVersionSchemaUser
+from ccpncdb.schemas import (magresRecordSchemaUser, magresVersionSchemaUser,
+                             schema_info)
 
 
 MagresArchiveFile = namedtuple('MagresArchiveFile', ['name', 'contents',
@@ -21,9 +21,16 @@ class MagresArchive(object):
 
     VDATA_CASEINS_TAGS = ['extref_type', 'license']
 
-    def __init__(self, archive, mode='r', record_data={}, version_data={}):
+    def __init__(self, archive, mode='r', record_data={}, version_data={},
+                 stream=False, max_size=None, max_file_size=None):
         """Load an archive of magres files with an optional .csv document
-        to store file by file information"""
+        to store file by file information.
+
+        In stream mode only the .csv document is read on opening; the
+        magres files are read one at a time from the open archive as
+        files() is iterated, and close() must be called when done.
+        max_size and max_file_size limit the total and per-file
+        uncompressed size (in bytes) of the archive contents."""
 
         self._default_record = record_data
         self._default_version = version_data
@@ -32,42 +39,91 @@ class MagresArchive(object):
         self._csv_file = {}
 
         self._mode = mode
+        self._stream = stream
+        self._max_size = max_size
+        self._max_file_size = max_file_size
+        self._handle = None
+        self._members = {}
 
         if mode == 'r':
             self.read(archive)
         elif mode == 'w':
             self._archive = archive
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def _read_member(self, name):
+        info = self._members[name]
+        if isinstance(self._handle, zipfile.ZipFile):
+            with self._handle.open(info) as f:
+                return f.read()
+        else:
+            f = self._handle.extractfile(info)
+            contents = f.read()
+            f.close()
+            return contents
+
+    def _check_sizes(self, sizes):
+        # Sizes are checked as declared in the archive; both zip and tar
+        # readers never return more than that for a member
+        if self._max_file_size is not None:
+            for name, size in sizes.items():
+                if size > self._max_file_size:
+                    raise MagresArchiveError('File {0} in archive is too '
+                                             'large'.format(name))
+        if self._max_size is not None:
+            if sum(sizes.values()) > self._max_size:
+                raise MagresArchiveError('Uncompressed archive is too large')
+
     def read(self, archive):
-        _raw_files = {}
+        sizes = {}
 
         try:
-            with zipfile.ZipFile(archive) as z:
-                for n in z.namelist():
-                    name = os.path.basename(n)
-                    if len(name) > 0:
-                        with z.open(n) as f:
-                            _raw_files[name] = f.read()
+            self._handle = zipfile.ZipFile(archive)
+            for zi in self._handle.infolist():
+                name = os.path.basename(zi.filename)
+                if len(name) > 0:
+                    self._members[name] = zi
+                    sizes[name] = zi.file_size
         except zipfile.BadZipfile:
             archive.seek(0)  # Clear
             try:
-                with tarfile.open(fileobj=archive) as z:
-                    for ti in z.getmembers():
-                        if ti.isfile():
-                            f = z.extractfile(ti)
-                            name = os.path.basename(ti.name)
-                            _raw_files[name] = f.read()
-                            f.close()
+                self._handle = tarfile.open(fileobj=archive)
+                for ti in self._handle.getmembers():
+                    if ti.isfile():
+                        name = os.path.basename(ti.name)
+                        self._members[name] = ti
+                        sizes[name] = ti.size
             except tarfile.ReadError:
                 raise RuntimeError(
                     'Uploaded archive file is not a valid zip or tar file.')
 
-        # Now to split them
-        for fname, file in _raw_files.items():
+        try:
+            self._check_sizes(sizes)
+            self._read_csv()
+            if not self._stream:
+                for fname in self._members:
+                    if os.path.splitext(fname)[1] == '.magres':
+                        file = self._read_member(fname)
+                        self._magres_files[fname] = file.decode('UTF-8')
+        finally:
+            if not self._stream:
+                self.close()
+
+    def _read_csv(self):
+        for fname in self._members:
             ext = os.path.splitext(fname)[1]
-            if ext == '.magres':
-                self._magres_files[fname] = file.decode('UTF-8')
-            elif ext == '.csv':
+            if ext == '.csv':
+                file = self._read_member(fname)
                 csv_reader = csv.DictReader(StringIO(file.decode('UTF-8')))
                 for row in csv_reader:
                     # We need to grab the filename first
@@ -83,7 +139,7 @@ class MagresArchive(object):
                     else:
                         # Older versions
                         _, name = row.popitem(False)
-                    if not (name in _raw_files):
+                    if not (name in self._members):
                         raise MagresArchiveError('Invalid .csv file in '
                                                  'archive: all rows must'
                                                  ' include a valid filename as'
@@ -137,12 +193,25 @@ class MagresArchive(object):
     def files(self):
         """Return a generator for all files within the archive"""
 
-        flist = sorted(list(self._magres_files.keys()))
-        rkeys = get_schema_keys(magresRecordSchemaUser)
-        vkeys = get_schema_keys(magresVersionSchemaUser)
+        if self._stream:
+            flist = sorted([f for f in self._members
+                            if os.path.splitext(f)[1] == '.magres'])
+        else:
+            flist = sorted(list(self._magres_files.keys()))
+        rkeys = schema_info(magresRecordSchemaUser).keyset
+        vkeys = schema_info(magresVersionSchemaUser).keyset
 
         for f in flist:
-            ftext = self._magres_files[f]
+            if self._stream:
+                ftext = self._read_member(f)
+                try:
+                    ftext = ftext.decode('UTF-8')
+                except UnicodeDecodeError:
+                    # Left as bytes, so that it fails to parse and is
+                    # reported as invalid like any other bad file
+                    pass
+            else:
+                ftext = self._magres_files[f]
             cdata = self._csv_file.get(f, {})
             rdata = dict(self._default_record)
             rdata.update({k: v for k, v in cdata.items() if k in rkeys})
@@ -0,0 +1,195 @@
+import zlib
+import hashlib
+from gridfs import GridFS, NoFile
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class BlobStoreError(Exception):
+    pass
+
+
+def _compress(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    elif compression == 'gzip':
+        comp = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return comp.compress(data) + comp.flush()
+    return data
+
+
+def _decompressobj(compression):
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+    elif compression == 'gzip':
+        return zlib.decompressobj(31)
+    return None
+
+
+class MagresBlob(object):
+    """A stored file, read back decompressed"""
+
+    def __init__(self, gridout):
+
+        self._gridout = gridout
+        meta = gridout.metadata or {}
+
+        self._id = gridout._id
+        self.sha256 = meta.get('sha256')
+        self.compression = meta.get('compression')
+        self.length = meta.get('length', gridout.length)
+        self.stored_length = gridout.length
+        self.chunk_size = gridout.chunk_size
+
+    @property
+    def etag(self):
+        # Strong validator: content hash, or whatever older files have
+        return (self.sha256 or getattr(self._gridout, 'md5', None) or
+                str(self._id))
+
+    def chunks(self, start=0, stop=None):
+        """Generator over the decompressed contents, or the byte range
+        start:stop of them, one stored chunk at a time"""
+
+        if stop is None:
+            stop = self.length
+
+        dec = _decompressobj(self.compression)
+        if dec is None:
+            # Not compressed, seek straight there
+            self._gridout.seek(start)
+            pos = start
+        else:
+            self._gridout.seek(0)
+            pos = 0
+
+        while pos < stop:
+            chunk = self._gridout.readchunk()
+            if len(chunk) == 0:
+                break
+            if dec is not None:
+                chunk = dec.decompress(chunk)
+            # Trim to the requested range
+            cstart = max(start - pos, 0)
+            cstop = min(stop - pos, len(chunk))
+            pos += len(chunk)
+            if cstop > cstart:
+                yield chunk[cstart:cstop]
+
+    def read(self):
+        return b''.join(self.chunks())
+
+
+class MagresBlobStore(object):
+    """Content-addressed, compressed store for magres files on top of GridFS.
+
+    Files are keyed by the SHA-256 of their uncompressed contents: storing
+    the same contents twice returns the existing file and increases its
+    reference count. Files stored before this was introduced (no metadata)
+    are read back as they are."""
+
+    DEFAULT_COMPRESSION = 'zstd' if zstandard is not None else 'gzip'
+
+    def __init__(self, database, collection='fs', compression=None):
+
+        self.fs = GridFS(database, collection)
+        self.files = database[collection + '.files']
+        self.chunks = database[collection + '.chunks']
+        self.compression = compression or self.DEFAULT_COMPRESSION
+
+        if self.compression == 'zstd' and zstandard is None:
+            raise BlobStoreError('zstd compression requires the zstandard '
+                                 'package')
+
+    def ensure_indexes(self):
+        self.files.create_index('metadata.sha256',
+                                name='ccpnc_blob_sha256')
+
+    def put(self, data, filename=None):
+        """Store data (str or bytes), returns the ID of the file holding it
+        """
+        return self._put(data, filename)[0]
+
+    def _put(self, data, filename=None):
+        # As put, but also tells whether a new file was created. Two
+        # concurrent puts of the same new contents can still end up in two
+        # files; that costs space, not correctness, and the migration
+        # merges them
+
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        sha256 = hashlib.sha256(data).hexdigest()
+
+        # Already there?
+        existing = self.files.find_one_and_update(
+            {'metadata.sha256': sha256},
+            {'$inc': {'metadata.refcount': 1}})
+        if existing is not None:
+            return existing['_id'], False
+
+        meta = {
+            'sha256': sha256,
+            'compression': self.compression,
+            'length': len(data),
+            'refcount': 1
+        }
+
+        fs_id = self.fs.put(_compress(data, self.compression),
+                            filename=filename, metadata=meta)
+        return fs_id, True
+
+    def get(self, fs_id):
+        try:
+            return MagresBlob(self.fs.get(ObjectId(fs_id)))
+        except (NoFile, InvalidId, TypeError):
+            raise BlobStoreError('File not found')
+
+    def retain(self, fs_id):
+        # One more reference to an existing file
+        self.files.update_one({'_id': ObjectId(fs_id),
+                               'metadata.refcount': {'$exists': True}},
+                              {'$inc': {'metadata.refcount': 1}})
+
+    def release(self, fs_id):
+        # One reference less; delete the file when none are left. Files
+        # without a refcount (not yet migrated) are left alone
+        res = self.files.find_one_and_update(
+            {'_id': ObjectId(fs_id),
+             'metadata.refcount': {'$exists': True}},
+            {'$inc': {'metadata.refcount': -1}},
+            projection={'metadata.refcount': 1},
+            return_document=ReturnDocument.AFTER)
+        if res is None or res['metadata']['refcount'] > 0:
+            return
+        # A put of the same contents may have taken it up again in the
+        # meantime: only delete the file if still unreferenced, then its
+        # chunks (a put that comes later stores a new file)
+        gone = self.files.delete_one({'_id': ObjectId(fs_id),
+                                      'metadata.refcount': {'$lte': 0}})
+        if gone.deleted_count > 0:
+            self.chunks.delete_many({'files_id': ObjectId(fs_id)})
+
+    def set_refcount(self, fs_id, refcount):
+        self.files.update_one({'_id': ObjectId(fs_id)},
+                              {'$set': {'metadata.refcount': refcount}})
+
+    def legacy_files(self):
+        # Files stored plain, before content addressing
+        return self.files.find({'metadata.sha256': {'$exists': False}})
+
+    def migrate_legacy(self, fdoc):
+        """Store again the contents of a legacy file (a document from
+        legacy_files), returns the ID of the file now holding them and
+        whether it is a new one. The legacy file itself is left in place
+        """
+        data = self.get(fdoc['_id']).read()
+        return self._put(data, fdoc.get('filename'))
+
+    def delete(self, fs_id):
+        self.fs.delete(ObjectId(fs_id))
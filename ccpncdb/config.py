@@ -30,6 +30,89 @@ class Config(object):
     def db_name(self):
         return self.data.get('db_name', 'ccpnc')
     
+    @property
+    def archive_workers(self):
+        return self.data.get('archive_workers', 0)
+
+    @property
+    def archive_queue(self):
+        return self.data.get('archive_queue', None)
+
+    @property
+    def archive_timeout(self):
+        return self.data.get('archive_timeout', None)
+
+    @property
+    def archive_stream(self):
+        return self.data.get('archive_stream', False)
+
+    @property
+    def archive_max_size(self):
+        return self.data.get('archive_max_size', None)
+
+    @property
+    def archive_max_file_size(self):
+        return self.data.get('archive_max_file_size', None)
+
+    @property
+    def file_compression(self):
+        return self.data.get('file_compression', None)
+
+    @property
+    def id_block_size(self):
+        return self.data.get('id_block_size', 1)
+
+    @property
+    def crossref_ttl(self):
+        return self.data.get('crossref_ttl', 30*86400)
+
+    @property
+    def crossref_timeout(self):
+        return self.data.get('crossref_timeout', 5)
+
+    @property
+    def search_cache_size(self):
+        # Bytes; 0 disables the search cache
+        return self.data.get('search_cache_size', 32*2**20)
+
+    @property
+    def search_cache_redis(self):
+        return self.data.get('search_cache_redis', None)
+
+    @property
+    def search_cache_max_ids(self):
+        # Searches matching more records than this aren't cached
+        return self.data.get('search_cache_max_ids', 10000)
+
+    @property
+    def extract_cache_size(self):
+        # Number of magres files; 0 disables the extraction cache
+        return self.data.get('extract_cache_size', 10000)
+
+    @property
+    def log_batch_size(self):
+        return self.data.get('log_batch_size', 100)
+
+    @property
+    def log_flush_interval(self):
+        return self.data.get('log_flush_interval', 1.0)
+
+    @property
+    def log_queue_size(self):
+        return self.data.get('log_queue_size', 10000)
+
+    @property
+    def log_overflow(self):
+        return self.data.get('log_overflow', 'drop')
+
+    @property
+    def log_capped_size(self):
+        return self.data.get('log_capped_size', None)
+
+    @property
+    def log_ttl(self):
+        return self.data.get('log_ttl', None)
+
     def client(self):
         return pymongo.MongoClient(host=self.db_url,
                            port=self.db_port)
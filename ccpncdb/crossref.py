@@ -0,0 +1,157 @@
+import threading
+import requests
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+
+class CrossrefError(Exception):
+    pass
+
+
+class CrossrefPending(CrossrefError):
+    # The lookup is still running in the background
+    pass
+
+
+class CrossrefCache(object):
+    """Author lists of DOIs from Crossref, cached in the database.
+
+    Found DOIs are kept for ttl seconds, DOIs Crossref doesn't know about
+    for negative_ttl seconds. Expired entries are still returned while they
+    are refreshed in the background; missing ones are fetched in the
+    background too, waiting at most wait seconds for them."""
+
+    API_URL = 'https://api.crossref.org/works/'
+
+    def __init__(self, client, dbname='ccpnc', ttl=30*86400,
+                 negative_ttl=86400, timeout=5, wait=None, workers=2):
+
+        self.client = client
+        self.cache = client[dbname].crossrefCache
+
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self.wait = timeout if wait is None else wait
+
+        self._http = requests.Session()
+        self._http.headers['User-Agent'] = 'ccpnc-database'
+        self._http.mount('https://', HTTPAdapter(pool_maxsize=workers))
+
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._counts = {'hits': 0, 'misses': 0, 'stale': 0, 'fetches': 0,
+                        'errors': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    @staticmethod
+    def _key(doi):
+        # DOIs are case insensitive
+        return doi.strip().lower()
+
+    def _fetch(self, doi):
+        # Author list from Crossref, or None if the DOI is not found
+        self._count('fetches')
+        try:
+            r = self._http.get(self.API_URL + doi, timeout=self.timeout)
+            if r.status_code == 404:
+                return None
+            r.raise_for_status()
+            return r.json()['message'].get('author', [])
+        except (RequestException, ValueError, KeyError) as e:
+            self._count('errors')
+            raise CrossrefError('Error fetching author information: ' +
+                                str(e))
+
+    def _refresh(self, doi):
+        # Fetch and store doi in the background; only one fetch per DOI
+        # at a time
+        key = self._key(doi)
+
+        def task():
+            try:
+                authors = self._fetch(doi)
+                self.cache.replace_one({'_id': key},
+                                       {'_id': key, 'authors': authors,
+                                        'fetched': datetime.utcnow()},
+                                       upsert=True)
+                return authors
+            finally:
+                with self._lock:
+                    self._pending.pop(key, None)
+
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pool.submit(task)
+                self._pending[key] = future
+
+        return future
+
+    def _expired(self, entry):
+        ttl = self.ttl if entry['authors'] is not None else self.negative_ttl
+        age = (datetime.utcnow() - entry['fetched']).total_seconds()
+        return age >= ttl
+
+    def get(self, doi, wait=None):
+        """Return the list of authors of doi (as Crossref gives them), or
+        None if Crossref doesn't know it. Raises CrossrefPending if the
+        lookup took longer than wait seconds, and CrossrefError if it
+        failed."""
+
+        entry = self.cache.find_one({'_id': self._key(doi)})
+
+        if entry is not None:
+            if self._expired(entry):
+                self._count('stale')
+                self._refresh(doi)
+            else:
+                self._count('hits')
+            return entry['authors']
+
+        self._count('misses')
+        future = self._refresh(doi)
+        try:
+            return future.result(timeout=self.wait if wait is None
+                                 else wait)
+        except TimeoutError:
+            raise CrossrefPending('Still fetching author information')
+
+    def prefetch(self, dois, refresh=False):
+        """Warm the cache with the given DOIs, fetching those that are
+        missing or expired (or all of them, if refresh is True). Returns
+        the numbers of DOIs fetched, already cached and failed."""
+
+        report = {'fetched': 0, 'cached': 0, 'failed': 0}
+
+        futures = []
+        dois = {self._key(doi): doi for doi in dois if doi}
+        for doi in dois.values():
+            entry = self.cache.find_one({'_id': self._key(doi)})
+            if entry is not None and not refresh and not self._expired(entry):
+                report['cached'] += 1
+            else:
+                futures.append(self._refresh(doi))
+
+        for future in futures:
+            try:
+                future.result()
+                report['fetched'] += 1
+            except CrossrefError:
+                report['failed'] += 1
+
+        return report
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts, pending=len(self._pending))
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+        self._http.close()
@@ -0,0 +1,92 @@
+import hashlib
+import threading
+from datetime import datetime
+import ase
+import soprano
+from pymongo import DESCENDING
+from pymongo.errors import DuplicateKeyError
+
+
+def normalise_magres(mstr):
+    # Magres text with line endings and trailing whitespace made uniform,
+    # which doesn't change how it's parsed
+    lines = mstr.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return '\n'.join(l.rstrip() for l in lines).strip('\n')
+
+
+class ExtractionCache(object):
+    """Automatic data extracted from magres files, cached in a collection.
+
+    Entries are keyed by the SHA-256 of the normalised magres text together
+    with version, which should change whenever the extractors do (the ASE
+    and soprano versions are added to it), so results from older code are
+    never used. Each holds the automatic record data and the calculation
+    block; the least recently used ones are pruned beyond max_entries."""
+
+    def __init__(self, collection, version, max_entries=10000):
+
+        self.collection = collection
+        self.version = '{0}/ase-{1}/soprano-{2}'.format(version,
+                                                        ase.__version__,
+                                                        soprano.__version__)
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._counts = {'hits': 0, 'misses': 0, 'pruned': 0}
+
+    def ensure_indexes(self):
+        self.collection.create_index('used', name='ccpnc_extract_used')
+
+    def key(self, mstr):
+        h = hashlib.sha256(self.version.encode('utf-8'))
+        h.update(b'\n')
+        h.update(normalise_magres(mstr).encode('utf-8'))
+        return h.hexdigest()
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counts[name] += n
+
+    def get(self, key):
+        # (autodata, calc_block), or None
+        entry = self.collection.find_one_and_update(
+            {'_id': key}, {'$set': {'used': datetime.utcnow()}},
+            projection={'autodata': 1, 'calc': 1})
+        if entry is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return entry['autodata'], entry['calc']
+
+    def put(self, key, autodata, calc_block):
+        try:
+            self.collection.insert_one({'_id': key, 'autodata': autodata,
+                                        'calc': calc_block,
+                                        'used': datetime.utcnow()})
+        except DuplicateKeyError:
+            # Extracted concurrently, same contents
+            return
+        self.prune()
+
+    def prune(self):
+        """Delete the least recently used entries beyond max_entries,
+        returns how many"""
+        excess = self.collection.estimated_document_count() - self.max_entries
+        if excess <= 0:
+            return 0
+        keep = self.collection.find({}, projection={'used': 1}).sort(
+            'used', DESCENDING).skip(self.max_entries).limit(1)
+        keep = list(keep)
+        if len(keep) == 0:
+            return 0
+        n = self.collection.delete_many(
+            {'used': {'$lte': keep[0]['used']}}).deleted_count
+        self._count('pruned', n)
+        return n
+
+    def clear(self):
+        self.collection.delete_many({})
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts)
@@ -0,0 +1,111 @@
+import re
+from math import gcd
+from functools import reduce
+from collections import Counter
+import numpy as np
+
+_cfre = re.compile('([A-Z][a-z]*)([0-9]*)')
+_formula_re = re.compile('(?:[A-Z][a-z]*[0-9]*)+')
+
+
+class Formula(object):
+    """Immutable chemical formula: how many atoms of each species.
+
+    Species are kept sorted, so two formulas with the same counts are equal
+    and hash the same whatever order they were written in; str() gives the
+    canonical string (e.g. 'C2H6O'), usable as a key outside of Python too.
+    """
+
+    __slots__ = ('_counts', '_hash')
+
+    def __init__(self, counts=()):
+
+        counts = dict(counts)
+        for s, n in counts.items():
+            if not isinstance(n, (int, np.integer)) or n < 0:
+                raise ValueError('Invalid count for {0}: {1}'.format(s, n))
+        counts = tuple(sorted((str(s), int(n))
+                              for s, n in counts.items() if n > 0))
+        object.__setattr__(self, '_counts', counts)
+        object.__setattr__(self, '_hash', hash(counts))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Formula is immutable')
+
+    @classmethod
+    def from_symbols(cls, symbols):
+        """Formula of a list (or array) of chemical symbols"""
+        if isinstance(symbols, np.ndarray):
+            if len(symbols) == 0:
+                return cls()
+            species, counts = np.unique(symbols, return_counts=True)
+            return cls(zip(species, counts))
+        return cls(Counter(symbols))
+
+    @classmethod
+    def from_string(cls, formula):
+        """Parse a string like 'C2H6O'; repeated species are added up
+        ('CH3CH2OH' is the same formula)"""
+        formula = re.sub(r'\s+', '', formula)
+        if _formula_re.fullmatch(formula) is None:
+            raise ValueError('Invalid formula string')
+        counts = Counter()
+        for s, n in _cfre.findall(formula):
+            counts[s] += int(n) if n != '' else 1
+        return cls(counts)
+
+    @classmethod
+    def from_list(cls, formula):
+        """From the [{'species': ..., 'n': ...}] lists stored in records"""
+        counts = Counter()
+        for f in formula:
+            counts[f['species']] += f['n']
+        return cls(counts)
+
+    def to_list(self):
+        """As a [{'species': ..., 'n': ...}] list, sorted by species"""
+        return [{'species': s, 'n': n} for s, n in self._counts]
+
+    @property
+    def species(self):
+        return [s for s, _ in self._counts]
+
+    @property
+    def natoms(self):
+        return sum(n for _, n in self._counts)
+
+    @property
+    def divisor(self):
+        # Greatest common divisor of the counts
+        return reduce(gcd, (n for _, n in self._counts), 0)
+
+    def reduced(self):
+        """The empirical formula: counts divided by their common divisor"""
+        d = self.divisor
+        if d <= 1:
+            return self
+        return Formula((s, n//d) for s, n in self._counts)
+
+    def __getitem__(self, species):
+        return dict(self._counts).get(species, 0)
+
+    def __iter__(self):
+        return iter(self._counts)
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __eq__(self, other):
+        if not isinstance(other, Formula):
+            return NotImplemented
+        return self._counts == other._counts
+
+    def __hash__(self):
+        return self._hash
+
+    def __str__(self):
+        return ''.join(s + (str(n) if n > 1 else '')
+                       for s, n in self._counts)
+
+    def __repr__(self):
+        return 'Formula({0!r})'.format(str(self))
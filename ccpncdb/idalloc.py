@@ -0,0 +1,53 @@
+import os
+import threading
+from pymongo import ReturnDocument
+
+
+class IDAllocator(object):
+    """Hands out unique integer IDs from a counter document.
+
+    IDs are reserved from the database in blocks of block_size with a single
+    atomic increment, and handed out from memory until the block runs out.
+    Since every reservation is atomic, processes sharing the counter never
+    get the same ID; IDs reserved but not handed out (when a process exits)
+    are simply skipped, so the sequence may have gaps."""
+
+    def __init__(self, collection, block_size=1):
+
+        self.collection = collection
+        self.block_size = max(int(block_size), 1)
+
+        self._lock = threading.Lock()
+        self._next = 0
+        self._stop = 0
+        self._pid = os.getpid()
+
+    def reserve(self, n):
+        # Atomically reserve n IDs in the database, return the first one
+        res = self.collection.find_one_and_update(
+            filter={},
+            return_document=ReturnDocument.AFTER,
+            update={'$inc': {'count': n}},
+            upsert=True)
+        return res['count']-n+1
+
+    def allocate(self, n=1):
+        """Return a list of n unique IDs, contiguous where possible"""
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked: the block belongs to the parent
+                self._next = self._stop = 0
+                self._pid = os.getpid()
+
+            ids = []
+            while len(ids) < n:
+                if self._next >= self._stop:
+                    size = max(n-len(ids), self.block_size)
+                    self._next = self.reserve(size)
+                    self._stop = self._next + size
+                take = min(n-len(ids), self._stop-self._next)
+                ids += range(self._next, self._next+take)
+                self._next += take
+
+            return ids
@@ -1,20 +1,184 @@
+import os
+import sys
+import time
+import queue
+import atexit
+import weakref
+import threading
 from datetime import datetime
+from bson.son import SON
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+# Loggers to close at exit, without keeping them alive
+_loggers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_all():
+    for logger in list(_loggers):
+        logger.close()
+
 
 class Logger(object):
+    """Writes log entries to the databaseLogs collection.
+
+    Entries are queued and written in batches by a background thread,
+    whenever batch_size of them are waiting or flush_interval seconds have
+    passed, so logging doesn't add a database round trip to requests. The
+    queue holds at most max_queue entries; when it's full, overflow decides
+    what happens to new ones: 'drop' them, 'block' until there's room, or
+    write them straight away ('sync'). Whatever is left is written at exit.
+
+    The collection can be created as capped (capped_size, in bytes) or get
+    a TTL index on the time of each entry (ttl, in seconds). background set
+    to False writes every entry as it comes, as it used to be done."""
 
-    def __init__(self, client, dbname='ccpnc'):
+    OVERFLOW_POLICIES = ('drop', 'block', 'sync')
+
+    def __init__(self, client, dbname='ccpnc', batch_size=100,
+                 flush_interval=1.0, max_queue=10000, overflow='drop',
+                 capped_size=None, ttl=None, background=True):
+
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError('Invalid overflow policy: ' + str(overflow))
 
         self.client = client
         logdb = client[dbname]
 
+        if capped_size is not None:
+            try:
+                logdb.create_collection('databaseLogs', capped=True,
+                                        size=capped_size)
+            except CollectionInvalid:
+                # Already exists
+                pass
+
         self.logs = logdb.databaseLogs
+        self._set_ttl(logdb, ttl)
+
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.background = background
+        self.dropped = 0
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._closed = threading.Event()
+
+        _loggers.add(self)
+
+    def _set_ttl(self, logdb, ttl):
+        # Make the TTL index match ttl. An existing one can't be created
+        # again with other options, so it is changed in place (or rebuilt,
+        # if the server won't) and dropped if there should be none
+        index = self.logs.index_information().get('ccpnc_log_ttl')
+        if index is not None:
+            if ttl is None:
+                self.logs.drop_index('ccpnc_log_ttl')
+                return
+            if index.get('expireAfterSeconds') == ttl:
+                return
+            try:
+                logdb.command(SON([('collMod', 'databaseLogs'),
+                                   ('index', {'keyPattern': {'time': 1},
+                                              'expireAfterSeconds': ttl})]))
+                return
+            except OperationFailure:
+                self.logs.drop_index('ccpnc_log_ttl')
+        if ttl is not None:
+            self.logs.create_index('time', name='ccpnc_log_ttl',
+                                   expireAfterSeconds=ttl)
+
+    def _start(self):
+        # Start the flusher thread, once per process (threads don't
+        # survive a fork)
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._closed.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name='ccpnc-logger')
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+
+        while not self._closed.is_set():
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        if len(batch) == 0:
+            return
+        with self._write_lock:
+            try:
+                self.logs.insert_many(batch, ordered=False)
+            except Exception as e:
+                # Losing log entries must never break the server
+                print('Error writing {0} log entries: {1}'.format(len(batch),
+                                                                 e),
+                      file=sys.stderr)
+
+    def log(self, message, orcid, data=None):
+
+        entry = dict(data or {})
+        entry['message'] = message
+        entry['orcid'] = orcid
+        entry['time'] = datetime.utcnow()
+
+        if not self.background:
+            res = self.logs.insert_one(entry)
+            return res.acknowledged
+
+        self._start()
+
+        if self.overflow == 'block':
+            self._queue.put(entry)
+            return True
 
-    def log(self, message, orcid, data={}):
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            if self.overflow == 'sync':
+                self._write([entry])
+            else:
+                self.dropped += 1
+                return False
 
-        data['message'] = message
-        data['orcid'] = orcid
-        data['time'] = datetime.utcnow()
+        return True
 
-        res = self.logs.insert_one(data)
+    def flush(self):
+        # Write all the queued entries now
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch = []
+        self._write(batch)
 
-        return res.acknowledged
+    def close(self):
+        # Stop the flusher thread and write what's left
+        self._closed.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(self.flush_interval + 1)
+        self._pid = None
+        self.flush()
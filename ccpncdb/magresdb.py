@@ -1,22 +1,32 @@
 import re
 import json
-from datetime import datetime
-from collections import namedtuple
-from gridfs import GridFS, NoFile
+import threading
+import multiprocessing
+from datetime import datetime, timedelta
+from collections import namedtuple, deque
+from concurrent.futures import (ProcessPoolExecutor, TimeoutError, Future,
+                                CancelledError)
+from concurrent.futures.process import BrokenProcessPool
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
-from pymongo import ReturnDocument
+from pymongo import ReturnDocument, UpdateOne, ReplaceOne, ASCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
-from ccpncdb.utils import (read_magres_file, extract_formula,
+from ccpncdb.utils import (read_magres_file, read_magres_string,
+                           extract_formula,
                            extract_stochiometry, extract_molecules,
                            extract_nmrdata, extract_elements,
-                           extract_elements_ratios, set_null_values,
-                           tokenize_name)
+                           extract_elements_ratios, extract_nmrscalars,
+                           set_null_values, tokenize_name, trigrams,
+                           version_trigrams)
 from ccpncdb.schemas import (magresVersionSchema,
-                             magresRecordSchema,
+                             magresRecordSchema, magresRecordValidator,
                              validate_with)
 from ccpncdb.archive import MagresArchive, MagresArchiveError
-from ccpncdb.search import build_search
+from ccpncdb.blobstore import MagresBlobStore, BlobStoreError
+from ccpncdb.idalloc import IDAllocator
+from ccpncdb.extractcache import ExtractionCache
+from ccpncdb.search import build_search, QueryCache
 
 MagresDBAddResult = namedtuple('MagresDBAddResult',
                                ['successful', 'id', 'mdbref'])
@@ -26,58 +36,337 @@ class MagresDBError(Exception):
     pass
 
 
+def auto_rdata(matoms):
+    # Compute a dictionary of all data that needs to be extracted
+    # automatically from a magres Atoms object
+    formula = extract_formula(matoms)
+    mols = extract_molecules(matoms)
+
+    elements = extract_elements(formula)
+    nmrdata = extract_nmrdata(matoms)
+
+    autodata = {
+        'formula': formula,
+        'stochiometry': extract_stochiometry(formula),
+        'elements': elements,
+        'elements_ratios': extract_elements_ratios(formula),
+        'chemical_formula_descriptive': matoms.get_chemical_formula(),
+        'nelements': len(elements),
+        'molecules': mols,
+        'Z': len(mols),
+        'nmrdata': nmrdata
+    }
+    autodata.update(extract_nmrscalars(nmrdata))
+
+    return autodata
+
+
+def _parse_magres(contents):
+    # Worker for the archive parsing pool: read a magres file and extract
+    # its automatic data in one go
+    magres = read_magres_file(contents)
+    return magres, auto_rdata(magres['Atoms'])
+
+
 class MagresDB(object):
 
-    def __init__(self, client, dbname='ccpnc'):
+    # Indexes on magresIndex. All names carry the INDEX_VERSION prefix, so
+    # that bumping it after changing the set makes ensure_indexes() drop the
+    # old ones and build the new ones
+    INDEX_VERSION = 1
+
+    # Bump after changing how the automatic data is extracted, so that
+    # results cached by older code are not used
+    EXTRACT_VERSION = 1
+    INDEXES = {
+        # Placeholder '0000000' is excluded, as it is set on insertion before
+        # the actual ID is assigned
+        'immutable_id': ([('immutable_id', ASCENDING)],
+                         {'unique': True,
+                          'partialFilterExpression': {
+                              'immutable_id': {'$gt': '0000000'}}}),
+        'orcid': ([('visible', ASCENDING), ('orcid.path', ASCENDING)], {}),
+        'chemname_tokens': ([('visible', ASCENDING),
+                             ('chemname_tokens', ASCENDING)], {}),
+        # Serve wildcard searches on text fields
+        'chemname_trigrams': ([('visible', ASCENDING),
+                               ('chemname_trigrams', ASCENDING)], {}),
+        'version_trigrams': ([('visible', ASCENDING),
+                              ('version_trigrams', ASCENDING)], {}),
+        'stochiometry': ([('visible', ASCENDING),
+                          ('stochiometry.species', ASCENDING),
+                          ('stochiometry.n', ASCENDING)], {}),
+        'elements': ([('visible', ASCENDING), ('elements', ASCENDING)], {}),
+        'license': ([('visible', ASCENDING),
+                     ('last_version.license', ASCENDING)], {}),
+        'msiso': ([('visible', ASCENDING), ('msiso.species', ASCENDING),
+                   ('msiso.value', ASCENDING)], {}),
+        'efgvzz': ([('visible', ASCENDING), ('efgvzz.species', ASCENDING),
+                    ('efgvzz.value', ASCENDING)], {}),
+    }
+
+    # Indexes on magresVersions, same naming
+    VERSION_INDEXES = {
+        'record_n': ([('record_id', ASCENDING), ('n', ASCENDING)],
+                     {'unique': True}),
+    }
+
+    # Sample clauses used by check_indexes to find out which search types
+    # can be served by an index
+    INDEX_PROBES = {
+        'mdbref': {'mdbref': '0000001'},
+        'orcid': {'orcid': '0000-0000-0000-0000'},
+        'chemname': {'pattern': 'ethanol'},
+        'formula': {'formula': 'C2H6O', 'subset': False},
+        'molecule': {'formula': 'C2H6O'},
+        'license': {'license': 'cc-by'},
+        'doi': {'doi': '10.1010/ABCD123456'},
+        'chemform': {'pattern': 'C2H6O'},
+        'extref': {'reftype': 'csd', 'refcode': 'ABCDEF',
+                   'other_reftype': None},
+        'msRange': {'sp': 'H', 'minms': 0.0, 'maxms': 10.0},
+        'efgRange': {'sp': 'H', 'minefg': 0.0, 'maxefg': 1.0},
+    }
+
+    # Projections for search results. 'summary' leaves out the bulky
+    # arrays (tensors) that are only needed for single records
+    SEARCH_PROFILES = {
+        'full': None,
+        'summary': {'nmrdata': 0, 'msiso': 0, 'efgvzz': 0, 'molecules': 0,
+                    'chemname_trigrams': 0, 'version_trigrams': 0},
+        'ids': {'immutable_id': 1, 'id': 1},
+        # What MetadataExport needs, plus _id to fetch versions with
+        'export': {'id': 0, 'user_name': 0, 'chemname_tokens': 0,
+                   'visible': 0, 'last_modified': 0, 'last_version': 0,
+                   'msiso': 0, 'efgvzz': 0, 'chemname_trigrams': 0,
+                   'version_trigrams': 0},
+    }
+    SEARCH_SORT_KEYS = ['immutable_id', 'last_modified', 'chemname',
+                        'nelements']
+
+    # Data added to records after they were first stored, which searches
+    # rely on: run_backfills() fills it in for older records, once per
+    # database. Names of backfill_<name> methods
+    BACKFILLS = ['nmrscalars', 'trigrams', 'stochiometry']
+    # Number of files pushed at once when streaming archives
+    STREAM_BATCH = 50
+
+    # Seconds after which a backfill that a process claimed but never
+    # finished (it died) can be claimed again
+    BACKFILL_STALE = 3600
+
+    def __init__(self, client, dbname='ccpnc', ensure_indexes=True,
+                 parse_workers=0, parse_queue=None, parse_timeout=None,
+                 stream_archives=False, archive_max_size=None,
+                 archive_max_file_size=None, file_compression=None,
+                 id_block_size=1, search_cache=None, extract_cache_size=0,
+                 backfill=True):
+        """Interface to the database.
+
+        Arguments:
+            client (MongoClient): client to connect with
+            dbname (str): name of the database
+            ensure_indexes (bool): reconcile the indexes on startup
+            parse_workers (int): number of processes used to parse archive
+                                 uploads; 0 parses them serially
+            parse_queue (int): maximum number of archive files queued for
+                               the workers at once (default twice the
+                               workers)
+            parse_timeout (float): seconds to wait for each archive file to
+                                   be parsed, counted from when it is
+                                   collected (in order) rather than
+                                   submitted, so an archive of N files may
+                                   take up to N times as long (default no
+                                   limit)
+            stream_archives (bool): read, validate and push archive files
+                                    one at a time, reporting invalid ones
+                                    as failed instead of rejecting the
+                                    whole archive
+            archive_max_size (int): maximum uncompressed archive size, in
+                                    bytes (default no limit)
+            archive_max_file_size (int): maximum uncompressed size of each
+                                         file in an archive, in bytes
+                                         (default no limit)
+            file_compression (str): compression for newly stored magres
+                                    files, 'zstd' or 'gzip' (default zstd
+                                    if available)
+            id_block_size (int): number of immutable IDs reserved from the
+                                 counter at once and handed out from
+                                 memory; IDs left unused when the process
+                                 exits are skipped (default 1)
+            search_cache (ResultCache): cache for the IDs of search
+                                        results (default no caching)
+            extract_cache_size (int): number of magres files whose
+                                      automatic data is cached, so that
+                                      uploading them again skips parsing
+                                      (default 0, no caching)
+            backfill (bool): run the backfills of BACKFILLS not yet run
+                             on this database on startup
+        """
 
         self.client = client
         ccpnc = self.client[dbname]
 
         # Grab the collections
         #
-        # 1. GridFS collection for magres files
-        self.magresFilesFS = GridFS(ccpnc, 'magresFilesFS')
+        # 1. GridFS collection for magres files, deduplicated and compressed
+        self.magresFiles = MagresBlobStore(ccpnc, 'magresFilesFS',
+                                           compression=file_compression)
+        self.magresFilesFS = self.magresFiles.fs
         # 2. Searchable data, including multiple versions (and references to
         # files)
         self.magresIndex = ccpnc.magresIndex
-        # 3. Unique ID counter
+        # 3. Versions, one document per version, keyed by (record_id, n)
+        self.magresVersions = ccpnc.magresVersions
+        # 4. Unique ID counter
         self.magresIDcount = ccpnc.magresIDcount
+        self._ids = IDAllocator(self.magresIDcount, id_block_size)
+        # 5. Generation counter, bumped at every write, for search caching
+        self.magresGeneration = ccpnc.magresGeneration
+        self.search_cache = search_cache
+        # 6. Backfills already run on this database
+        self.magresBackfills = ccpnc.magresBackfills
+        # 7. Automatic data extracted from magres files, by content
+        self.extract_cache = None
+        if extract_cache_size > 0:
+            self.extract_cache = ExtractionCache(ccpnc.magresExtractCache,
+                                                 self.EXTRACT_VERSION,
+                                                 extract_cache_size)
+
+        self.parse_workers = parse_workers
+        self.parse_queue = parse_queue or 2*parse_workers
+        self.parse_timeout = parse_timeout
+        self._pool = None
+        self._pool_futures = {}
+        self._pool_lock = threading.Lock()
+
+        self.stream_archives = stream_archives
+        self.archive_max_size = archive_max_size
+        self.archive_max_file_size = archive_max_file_size
+
+        if ensure_indexes:
+            self.ensure_indexes()
+        if backfill:
+            self.run_backfills()
+
+    def _index_name(self, name):
+        return 'ccpnc_v{0}_{1}'.format(self.INDEX_VERSION, name)
+
+    def ensure_indexes(self):
+        """Reconcile the indexes on magresIndex with INDEXES (and on
+        magresVersions with VERSION_INDEXES): create the missing ones and
+        drop those left over from previous versions. Returns the names of
+        created and dropped indexes."""
+
+        created = []
+        dropped = []
+        for coll, indexes in [(self.magresIndex, self.INDEXES),
+                              (self.magresVersions, self.VERSION_INDEXES)]:
+            existing = coll.index_information()
+            wanted = {self._index_name(n): spec
+                      for n, spec in indexes.items()}
+
+            for name in existing:
+                if name.startswith('ccpnc_v') and name not in wanted:
+                    coll.drop_index(name)
+                    dropped.append(name)
+
+            for name, (keys, opts) in sorted(wanted.items()):
+                if name not in existing:
+                    coll.create_index(keys, name=name, **opts)
+                    created.append(name)
+
+        self.magresFiles.ensure_indexes()
+        if self.extract_cache is not None:
+            self.extract_cache.ensure_indexes()
+
+        return created, dropped
+
+    def check_indexes(self):
+        """Run explain() on a sample query for each search type and report
+        which ones still resort to a full collection scan.
+
+        Returns a dictionary {search type: True if it scans the collection}
+        """
+
+        def has_collscan(plan):
+            if isinstance(plan, dict):
+                if plan.get('stage') == 'COLLSCAN':
+                    return True
+                return any(has_collscan(v) for v in plan.values())
+            elif isinstance(plan, list):
+                return any(has_collscan(v) for v in plan)
+            return False
+
+        report = {}
+        for stype, args in sorted(self.INDEX_PROBES.items()):
+            query = build_search([{'type': stype, 'args': args,
+                                   'negate_query': False}])
+            expl = self.magresIndex.find(query).explain()
+            plan = expl.get('queryPlanner', {}).get('winningPlan', {})
+            report[stype] = has_collscan(plan)
+
+        return report
 
     def _auto_rdata(self, matoms):
-        # Compute a dictionary of all data that needs to be extracted
-        # automatically from a magres Atoms object
-        formula = extract_formula(matoms)
-        mols = extract_molecules(matoms)
-
-        elements = extract_elements(formula)
-
-        autodata = {
-            'formula': formula,
-            'stochiometry': extract_stochiometry(formula),
-            'elements': elements,
-            'elements_ratios': extract_elements_ratios(formula),
-            'chemical_formula_descriptive': matoms.get_chemical_formula(),
-            'nelements': len(elements),
-            'molecules': mols,
-            'Z': len(mols),
-            'nmrdata': extract_nmrdata(matoms)
-        }
-
-        return autodata
+        return auto_rdata(matoms)
+
+    def _magres_autodata(self, magres):
+        # Automatic data of a loaded magres file, extracted on first use
+        if magres.get('autodata') is None:
+            magres['autodata'] = self._auto_rdata(magres['Atoms'])
+        return magres['autodata']
+
+    def _magres_calc(self, magres):
+        # JSON calculation block of a loaded magres file
+        if 'calc' not in magres:
+            calc_block = magres['Atoms'].info.get('magresblock_calculation',
+                                                  {})
+            magres['calc'] = (json.dumps(calc_block) if len(calc_block) > 0
+                              else None)
+        return magres['calc']
+
+    def _cache_lookup(self, mstr):
+        # Magres file already extracted, with Atoms None (it's not parsed
+        # at all), or None if not cached
+        if self.extract_cache is None:
+            return None
+        cached = self.extract_cache.get(self.extract_cache.key(mstr))
+        if cached is None:
+            return None
+        autodata, calc_block = cached
+        return {'string': mstr, 'Atoms': None, 'autodata': autodata,
+                'calc': calc_block}
+
+    def _cache_store(self, magres):
+        if self.extract_cache is None or magres['Atoms'] is None:
+            return
+        self.extract_cache.put(self.extract_cache.key(magres['string']),
+                               self._magres_autodata(magres),
+                               self._magres_calc(magres))
 
     def _load_magres(self, mfile):
 
         # Read in magres file
         try:
-            magres = read_magres_file(mfile)
+            mstr = read_magres_string(mfile)
+        except:
+            raise MagresDBError('Invalid magres file')
+
+        magres = self._cache_lookup(mstr)
+        if magres is not None:
+            return magres
+
+        try:
+            magres = read_magres_file(mstr)
         except:
             # Anything, really
             raise MagresDBError('Invalid magres file')
-        return magres
+        self._cache_store(magres)
 
-    def _validate_rdata(self, magres, record_data, date=None):
+        return magres
 
-        matoms = magres['Atoms']
+    def _validate_rdata(self, magres, record_data, date=None, autodata=None):
 
         if date is None:
             date = datetime.utcnow()
@@ -88,18 +377,21 @@ class MagresDB(object):
             'type': 'magres',
             'visible': True,
             'chemname_tokens': [''],
+            'chemname_trigrams': [''],
+            'version_trigrams': [''],
             'last_modified': date,
             'immutable_id': '0000000',     # Placeholder
             'version_count': 0,
-            'version_history': [],          # Empty for now
             'last_version': None
         }
 
-        record_autodata.update(self._auto_rdata(matoms))
+        if autodata is None:
+            autodata = self._magres_autodata(magres)
+        record_autodata.update(autodata)
 
         record_data = dict(record_data)
         record_data.update(record_autodata)
-        valres = validate_with(record_data, magresRecordSchema)
+        valres = magresRecordValidator.validate(record_data)
 
         if not valres.result:
             if valres.invalid is None:
@@ -112,13 +404,14 @@ class MagresDB(object):
 
         # Extract the tokens
         record_data['chemname_tokens'] = tokenize_name(record_data['chemname'])
+        record_data['chemname_trigrams'] = trigrams(record_data['chemname'])
+        record_data['version_trigrams'] = []
         record_data = set_null_values(record_data, magresRecordSchema)
 
         return record_data
 
     def _push_record(self, magres, record_data, version_data):
 
-        mstr = magres['string']
         date = record_data['last_modified']
 
       # Add the record to the database
@@ -128,7 +421,9 @@ class MagresDB(object):
         record_id = res.inserted_id
         # Finally, the version data
         try:
-            self.add_version(record_id, mstr, version_data, False, date)
+            # The file is already loaded, don't read it again
+            version_data = self._validate_vdata(version_data, date)
+            self._push_version(record_id, magres, version_data, False)
         except MagresDBError as e:
             # Delete the record for the failed version
             self.magresIndex.delete_one({'_id': ObjectId(record_id)})
@@ -140,6 +435,8 @@ class MagresDB(object):
                                           {'$set': {'id': str(record_id),
                                                     'immutable_id': mdbref}})
 
+        self._bump_generation()
+
         return MagresDBAddResult(res.acknowledged, str(record_id), mdbref)
 
     def _validate_vdata(self, version_data={}, date=None):
@@ -171,6 +468,14 @@ class MagresDB(object):
 
         return version_data
 
+    def _store_magres(self, record_id, magres):
+        # Store the magres file (or reuse an identical one), return its ID
+        # and the JSON calculation block
+        mfile_id = self.magresFiles.put(magres['string'],
+                                        filename=str(record_id))
+
+        return mfile_id, self._magres_calc(magres)
+
     def _push_version(self, record_id, magres, version_data,
                       update_record=True):
 
@@ -183,17 +488,9 @@ class MagresDB(object):
                                     'first version of a record')
             mfile_id = rec['last_version']['magresFilesID']
             calc_block = rec['last_version']['magres_calc']
+            self.magresFiles.retain(mfile_id)
         else:
-
-            mstr = magres['string']
-            matoms = magres['Atoms']
-
-            mfile_id = self.magresFilesFS.put(mstr,
-                                              filename=record_id,
-                                              encoding='UTF-8')
-            calc_block = matoms.info.get('magresblock_calculation', {})
-            calc_block = (json.dumps(calc_block) if len(calc_block) > 0 else
-                          None)
+            mfile_id, calc_block = self._store_magres(record_id, magres)
 
         date = version_data['date']
 
@@ -201,24 +498,48 @@ class MagresDB(object):
         version_data['magresFilesID'] = str(mfile_id)
         version_data['magres_calc'] = calc_block
 
-        to_set = {'last_version': version_data, 'last_modified': date}
+        to_set = {'last_version': version_data, 'last_modified': date,
+                  'version_trigrams': version_trigrams(version_data)}
 
         if update_record and magres is not None:
             # Update the automatically generated elements in the record
-            to_set.update(self._auto_rdata(matoms))
-
-        res = self.magresIndex.update_one({'_id': ObjectId(record_id)},
-                                          {'$push': {
-                                              'version_history':
-                                              version_data
-                                          },
-            '$inc': {'version_count': 1},
-            '$set': to_set
-        })
-
-        if not res.acknowledged:
-            raise MagresDBError('Could not push new version for record ' +
-                                str(record_id))
+            to_set.update(self._magres_autodata(magres))
+
+        # The current count is the number of the new version. Its row goes
+        # in first, so the record never points at a version that isn't
+        # stored; the unique (record_id, n) index stops concurrent pushes
+        # from taking the same number, and the record is only updated if
+        # nobody else has moved the count since
+        record_id = ObjectId(record_id)
+        rec = self.magresIndex.find_one({'_id': record_id},
+                                        projection={'version_count': 1})
+        try:
+            if rec is None:
+                raise MagresDBError('Could not push new version for record '
+                                    + str(record_id))
+            n = rec['version_count']
+            try:
+                self.magresVersions.insert_one(dict(version_data,
+                                                    record_id=record_id,
+                                                    n=n))
+            except DuplicateKeyError:
+                raise MagresDBError('Could not push new version for record '
+                                    + str(record_id) + ': concurrent edit')
+            to_set['version_count'] = n+1
+            res = self.magresIndex.update_one({'_id': record_id,
+                                               'version_count': n},
+                                              {'$set': to_set})
+            if res.matched_count == 0:
+                self.magresVersions.delete_one({'record_id': record_id,
+                                                'n': n})
+                raise MagresDBError('Could not push new version for record '
+                                    + str(record_id) + ': concurrent edit')
+        except Exception:
+            # The file isn't referenced after all
+            self.magresFiles.release(mfile_id)
+            raise
+
+        self._bump_generation()
 
     def add_record(self, mfile, record_data, version_data, date=None):
 
@@ -244,32 +565,247 @@ class MagresDB(object):
 
     def add_archive(self, archive, record_data, version_data):
 
-        ma = MagresArchive(archive, record_data=record_data,
-                           version_data=version_data)
+        with MagresArchive(archive, record_data=record_data,
+                           version_data=version_data,
+                           stream=self.stream_archives,
+                           max_size=self.archive_max_size,
+                           max_file_size=self.archive_max_file_size) as ma:
+            if self.stream_archives:
+                return self._stream_archive(ma)
 
-        data = {}
+            data = []
 
-        results = {}
+            for f, magres, autodata in self._parse_archive_files(ma.files()):
 
-        for f in ma.files():
+                rdata = self._validate_rdata(magres, f.record_data,
+                                             autodata=autodata)
+                vdata = self._validate_vdata(f.version_data,
+                                             rdata['last_modified'])
+                data.append((f.name, magres, rdata, vdata))
 
-            magres = self._load_magres(f.contents)
-            rdata = self._validate_rdata(magres, f.record_data)
-            vdata = self._validate_vdata(f.version_data)
-            data[f.name] = (magres, rdata, vdata)
+        # If everything's gone right, we can push
+        return self._push_records(data)
 
-        successful = []
-        failed = []
-        mdbrefs = []
-        ids = []
+    def _stream_archive(self, ma):
+        # Push files in batches of STREAM_BATCH as soon as they are ready,
+        # so that only a few are held in memory at any time
 
-        # If everything's gone right, we can push
-        for f in ma.files():
-            magres, rdata, vdata = data[f.name]
+        results = {}
+        batch = []
+        files = self._parse_archive_files(ma.files(), strict=False)
+
+        for f, magres, autodata in files:
             try:
-                results[f.name] = self._push_record(magres, rdata, vdata)
-            except:
+                if magres is None:
+                    raise MagresDBError('Invalid magres file')
+                rdata = self._validate_rdata(magres, f.record_data,
+                                             autodata=autodata)
+                vdata = self._validate_vdata(f.version_data,
+                                             rdata['last_modified'])
+            except MagresDBError:
                 results[f.name] = None
+                continue
+            # Set now too, to keep the results in the archive's order
+            results[f.name] = None
+            batch.append((f.name, magres, rdata, vdata))
+            if len(batch) >= self.STREAM_BATCH:
+                results.update(self._push_records(batch))
+                batch = []
+        results.update(self._push_records(batch))
+
+        return results
+
+    def _get_pool(self):
+        # The pool is shared by all request threads
+        with self._pool_lock:
+            if self._pool is None:
+                # Spawn rather than fork, as the parent holds a MongoClient
+                ctx = multiprocessing.get_context('spawn')
+                self._pool = ProcessPoolExecutor(self.parse_workers,
+                                                 mp_context=ctx)
+            return self._pool
+
+    def _reset_pool(self, pool=None):
+        # Shut down the pool (only if it is still pool, when given: another
+        # thread may have replaced it already) and kill its workers, which
+        # may be stuck on a file
+        with self._pool_lock:
+            if self._pool is None or (pool is not None and
+                                      self._pool is not pool):
+                return
+            pool = self._pool
+            self._pool = None
+            futures = list(self._pool_futures.pop(pool, ()))
+
+        # The executor has no public way to reach its workers; _processes
+        # (a {pid: Process} dictionary) is there in CPython 3.8 to 3.13
+        processes = list((getattr(pool, '_processes', None) or {}).values())
+        if processes:
+            # Killing them breaks the pool: the executor fails whatever is
+            # pending with BrokenProcessPool and shuts itself down. Also
+            # cancelling or shutting down trips its cleanup on Python 3.8
+            for p in processes:
+                if p.is_alive():
+                    p.terminate()
+        else:
+            # shutdown(cancel_futures=True) needs Python 3.9
+            for f in futures:
+                f.cancel()
+            pool.shutdown(wait=False)
+
+    def _submit(self, contents):
+        # Send a file to the pool, replacing it if it was shut down by
+        # another thread or broken
+        for attempt in range(2):
+            pool = self._get_pool()
+            try:
+                future = pool.submit(_parse_magres, contents)
+            except (RuntimeError, BrokenProcessPool):
+                self._reset_pool(pool)
+                continue
+            # Kept until done, to be cancelled if the pool is reset (if it
+            # already was, its workers are gone and the future will fail)
+            with self._pool_lock:
+                if self._pool is pool:
+                    pending = self._pool_futures.setdefault(pool, set())
+                    pending.add(future)
+                    future.add_done_callback(pending.discard)
+            return pool, future
+        raise MagresDBError('Could not start parsing archive files')
+
+    def _parse_archive_files(self, files, strict=True):
+        # Parse and extract the automatic data for archive files, in a
+        # process pool if so configured. Yields (file, magres, autodata) in
+        # the same order as files; autodata is None if parsed serially.
+        # If not strict, invalid files (and those that time out) are yielded
+        # with magres None instead of raising an error
+
+        if self.parse_workers < 1:
+            for f in files:
+                try:
+                    magres = self._load_magres(f.contents)
+                except MagresDBError:
+                    if strict:
+                        raise
+                    magres = None
+                yield f, magres, None
+            return
+
+        queue = deque()
+
+        def collect(f, pool, future, retry=True):
+            try:
+                magres, autodata = future.result(timeout=self.parse_timeout)
+            except TimeoutError:
+                # The worker may be stuck, start afresh next time
+                self._reset_pool(pool)
+                if strict:
+                    raise MagresDBError('Timed out while reading ' + f.name)
+                return f, None, None
+            except (BrokenProcessPool, CancelledError):
+                # The pool was reset under it, because of another file;
+                # try once more on a new one
+                if retry:
+                    return collect(f, *self._submit(f.contents), False)
+                if strict:
+                    raise MagresDBError('Could not read ' + f.name)
+                return f, None, None
+            except Exception:
+                if strict:
+                    raise MagresDBError('Invalid magres file')
+                return f, None, None
+            magres['autodata'] = autodata
+            self._cache_store(magres)
+            return f, magres, autodata
+
+        try:
+            for f in files:
+                # Files extracted before don't need a worker
+                try:
+                    magres = self._cache_lookup(read_magres_string(f.contents))
+                except UnicodeDecodeError:
+                    magres = None
+                if magres is not None:
+                    pool = None
+                    future = Future()
+                    future.set_result((magres, magres['autodata']))
+                else:
+                    # The pool may have been replaced after a timeout
+                    try:
+                        pool, future = self._submit(f.contents)
+                    except MagresDBError as e:
+                        if strict:
+                            raise
+                        pool, future = None, Future()
+                        future.set_exception(e)
+                queue.append((f, pool, future))
+                if len(queue) >= self.parse_queue:
+                    yield collect(*queue.popleft())
+            while len(queue) > 0:
+                yield collect(*queue.popleft())
+        finally:
+            for _, _, future in queue:
+                future.cancel()
+
+    def _push_records(self, data):
+        # Push many new records at once, each with its first version. data
+        # is a list of (name, magres, record_data, version_data) tuples;
+        # returns a dictionary {name: MagresDBAddResult, or None if failed}
+
+        results = {name: None for name, _, _, _ in data}
+        if len(data) == 0:
+            return results
+
+        # One counter increment for the whole block
+        mdbrefs = self.generate_ids(len(data))
+
+        records = []
+        names = []
+        for (name, magres, rdata, vdata), mdbref in zip(data, mdbrefs):
+            record_id = ObjectId()
+            try:
+                mfile_id, calc_block = self._store_magres(record_id, magres)
+            except Exception:
+                continue
+
+            vdata = dict(vdata)
+            vdata['magresFilesID'] = str(mfile_id)
+            vdata['magres_calc'] = calc_block
+
+            rdata = dict(rdata)
+            rdata.update({
+                '_id': record_id,
+                'id': str(record_id),
+                'immutable_id': mdbref,
+                'version_count': 1,
+                'last_version': vdata,
+                'last_modified': vdata['date'],
+                'version_trigrams': version_trigrams(vdata),
+            })
+            records.append(rdata)
+            names.append(name)
+
+        failed = set()
+        try:
+            self.magresIndex.insert_many(records, ordered=False)
+        except BulkWriteError as e:
+            failed = {err['index'] for err in e.details['writeErrors']}
+
+        versions = []
+        for i, (name, rec) in enumerate(zip(names, records)):
+            if i in failed:
+                # Don't leave orphaned files behind
+                fs_id = rec['last_version']['magresFilesID']
+                self.magresFiles.release(fs_id)
+            else:
+                versions.append(dict(rec['last_version'],
+                                     record_id=rec['_id'], n=0))
+                results[name] = MagresDBAddResult(True, rec['id'],
+                                                  rec['immutable_id'])
+
+        if len(versions) > 0:
+            self.magresVersions.insert_many(versions)
+        self._bump_generation()
 
         return results
 
@@ -277,6 +813,7 @@ class MagresDB(object):
 
         res = self.magresIndex.update_one({'_id': ObjectId(record_id)},
                                           update=update)
+        self._bump_generation()
 
         return res.acknowledged
 
@@ -296,37 +833,483 @@ class MagresDB(object):
 
         return mrec
 
-    def get_magres_file(self, fs_id, decode=False):
+    def _legacy_versions(self, record_ids):
+        # Versions still embedded in records as version_history (stored
+        # before split_version_history was run), as {ObjectId: list}
+        cursor = self.magresIndex.find(
+            {'_id': {'$in': list(record_ids)},
+             'version_history': {'$exists': True}},
+            projection={'version_history': 1})
+        return {r['_id']: r['version_history'] for r in cursor}
+
+    def get_version(self, record_id, n):
+        # Version n (counting from 0) of a record
 
         try:
-            mfile_ref = self.magresFilesFS.get(ObjectId(fs_id))
-        except NoFile:
-            raise MagresDBError('File not found')
+            record_id = ObjectId(record_id)
+            n = int(n)
+            version = self.magresVersions.find_one(
+                {'record_id': record_id, 'n': n},
+                projection={'_id': 0, 'record_id': 0, 'n': 0})
+        except InvalidId:
+            raise MagresDBError('Invalid ID requested')
+
+        if version is None:
+            history = self._legacy_versions([record_id]).get(record_id, [])
+            if 0 <= n < len(history):
+                version = history[n]
+
+        if version is None:
+            raise MagresDBError('Version not found')
+
+        return version
+
+    def get_versions(self, record_id):
+        # All versions of a record, in order
+
+        try:
+            record_id = ObjectId(record_id)
+            cursor = self.magresVersions.find(
+                {'record_id': record_id},
+                projection={'_id': 0, 'record_id': 0},
+                sort=[('n', ASCENDING)])
+        except InvalidId:
+            raise MagresDBError('Invalid ID requested')
+
+        versions = dict(enumerate(self._legacy_versions([record_id]).get(
+            record_id, [])))
+        for v in cursor:
+            versions[v.pop('n')] = v
+
+        return [versions[n] for n in sorted(versions)]
+
+    def get_versions_bulk(self, pairs):
+        # Many versions at once, given as (record_id, n) pairs. Returns a
+        # dictionary {(ObjectId, n): version}; missing ones are left out
+
+        try:
+            pairs = {(ObjectId(r), int(n)) for r, n in pairs}
+        except InvalidId:
+            raise MagresDBError('Invalid ID requested')
+        if len(pairs) == 0:
+            return {}
+
+        cursor = self.magresVersions.find(
+            {'$or': [{'record_id': r, 'n': n} for r, n in pairs]},
+            projection={'_id': 0})
+
+        versions = {}
+        for v in cursor:
+            key = (v.pop('record_id'), v.pop('n'))
+            versions[key] = v
+
+        missing = pairs - set(versions)
+        if len(missing) > 0:
+            legacy = self._legacy_versions({r for r, _ in missing})
+            for r, n in missing:
+                history = legacy.get(r, [])
+                if 0 <= n < len(history):
+                    versions[(r, n)] = history[n]
+
+        return versions
+
+    def get_version_by_mdbref(self, mdbref, n):
+        # Version n of the visible record with the given immutable ID
+
+        rec = self.magresIndex.find_one({'immutable_id': mdbref,
+                                         'visible': True},
+                                        projection={'_id': 1})
+        if rec is None:
+            raise MagresDBError('Record not found')
+
+        return self.get_version(rec['_id'], n)
+
+    def get_magres_file(self, fs_id, decode=False):
+
+        data = self.open_magres_file(fs_id).read()
 
         if decode:
-            return mfile_ref.read().decode('utf-8')
+            return data.decode('utf-8')
         else:
-            return mfile_ref.read()
+            return data
+
+    def open_magres_file(self, fs_id):
+        # Return the stored magres file (a MagresBlob, decompressing on the
+        # fly)
+
+        try:
+            return self.magresFiles.get(fs_id)
+        except BlobStoreError:
+            raise MagresDBError('File not found')
+
+    def iter_magres_file(self, fs_id, start=0, stop=None):
+        # Return a generator over the chunks of a stored magres file, or of
+        # the byte range start:stop of it. Errors on finding the file are
+        # raised straight away
+        return self.open_magres_file(fs_id).chunks(start, stop)
 
-    def search_record(self, query):
+    def _build_query(self, query):
 
         query = build_search(query)
         if len(query['$and']) == 1:
             # Query for everything
-            raise MagresDBError('Empty query') 
-        results = self.magresIndex.find(query)
+            raise MagresDBError('Empty query')
+
+        return query
+
+    def _bump_generation(self):
+        # Any write makes cached search results out of date
+        self.magresGeneration.update_one({'_id': 'search'},
+                                         {'$inc': {'n': 1}}, upsert=True)
+
+    def _generation(self):
+        gen = self.magresGeneration.find_one({'_id': 'search'})
+        return 0 if gen is None else gen['n']
+
+    def _check_sort(self, sort):
+        try:
+            sort = [(k, int(d)) for k, d in sort]
+        except (TypeError, ValueError):
+            raise MagresDBError('Invalid sort key')
+        if any(k not in self.SEARCH_SORT_KEYS or d not in (1, -1)
+               for k, d in sort):
+            raise MagresDBError('Invalid sort key')
+        # Tie-break on _id so that pages are stable
+        return sort + [('_id', 1)]
+
+    def _search_ids(self, spec, mquery, sort=None):
+        # IDs of all the records matching a search, in order, from the
+        # cache if possible. None if the search can't be cached, or matches
+        # too many records for it
+        key = QueryCache.key(spec)
+        if self.search_cache is None or key is None:
+            return None
+        key = (key, tuple(sort or ()))
+
+        generation = self._generation()
+        ids = self.search_cache.get(key, generation)
+        if ids is None:
+            # One more than fits tells us it's too big, without loading
+            # all of them
+            max_ids = self.search_cache.max_ids
+            cursor = self.magresIndex.find(mquery, projection={'_id': 1})
+            if sort:
+                cursor = cursor.sort(sort)
+            ids = [str(r['_id']) for r in cursor.limit(max_ids+1)]
+            self.search_cache.set(key, generation, ids)
+            if len(ids) > max_ids:
+                return None
+        elif ids is False:
+            return None
+
+        return ids
+
+    def search_record(self, query, limit=None, skip=0, sort=None,
+                      profile='full'):
+        """Search for records. Returns a cursor, or a list of records when
+        served from the search cache.
+
+        Arguments:
+            query (list): search specification, as for build_search
+            limit (int): maximum number of results (None for all)
+            skip (int): number of results to skip, for pagination
+            sort (list): list of (key, direction) pairs, with keys from
+                         SEARCH_SORT_KEYS and direction 1 or -1
+            profile (str): one of the SEARCH_PROFILES projections
+        """
+
+        spec = query
+        query = self._build_query(query)
+
+        skip = int(skip)
+        limit = None if limit is None else int(limit)
+        if skip < 0 or (limit is not None and limit < 0):
+            raise MagresDBError('Invalid limit or skip')
+
+        try:
+            projection = self.SEARCH_PROFILES[profile]
+        except KeyError:
+            raise MagresDBError('Invalid search profile')
+
+        if sort:
+            sort = self._check_sort(sort)
+
+        ids = self._search_ids(spec, query, sort)
+        if ids is not None:
+            # Only fetch the page
+            page = ids[skip:]
+            if limit is not None:
+                page = page[:limit]
+            page = [ObjectId(i) for i in page]
+            found = {rec['_id']: rec for rec in self.magresIndex.find(
+                {'_id': {'$in': page}}, projection=projection)}
+            return [found[i] for i in page if i in found]
+
+        results = self.magresIndex.find(query, projection=projection)
+
+        if sort:
+            results = results.sort(sort)
+        if skip:
+            results = results.skip(skip)
+        if limit is not None:
+            results = results.limit(limit)
 
         return results
 
+    def get_records_by_mdbref(self, mdbrefs, profile='full'):
+        # Fetch many visible records with a single query. Returns a
+        # dictionary {mdbref: record}; missing ones are left out
+
+        try:
+            projection = self.SEARCH_PROFILES[profile]
+        except KeyError:
+            raise MagresDBError('Invalid search profile')
+
+        query = {'immutable_id': {'$in': list(mdbrefs)}, 'visible': True}
+        results = self.magresIndex.find(query, projection=projection)
+
+        return {rec['immutable_id']: rec for rec in results}
+
+    def count_records(self, query):
+
+        spec = query
+        query = self._build_query(query)
+
+        ids = self._search_ids(spec, query)
+        if ids is not None:
+            return len(ids)
+
+        return self.magresIndex.count_documents(query)
+
+    def run_backfills(self, batch_size=500):
+        """Run the backfills in BACKFILLS that haven't completed on this
+        database yet, so that records stored before the data they add was
+        introduced aren't left out of searches. Each is claimed first, so
+        that of several processes starting at once only one runs it; the
+        others carry on without. Returns a dictionary {name: number of
+        updated records} of the ones run here."""
+
+        report = {}
+        for name in self.BACKFILLS:
+            now = datetime.utcnow()
+            stale = now - timedelta(seconds=self.BACKFILL_STALE)
+            try:
+                # Inserts the claim if there's none, fails on a duplicate
+                # _id if it's done or someone else holds it
+                self.magresBackfills.update_one(
+                    {'_id': name, '$or': [
+                        {'state': {'$nin': ['running', 'done']}},
+                        {'state': 'running', 'started': {'$lt': stale}}]},
+                    {'$set': {'state': 'running', 'started': now}},
+                    upsert=True)
+            except DuplicateKeyError:
+                continue
+
+            try:
+                report[name] = getattr(self, 'backfill_' + name)(batch_size)
+            except Exception:
+                self.magresBackfills.update_one(
+                    {'_id': name}, {'$set': {'state': 'failed'}})
+                raise
+            self.magresBackfills.update_one(
+                {'_id': name}, {'$set': {'state': 'done',
+                                         'date': datetime.utcnow()}})
+
+        return report
+
+    def backfill_nmrscalars(self, batch_size=500):
+        """Compute the flattened msiso/efgvzz arrays for records stored
+        before they were introduced, without which they don't show up in
+        NMR range searches; run_backfills() does it on startup. Returns the
+        number of updated records.
+        """
+
+        cursor = self.magresIndex.find({'msiso': {'$exists': False}},
+                                       projection={'nmrdata': 1})
+
+        n = 0
+        ops = []
+        for rec in cursor:
+            scalars = extract_nmrscalars(rec.get('nmrdata') or [])
+            ops.append(UpdateOne({'_id': rec['_id']}, {'$set': scalars}))
+            if len(ops) >= batch_size:
+                n += self.magresIndex.bulk_write(ops,
+                                                 ordered=False).modified_count
+                ops = []
+        if len(ops) > 0:
+            n += self.magresIndex.bulk_write(ops, ordered=False).modified_count
+        self._bump_generation()
+
+        return n
+
+    def backfill_trigrams(self, batch_size=500):
+        """Compute the trigram arrays used by wildcard searches for records
+        stored before they were introduced. Until this is done, those
+        records don't show up in chemname, chemform, DOI and reference
+        code searches; run_backfills() does it on startup. Returns the
+        number of updated records.
+        """
+
+        cursor = self.magresIndex.find(
+            {'version_trigrams': {'$exists': False}},
+            projection={'chemname': 1, 'last_version': 1})
+
+        n = 0
+        ops = []
+        for rec in cursor:
+            tg = {
+                'chemname_trigrams': trigrams(rec.get('chemname') or ''),
+                'version_trigrams': version_trigrams(rec.get('last_version')
+                                                     or {})
+            }
+            ops.append(UpdateOne({'_id': rec['_id']}, {'$set': tg}))
+            if len(ops) >= batch_size:
+                n += self.magresIndex.bulk_write(ops,
+                                                 ordered=False).modified_count
+                ops = []
+        if len(ops) > 0:
+            n += self.magresIndex.bulk_write(ops, ordered=False).modified_count
+        self._bump_generation()
+
+        return n
+
+    def backfill_stochiometry(self, batch_size=500):
+        """Recompute the stochiometry of records from their formula. It
+        used to be reduced by common prime factors only as long as the
+        smallest ones matched, so that e.g. C6H9 wasn't reduced to C2H3,
+        and such records weren't found by formula; run_backfills() does it
+        on startup. Returns the number of updated records.
+        """
+
+        cursor = self.magresIndex.find({},
+                                       projection={'formula': 1,
+                                                   'stochiometry': 1})
+
+        n = 0
+        ops = []
+        for rec in cursor:
+            stochio = extract_stochiometry(rec.get('formula') or [])
+            if stochio == rec.get('stochiometry'):
+                continue
+            ops.append(UpdateOne({'_id': rec['_id']},
+                                 {'$set': {'stochiometry': stochio}}))
+            if len(ops) >= batch_size:
+                n += self.magresIndex.bulk_write(ops,
+                                                 ordered=False).modified_count
+                ops = []
+        if len(ops) > 0:
+            n += self.magresIndex.bulk_write(ops, ordered=False).modified_count
+        self._bump_generation()
+
+        return n
+
+    def _magres_file_refs(self):
+        # Generator over the file IDs referenced by all versions
+        for v in self.magresVersions.find({}, projection={
+                'magresFilesID': 1}):
+            yield v.get('magresFilesID')
+
+    def migrate_magres_files(self, batch_size=500):
+        """Move files stored before content addressing to the deduplicated,
+        compressed store: repoint the versions to the new files, delete the
+        old ones and recount references. Returns a report with the number
+        of files migrated and created and the bytes reclaimed. Versions
+        must have been split out of the records first (see
+        split_version_history)."""
+
+        if self.magresIndex.find_one({'version_history': {'$exists': True}},
+                                     projection={'_id': 1}) is not None:
+            raise MagresDBError('Records with an embedded version_history '
+                                'must be split first')
+
+        # 1. Store the new files
+        remap = {}
+        ncreated = 0
+        size_before = 0
+        size_after = 0
+        for fdoc in self.magresFiles.legacy_files():
+            new_id, created = self.magresFiles.migrate_legacy(fdoc)
+            remap[str(fdoc['_id'])] = str(new_id)
+            size_before += fdoc['length']
+            if created:
+                ncreated += 1
+                size_after += self.magresFiles.get(new_id).stored_length
+
+        # 2. Repoint the versions, then the records' latest ones
+        for coll, field in [(self.magresVersions, 'magresFilesID'),
+                            (self.magresIndex, 'last_version.magresFilesID')]:
+            if len(remap) == 0:
+                break
+            ops = []
+            cursor = coll.find({field: {'$in': list(remap)}},
+                               projection={field: 1})
+            for doc in cursor:
+                old_id = doc
+                for k in field.split('.'):
+                    old_id = old_id[k]
+                ops.append(UpdateOne({'_id': doc['_id']},
+                                     {'$set': {field: remap[old_id]}}))
+                if len(ops) >= batch_size:
+                    coll.bulk_write(ops, ordered=False)
+                    ops = []
+            if len(ops) > 0:
+                coll.bulk_write(ops, ordered=False)
+
+        # 3. Delete the old files and recount
+        for old_id in remap:
+            self.magresFiles.delete(old_id)
+
+        refcounts = {}
+        for fs_id in self._magres_file_refs():
+            refcounts[fs_id] = refcounts.get(fs_id, 0) + 1
+        for fs_id in set(remap.values()):
+            self.magresFiles.set_refcount(fs_id, refcounts.get(fs_id, 0))
+
+        return {
+            'migrated': len(remap),
+            'created': ncreated,
+            'size_before': size_before,
+            'size_after': size_after,
+            'reclaimed': size_before - size_after
+        }
+
+    def split_version_history(self, batch_size=500):
+        """Move the versions of records stored with an embedded
+        version_history to magresVersions, leaving only last_version and
+        version_count on the record. Safe to run again if interrupted.
+        Returns the number of converted records."""
+
+        cursor = self.magresIndex.find(
+            {'version_history': {'$exists': True}},
+            projection={'version_history': 1})
+
+        n = 0
+        for rec in cursor:
+            ops = []
+            for i, v in enumerate(rec['version_history']):
+                v = dict(v, record_id=rec['_id'], n=i)
+                ops.append(ReplaceOne({'record_id': rec['_id'], 'n': i}, v,
+                                      upsert=True))
+                if len(ops) >= batch_size:
+                    self.magresVersions.bulk_write(ops)
+                    ops = []
+            if len(ops) > 0:
+                self.magresVersions.bulk_write(ops)
+            # Versions added since the upgrade are already stored after
+            # the embedded ones, and counted
+            self.magresIndex.update_one(
+                {'_id': rec['_id']},
+                {'$unset': {'version_history': ''},
+                 '$max': {'version_count': len(rec['version_history'])}})
+            n += 1
+
+        return n
+
     def generate_id(self):
         # Generate a new unique ID
-        res = self.magresIDcount.find_one_and_update(
-            filter={},
-            return_document=ReturnDocument.AFTER,
-            update={'$inc': {'count': 1}},
-            upsert=True)
-        mdbid = res['count']
-        # Format as string
-        mdbid = '{0:07d}'.format(mdbid)
-
-        return mdbid
+        return self.generate_ids(1)[0]
+
+    def generate_ids(self, n):
+        # Generate n new unique IDs, from as few counter increments as
+        # possible
+        return ['{0:07d}'.format(mdbid) for mdbid in self._ids.allocate(n)]
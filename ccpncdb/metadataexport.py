@@ -30,44 +30,48 @@ class MetadataExport:
         return json_result
                                                                                                                                                                                                                                                                                                                                            
     @staticmethod
-    def metadata_cleanup(json_result, version_num, file_id = None):
+    def metadata_cleanup(json_result, version_num, file_id = None, version_data = None):
         """
         Cleans up and reorders metadata for a given JSON dataset.
 
         This function processes a JSON dictionary containing metadata, performing the following operations:
-        - Finds and stores the matching metadata in 'version_metadata' for the user specified record version 
-          using magresfilesID as reference.
+        - Stores the metadata of the user specified record version in 'version_metadata'. Versions are kept 
+          apart from the records in the database, so the version is normally passed in; records that still 
+          carry a 'version_history' have it taken from there.
         - Cleans up the date and calculation metadata.
         - Reorders the keys in the resulting dictionary according to a predefined order.
 
         Parameters:
         json_result (dict): The input JSON dictionary containing metadata.
-        file_id (str, optional): The file ID to match within the 'version_history'. Defaults to None.
+        version_num (int): The index of the version to export.
+        file_id (str, optional): The file ID of the version. Defaults to None.
+        version_data (dict, optional): The version to export. Defaults to None, to take it from 
+        json_result['version_history'].
         is_archive (bool, optional): Flag indicating if the metadata is part of an archive. Defaults to False.
 
         Returns:
         json_result_ordered (dict): A new dictionary with cleaned and reordered metadata.
         """
+        if version_data is None:
+            version_data = json_result['version_history'][int(version_num)]
+
         json_result_new = {}
         for key in json_result:
-            if key == 'version_history':
-                
-                json_result_new['version'] = f"{int(version_num)+1}"
-                json_result_new['latest_version'] = json_result['version_count']
-
-                json_buffer = json_result[key][int(version_num)]
-                del json_buffer['magresFilesID']
-                for item in json_buffer:
-                    if item == 'date':
-                        json_buffer[item] = MetadataExport.format_date(json_buffer[item])
-                    elif item == 'magres_calc':
-                        json_buffer[item] = MetadataExport.calc_metadata_extract(json_buffer[item])
-                    else:
-                        json_buffer[item] = json_buffer[item]
-
-                json_result_new['version_metadata'] = json_buffer
-            else:
+            if key != 'version_history':
                 json_result_new[key] = json_result[key]
+
+        json_result_new['version'] = f"{int(version_num)+1}"
+        json_result_new['latest_version'] = json_result['version_count']
+
+        json_buffer = dict(version_data)
+        json_buffer.pop('magresFilesID', None)
+        for item in json_buffer:
+            if item == 'date':
+                json_buffer[item] = MetadataExport.format_date(json_buffer[item])
+            elif item == 'magres_calc':
+                json_buffer[item] = MetadataExport.calc_metadata_extract(json_buffer[item])
+
+        json_result_new['version_metadata'] = json_buffer
         del json_result_new['version_count']
 
         json_result_ordered = MetadataExport.reorder_keys(json_result_new)
@@ -108,7 +112,8 @@ class MetadataExport:
         is raised.
 
         Parameters:
-        date_str (str): The input date string to be formatted.
+        date_str (str or datetime): The input date string to be formatted. Dates read straight from the 
+        database are datetime objects and are formatted directly.
 
         Returns:
         date str: The formatted date string in the standardised format "%Y-%m-%d %H:%M:%S".
@@ -122,6 +127,9 @@ class MetadataExport:
         - "%Y-%m-%d %H:%M:%S" (e.g., "2021-12-25 16:23:34")
         - "%a, %d %b %Y %H:%M:%S %Z" (e.g., "Thu, 19 Sep 2024 10:10:36 GMT")
         """
+        if isinstance(date_str, datetime.datetime):
+            return date_str.strftime("%Y-%m-%d %H:%M:%S")
+
         date_formats= [
             "%Y-%m-%d %H:%M:%S.%f",  # Existing format with microseconds
             "%Y-%m-%d %H:%M:%S",     # Existing format without microseconds
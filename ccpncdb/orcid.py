@@ -1,8 +1,12 @@
 import re
 import os
 import yaml
+import time
+import threading
 import requests
-from requests.exceptions import ConnectionError
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
 
 
 class NoOrcidTokens(Exception):
@@ -15,6 +19,152 @@ class OrcidError(Exception):
     pass
 
 
+class UserList(object):
+    """A list of ORCID iDs read from a YAML file, kept in memory as a set.
+
+    The file is read again only when its modification time changes, or
+    after reload() (or reload_all(), for all of them).
+    Counts membership hits and misses and the number of reloads."""
+
+    # One shared instance per path
+    _lists = {}
+    _lists_lock = threading.Lock()
+
+    def __init__(self, path):
+
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+        self._lock = threading.Lock()
+        self._ids = frozenset()
+        self._mtime = None
+        self._stale = True
+
+    @classmethod
+    def get(cls, path):
+        with cls._lists_lock:
+            if path not in cls._lists:
+                cls._lists[path] = cls(path)
+            return cls._lists[path]
+
+    @classmethod
+    def reload_all(cls):
+        with cls._lists_lock:
+            for ulist in cls._lists.values():
+                ulist.reload()
+
+    def reload(self):
+        # Force a new read at the next check
+        self._stale = True
+
+    def _refresh(self):
+        # Size too, in case the file is rewritten within the mtime
+        # resolution
+        st = os.stat(self.path)
+        mtime = (st.st_mtime_ns, st.st_size)
+
+        if not self._stale and mtime == self._mtime:
+            return
+
+        with self._lock:
+            with open(self.path) as f:
+                ids = yaml.safe_load(f)
+            self._ids = frozenset([] if ids is None else ids)
+            self._mtime = mtime
+            self._stale = False
+            self.reloads += 1
+
+    def __contains__(self, orcid):
+        self._refresh()
+        found = orcid in self._ids
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'reloads': self.reloads, 'size': len(self._ids)}
+
+
+class OrcidRecordCache(object):
+    """LRU cache of ORCID public records, keyed by ORCID iD.
+
+    Records are fresh for ttl seconds, after which they are fetched again.
+    If fetching fails, a record up to stale_ttl seconds old is served
+    instead. Keeps hit, miss, stale, error and eviction counters."""
+
+    def __init__(self, maxsize=1024, ttl=3600, stale_ttl=86400):
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+        self._lock = threading.Lock()
+        self._records = OrderedDict()
+        self._counts = {'hits': 0, 'misses': 0, 'stale': 0, 'errors': 0,
+                        'evictions': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def _lookup(self, orcid):
+        with self._lock:
+            entry = self._records.get(orcid)
+            if entry is not None:
+                self._records.move_to_end(orcid)
+            return entry
+
+    def _store(self, orcid, rdata):
+        with self._lock:
+            self._records[orcid] = (rdata, time.monotonic())
+            self._records.move_to_end(orcid)
+            while len(self._records) > self.maxsize:
+                self._records.popitem(last=False)
+                self._counts['evictions'] += 1
+
+    def get(self, orcid, fetch):
+        """Return the record for orcid, calling fetch() to retrieve it
+        if it's missing or expired"""
+
+        entry = self._lookup(orcid)
+        if entry is not None:
+            rdata, t = entry
+            if time.monotonic()-t < self.ttl:
+                self._count('hits')
+                return rdata
+
+        self._count('misses')
+        try:
+            rdata = fetch()
+        except (OrcidError, RequestException):
+            self._count('errors')
+            if entry is not None and time.monotonic()-entry[1] < \
+                    self.stale_ttl:
+                self._count('stale')
+                return entry[0]
+            raise
+
+        self._store(orcid, rdata)
+        return rdata
+
+    def invalidate(self, orcid=None):
+        # Drop one record, or all of them
+        with self._lock:
+            if orcid is None:
+                self._records.clear()
+            else:
+                self._records.pop(orcid, None)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts, size=len(self._records))
+
+
 class OrcidConnection(object):
     """ Provides an interface to connect with
     ORCID, given the relevant app data."""
@@ -27,7 +177,8 @@ class OrcidConnection(object):
 
     def __init__(self, details, session=None,
                  login_url='https://orcid.org/',
-                 api_url='https://pub.orcid.org/v2.0/'):
+                 api_url='https://pub.orcid.org/v2.0/',
+                 cache=None, timeout=10):
 
         if session is None:
             # Use the global one
@@ -37,22 +188,22 @@ class OrcidConnection(object):
         self._details = details
         self._login_url = login_url
         self._api_url = api_url
+        self._timeout = timeout
+
+        # Records of public info
+        self.cache = OrcidRecordCache() if cache is None else cache
+        # Pooled, keep-alive connections
+        self._http = requests.Session()
+        self._http.mount('https://', HTTPAdapter(pool_connections=4,
+                                                 pool_maxsize=16))
 
     def is_banned(self, orcid):
         # Check if the given ORCID is in the banlist
-        with open(self._banpath) as f:
-            banlist = yaml.safe_load(f)
-            banlist = [] if banlist is None else banlist
-
-        return (orcid in banlist)
+        return orcid in UserList.get(self._banpath)
 
     def is_admin(self, orcid):
         # Check if the given ORCID is in the admin list
-        with open(self._adminpath) as f:
-            adminlist = yaml.safe_load(f)
-            adminlist = [] if adminlist is None else adminlist
-
-        return (orcid in adminlist)
+        return orcid in UserList.get(self._adminpath)
 
     def request_public_tokens(self):
         # Get tokens from ORCID for a public API access
@@ -64,9 +215,10 @@ class OrcidConnection(object):
         })
 
         try:
-            r = requests.post(self._login_url + 'oauth/token',
-                              data=payload, headers=headers)
-        except ConnectionError:
+            r = self._http.post(self._login_url + 'oauth/token',
+                                data=payload, headers=headers,
+                                timeout=self._timeout)
+        except RequestException:
             raise NoOrcidTokens('Connection to oauth/token failed')
 
         return r.json()
@@ -81,9 +233,10 @@ class OrcidConnection(object):
         })
 
         try:
-            r = requests.post(self._login_url + 'oauth/token',
-                              data=payload, headers=headers)
-        except ConnectionError:
+            r = self._http.post(self._login_url + 'oauth/token',
+                                data=payload, headers=headers,
+                                timeout=self._timeout)
+        except RequestException:
             raise NoOrcidTokens('Connection to oauth/token failed')
 
         # Save them (if no error has occurred, and if the user is authorised)
@@ -152,19 +305,25 @@ class OrcidConnection(object):
         return rdata
 
     def request_public_info(self, orcid, token):
-        # Request public info on a user, using the given access token
+        # Request public info on a user, using the given access token;
+        # cached
+
+        return self.cache.get(orcid,
+                              lambda: self._fetch_public_info(orcid, token))
+
+    def _fetch_public_info(self, orcid, token):
 
         headers = {
             'Accept': 'application/json',
             'Authorization type': 'Bearer',
             'Access token': token,
         }
-        r = requests.get(self._api_url + orcid + '/record',
-                         headers=headers)
+        r = self._http.get(self._api_url + orcid + '/record',
+                           headers=headers, timeout=self._timeout)
 
         try:
             rdata = r.json()
-        except AttributeError:
+        except (AttributeError, ValueError):
             raise OrcidError('Error: could not retrieve ORCID info')
         if 'error-code' in rdata:
             raise OrcidError(rdata['developer-message'])
@@ -174,10 +333,34 @@ class OrcidConnection(object):
 
 class FakeOrcidConnection(OrcidConnection):
 
-    """ Provides a fake interface imitating ORCID, for debugging purposes."""
+    """ Provides a fake interface imitating ORCID, for debugging purposes.
+
+    Public records come from the records dictionary (by default, one for
+    the fake user) through the same cache as the real connection; set
+    offline to True to make fetching them fail as if ORCID was down.
+    fetches counts how many times they were actually fetched."""
 
-    def __init__(self):
+    def __init__(self, records=None, cache=None):
         self._session = {}
+        self.cache = OrcidRecordCache() if cache is None else cache
+        self.records = records
+        if self.records is None:
+            self.records = {'0000-0000-0000-0000': {
+                'orcid-identifier': {
+                    'path': '0000-0000-0000-0000',
+                    'host': 'none',
+                    'uri': '0000-0000-0000-0000'
+                },
+                'person': {
+                    'name': {
+                        'credit-name': {
+                            'value': 'John Doe'
+                        }
+                    }
+                }
+            }}
+        self.offline = False
+        self.fetches = 0
 
     def request_tokens(self, code):
 
@@ -196,23 +379,12 @@ class FakeOrcidConnection(OrcidConnection):
 
         return fake_details
 
-    def request_info(self, client_details, auth_admin=False):
+    def _fetch_public_info(self, orcid, token):
 
-        auth = self.authenticate(client_details, auth_admin=auth_admin)
+        self.fetches += 1
+        if self.offline:
+            raise requests.ConnectionError('Fake ORCID is offline')
+        if orcid not in self.records:
+            raise OrcidError('Fake ORCID record not found')
 
-        if not auth:
-            raise OrcidError('Could not authenticate')
-
-        return {'orcid-identifier': {
-                'path': '0000-0000-0000-0000',
-                'host': 'none',
-                'uri': '0000-0000-0000-0000'
-                },
-                'person': {
-                    'name': {
-                        'credit-name': {
-                            'value': 'John Doe'
-                        }
-                    }
-        }
-        }
+        return self.records[orcid]
@@ -0,0 +1,147 @@
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemoryBackend(object):
+    """In-process LRU store, holding at most max_bytes (as estimated by
+    the caller) of values"""
+
+    def __init__(self, max_bytes=32*2**20):
+
+        self.max_bytes = max_bytes
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._values = OrderedDict()
+        self._size = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            self._values.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._values:
+                self._size -= self._values.pop(key)[1]
+            self._values[key] = (value, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, s) = self._values.popitem(last=False)
+                self._size -= s
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._values), 'bytes': self._size,
+                    'evictions': self.evictions}
+
+
+class RedisBackend(object):
+    """Store shared between processes, on a Redis server. client is a
+    redis.Redis instance (or anything with the same get/set methods);
+    entries expire after ttl seconds, and Redis' own memory policy takes
+    care of eviction"""
+
+    def __init__(self, client, prefix='ccpnc:search:', ttl=3600):
+
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        if redis is None:
+            raise RuntimeError('A shared search cache requires the redis '
+                               'package')
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, size):
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def clear(self):
+        # Entries of old generations just expire
+        pass
+
+    def stats(self):
+        return {}
+
+
+class ResultCache(object):
+    """Cache of the IDs of the records matched by a search, keyed by the
+    normalised query and a generation number, which the database bumps at
+    every write: entries of older generations are never looked up again
+    and eventually evicted. Searches matching more than max_ids records
+    aren't worth holding: for those only a marker is stored, so that they
+    go straight to the database. Keeps hit and miss counters."""
+
+    def __init__(self, backend=None, max_ids=10000):
+
+        self.backend = MemoryBackend() if backend is None else backend
+        self.max_ids = max_ids
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(key, generation):
+        return '{0}:{1}'.format(generation,
+                                hashlib.sha1(repr(key).encode()).hexdigest())
+
+    @staticmethod
+    def _size(ids):
+        # Rough estimate of the memory taken by a list of ID strings
+        return 64 + 80*len(ids)
+
+    def get(self, key, generation):
+        # List of IDs (as strings), False if there were too many to cache,
+        # or None
+        ids = self.backend.get(self._key(key, generation))
+        with self._lock:
+            if ids is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return ids
+
+    def set(self, key, generation, ids):
+        if len(ids) > self.max_ids:
+            self.backend.set(self._key(key, generation), False, 64)
+            return
+        ids = [str(i) for i in ids]
+        self.backend.set(self._key(key, generation), ids, self._size(ids))
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            stats = {'hits': self.hits, 'misses': self.misses,
+                     'hit_rate': self.hits/total if total > 0 else 0.0}
+        stats.update(self.backend.stats())
+        return stats
@@ -1,7 +1,8 @@
 import re
+from types import MappingProxyType
 from datetime import datetime
 from collections import namedtuple, OrderedDict
-from schema import Schema, And, Optional, Or
+from schema import Schema, And, Optional, Or, Hook, Literal
 from schema import (SchemaError, SchemaMissingKeyError)
 
 
@@ -87,6 +88,8 @@ magresRecordSchemaAutomatic = Schema({
     'immutable_id': str,
     'last_modified': datetime,
     'chemname_tokens': [str],
+    'chemname_trigrams': [str],
+    'version_trigrams': [str],
     'elements': [str],
     'nelements': int,
     'elements_ratios': [float],
@@ -99,6 +102,10 @@ magresRecordSchemaAutomatic = Schema({
         Optional('msiso'): [float],
         Optional('efgvzz'): [float]
     }],
+    'msiso': [{'species': str,
+               'value': float}],
+    'efgvzz': [{'species': str,
+                'value': float}],
     'formula': [{'species': str,
                  'n': int}],
     'stochiometry': [{'species': str,
@@ -107,13 +114,56 @@ magresRecordSchemaAutomatic = Schema({
     'molecules': [[{'species': str,
                     'n': int}]],
     'version_count': int,
-    'version_history': [magresVersionSchema],
     'last_version': Or(magresVersionSchema, None)
 })
 
 magresRecordSchema = _merge_schemas(magresRecordSchemaUser,
                                     magresRecordSchemaAutomatic)
 
+SchemaInfo = namedtuple('SchemaInfo',
+                        ['keys', 'keyset', 'required', 'optional',
+                         'defaults'])
+
+
+def _schema_info(schema):
+    # Key metadata of a dictionary schema: sorted keys, the same as a set,
+    # required and optional ones, and defaults of the optional ones
+    required = set()
+    optional = set()
+    defaults = {}
+    for k in schema.schema:
+        if isinstance(k, Optional):
+            optional.add(k.schema)
+            if hasattr(k, 'default'):
+                defaults[k.schema] = k.default
+        else:
+            required.add(getattr(k, 'schema', k))
+    keys = required | optional
+
+    return SchemaInfo(tuple(sorted(keys)), frozenset(keys),
+                      frozenset(required), frozenset(optional),
+                      MappingProxyType(defaults))
+
+
+# Built once, for all the schemas above
+_schema_registry = MappingProxyType({
+    id(s): (s, _schema_info(s))
+    for s in (orcidSchema, tensorSchema, magresVersionSchemaUser,
+              magresVersionSchemaAutomatic, magresVersionSchema,
+              magresRecordSchemaUser, magresRecordSchemaAutomatic,
+              magresRecordSchema)
+})
+
+
+def schema_info(schema):
+    """Return the SchemaInfo of a dictionary schema; precomputed for the
+    schemas defined here, worked out on the spot for any other"""
+    entry = _schema_registry.get(id(schema))
+    if entry is not None and entry[0] is schema:
+        return entry[1]
+    return _schema_info(schema)
+
+
 # Keys to actually list in the standard CSV file for archives
 csvProperties = ['chemname', 'license', 'doi', 'chemform',
                  'extref_type', 'extref_other', 'extref_code', 
@@ -123,11 +173,171 @@ ValidationResult = namedtuple('ValidationResult',
                               ['result', 'missing', 'invalid'])
 
 
+def _sample_indices(n, sample):
+    # Evenly spaced indices into a list of length n, first and last included
+    if sample is None or n <= sample:
+        return range(n)
+    if sample < 2:
+        return range(min(n, sample))
+    return sorted({round(i*(n-1)/(sample-1)) for i in range(sample)})
+
+
+def _compile(s, sample=None):
+    # Turn a schema definition into a function returning whether data
+    # matches it, following the same rules as Schema.validate. If sample is
+    # given, only that many elements of each list are checked
+
+    if isinstance(s, Literal):
+        s = s.schema
+    if type(s) is Schema:
+        if s.ignore_extra_keys:
+            return Schema(s).is_valid
+        return _compile(s.schema, sample)
+    if type(s) is Or:
+        checks = [_compile(x, sample) for x in s.args]
+        return lambda d: any(c(d) for c in checks)
+    if type(s) is And:
+        checks = [_compile(x, sample) for x in s.args]
+        return lambda d: all(c(d) for c in checks)
+
+    if type(s) in (list, tuple, set, frozenset):
+        stype = type(s)
+        elem = _compile(Or(*s), sample)
+        if sample is None or stype is not list:
+            return lambda d: isinstance(d, stype) and all(elem(x) for x in d)
+        return lambda d: (isinstance(d, list) and
+                          all(elem(d[i])
+                              for i in _sample_indices(len(d), sample)))
+
+    if isinstance(s, dict):
+        return _CompiledDict(s, sample).check
+
+    if isinstance(s, type):
+        if s is int:
+            return lambda d: isinstance(d, int) and not isinstance(d, bool)
+        return lambda d: isinstance(d, s)
+
+    if hasattr(s, 'validate'):
+        return Schema(s).is_valid
+
+    if callable(s):
+        def check(d):
+            try:
+                return bool(s(d))
+            except Exception:
+                return False
+        return check
+
+    return lambda d: s == d
+
+
+class _CompiledDict(object):
+    # Compiled dictionary schema. Only plain keys (possibly Optional) are
+    # supported; anything fancier is left to the schema library
+
+    def __init__(self, s, sample=None, trusted=None):
+
+        self.values = {}
+        self.required = set()
+        self.fallback = None
+
+        for skey, svalue in s.items():
+            key = skey.schema if isinstance(skey, Optional) else skey
+            if isinstance(skey, Hook) or not isinstance(key, str):
+                self.fallback = Schema(s).is_valid
+                return
+            if not isinstance(skey, Optional):
+                self.required.add(key)
+            # trusted None means all keys
+            self.values[key] = _compile(svalue, sample if trusted is None
+                                        or key in trusted else None)
+
+    def check(self, data):
+        if self.fallback is not None:
+            return self.fallback(data)
+        return self.validate(data).result
+
+    def validate(self, data):
+
+        if not isinstance(data, dict):
+            return ValidationResult(False, [], None)
+
+        covered = set()
+        wrong = []
+        # Dictionaries last, as Schema.validate does, so that the same key
+        # is reported when more than one is invalid
+        for key, value in sorted(data.items(),
+                                 key=lambda kv: isinstance(kv[1], dict)):
+            check = self.values.get(key) if isinstance(key, str) else None
+            if check is None:
+                wrong.append(key)
+            elif not check(value):
+                return ValidationResult(False, [], key)
+            else:
+                covered.add(key)
+
+        if not self.required.issubset(covered):
+            return ValidationResult(False,
+                                    sorted(self.required - covered, key=repr),
+                                    None)
+        if len(wrong) > 0:
+            return ValidationResult(False, [], sorted(wrong, key=repr)[0])
+
+        return ValidationResult(True, [], None)
+
+
+class CompiledSchema(object):
+    """Fast validator for a dictionary Schema, giving the same results as
+    validate_with. The schema definition is turned into plain functions
+    once, instead of being walked by the schema library at every call.
+
+    Lists under the trusted keys (data our own code generates) are only
+    spot checked: sample evenly spaced elements of each, at any depth,
+    or none if sample is 0. Everything else is checked in full."""
+
+    def __init__(self, schema, trusted=(), sample=None):
+
+        s = schema.schema if isinstance(schema, Schema) else schema
+        self._dict = _CompiledDict(s, sample, set(trusted))
+        if self._dict.fallback is not None:
+            raise ValueError('Only schemas with plain string keys can be '
+                             'compiled')
+
+    def validate(self, data):
+        return self._dict.validate(data)
+
+
+_compiled_schemas = {}
+
+
+def _compiled(schema):
+    # Strict compiled version of schema, made on first use
+    entry = _compiled_schemas.get(id(schema))
+    if entry is None or entry[0] is not schema:
+        try:
+            compiled = CompiledSchema(schema)
+        except ValueError:
+            compiled = None
+        entry = (schema, compiled)
+        _compiled_schemas[id(schema)] = entry
+    return entry[1]
+
+
 def validate_with(data, schema):
 
     # Validate the data with the given schema, but return extracted info
     # on what has gone wrong (if anything)
 
+    compiled = _compiled(schema)
+    if compiled is not None and isinstance(data, dict):
+        return compiled.validate(data)
+
+    return _validate_with_schema(data, schema)
+
+
+def _validate_with_schema(data, schema):
+    # Same, through the schema library
+
     result = True
     missing = []
     invalid = None
@@ -146,3 +356,12 @@ def validate_with(data, schema):
                              ).findall(str(e))[0]
 
     return ValidationResult(result, missing, invalid)
+
+
+# Records as they are built at upload: the automatic arrays are only spot
+# checked, as they come from our own extraction code
+magresRecordValidator = CompiledSchema(
+    magresRecordSchema,
+    trusted=[k for k in magresRecordSchemaAutomatic.schema
+             if isinstance(k, str)],
+    sample=8)
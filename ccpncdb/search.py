@@ -1,85 +1,43 @@
 import re
+import copy
 import inspect
-from ccpncdb.utils import extract_stochiometry, tokenize_name
+import threading
+from collections import OrderedDict
+from ccpncdb.utils import tokenize_name, regex_trigrams
+from ccpncdb.formula import Formula
 
+_quotere = re.compile('"([^\"]+)"')
 
-def _formula_read(f):
-    cfre = re.compile('([A-Z][a-z]*)([0-9]*)')
 
-    if (cfre.match(f) is None):
-        raise ValueError('Invalid formula string')
-
-    match = []
-    for el in cfre.findall(f):
-        n = int(el[1]) if el[1] != '' else 1
-        match.append({
-            'species': el[0],
-            'n': n
-        })
-
-    return match
-
-# Expressions for NMR quantities in aggregation queries
-
-
-def _expr_vzz(name):
-    return '$${0}.e_z'.format(name)
-
-
-def _expr_iso(name):
-    return {'$avg': ['$${0}.e_x'.format(name),
-                     '$${0}.e_y'.format(name),
-                     '$${0}.e_z'.format(name)]}
-
-
-def _expr_nmrrange(sp, var, expr, minv, maxv):
+def _nmrrange(sp, var, minv, maxv):
 
     minv = float(minv)
     maxv = float(maxv)
 
-    single_query = {'$and': [
-        {'$eq': ['$$nmrd.species', sp]},
-        {'$anyElementTrue': {
-            '$map': {
-                'input': '$$nmrd.{0}'.format(var),
-                'as': '{0}'.format(var),
-                'in': {
-                    '$and': [
-                            {'$gte': [expr(var), minv]},
-                            {'$lte': [expr(var), maxv]}
-                    ]
-                }
-            }
-        }
-        }
-    ]}
-
-    # Build the overall query by checking ifthe nmrdata exists combined with the 
-    # single_query for the ranged search
-    all_query = [{'$and':[
-        {'nmrdata.{0}'.format(var): {'$exists': True}},
-        {'$expr': {'$anyElementTrue': {
-            '$map': {
-                'input': '$nmrdata',
-                'as': 'nmrd',
-                'in': single_query
-            }
-        }
-        }
-        },]}
-    ]
+    # Scalars are precomputed at upload in flattened {species, value}
+    # lists, so a plain $elemMatch can be served by an index
+    return [{var: {'$elemMatch': {'species': sp,
+                                  'value': {'$gte': minv, '$lte': maxv}}}}]
 
-    return all_query
+
+def _prefilter(field, regex, prefix=''):
+    # Clause on a trigram array that narrows down, through its index, the
+    # records a case insensitive regex can match; it still has to be
+    # checked on them. Empty if nothing can be told from the regex
+    tg = regex_trigrams(regex, prefix)
+    if len(tg) == 0:
+        return {}
+    return {field: {'$all': tg}}
 
 
 def search_by_msRange(sp, minms, maxms):
 
-    return _expr_nmrrange(sp, 'ms', _expr_iso, minms, maxms)
+    return _nmrrange(sp, 'msiso', minms, maxms)
 
 
 def search_by_efgRange(sp, minefg, maxefg):
 
-    return _expr_nmrrange(sp, 'efg', _expr_vzz, minefg, maxefg)
+    return _nmrrange(sp, 'efgvzz', minefg, maxefg)
 
 
 def search_by_doi(doi):
@@ -98,11 +56,9 @@ def search_by_doi(doi):
     else:
         doi = doi.replace(".","\\.")
         doi = '^'+doi+'$'
-    return [
-        {'last_version.doi':
-            {'$regex': doi, '$options': 'i'}
-            }
-        ]
+    q = _prefilter('version_trigrams', doi, 'doi:')
+    q['last_version.doi'] = {'$regex': doi, '$options': 'i'}
+    return [q]
 
     #Legacy code backup
     # doi = re.escape(doi)
@@ -124,8 +80,7 @@ def search_by_chemname(pattern):
         return []
 
     # Start by splitting the pattern in bits in quotes and bits outside them
-    quotere = re.compile('"([^\"]+)"')
-    substrings = quotere.findall(pattern)
+    substrings = _quotere.findall(pattern)
 
     query = {
         '$or': [
@@ -140,7 +95,8 @@ def search_by_chemname(pattern):
         # "*", ".*").replace("?", "."), re.IGNORECASE)
         regex = re.compile(sb.replace("*", ".*"), re.IGNORECASE)
         # sbquery = {'chemname': {'$regex': regex, '$options': 'i'}}
-        sbquery = {'chemname': {'$regex': regex}} #regex already includes re.IGNORECASE, setting $options to 'i' is redundant and causes an error
+        sbquery = _prefilter('chemname_trigrams', regex)
+        sbquery['chemname'] = {'$regex': regex} #regex already includes re.IGNORECASE, setting $options to 'i' is redundant and causes an error
         query['$or'][0]['$and'].append(sbquery)
         pattern = pattern.replace('"{0}"'.format(sb), '')
 
@@ -163,15 +119,14 @@ def search_by_chemform(pattern):
         "*", ".*").replace("?", ".")
     # escape ., convert * to any character, convert ? to a single character
 
-    return [
-        {'last_version.chemform': {'$regex': regex, '$options': 'i'}}
-    ]
+    q = _prefilter('version_trigrams', regex, 'chemform:')
+    q['last_version.chemform'] = {'$regex': regex, '$options': 'i'}
+    return [q]
 
 
 def search_by_formula(formula, subset=False):
 
-    formula = _formula_read(formula)
-    stochio = extract_stochiometry(formula)
+    stochio = Formula.from_string(formula).reduced().to_list()
 
     # Check for stochiometry
     if not subset:
@@ -193,7 +148,7 @@ def search_by_formula(formula, subset=False):
 
 def search_by_molecule(formula):
 
-    formula = _formula_read(formula)
+    formula = Formula.from_string(formula).to_list()
 
     return [{'molecules': {
         '$in': [formula]
@@ -257,6 +212,8 @@ def search_by_extref(reftype, refcode, other_reftype=None): #other_reftype is on
             #replaced original code to treat search string as an exact match
             regex_pattern = '^' + refcode + '$'
             q['last_version.extref_code'] = {'$regex': regex_pattern, '$options': 'i'}
+        q.update(_prefilter('version_trigrams', regex_pattern,
+                            'extref_code:'))
         #legacy code    
         # q['last_version.extref_code'] = {'$regex': refcode, '$options': 'i'}
 
@@ -278,9 +235,112 @@ def search_by_mdbref(mdbref):
 # Function dictionary
 search_functions = {name[10:]: obj for name, obj in locals().items()
                     if name[:10] == 'search_by_'}
+# And their arguments
+search_arguments = {name: inspect.getfullargspec(func).args
+                    for name, func in search_functions.items()}
+
+
+class QueryCache(object):
+    """LRU cache of built search filters, keyed by the normalised search
+    specification: only the type, negation and arguments each search
+    function uses count. Keeps hit and miss counters."""
+
+    def __init__(self, maxsize=256):
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._filters = OrderedDict()
+
+    @staticmethod
+    def _freeze(value):
+        if isinstance(value, dict):
+            return tuple(sorted((k, QueryCache._freeze(v))
+                                for k, v in value.items()))
+        elif isinstance(value, (list, tuple)):
+            return tuple(QueryCache._freeze(v) for v in value)
+        return value
+
+    @staticmethod
+    def _canonical(stype, arg, value):
+        # Formulas written differently but giving the same query share a
+        # key
+        if arg == 'formula' and stype in ('formula', 'molecule'):
+            try:
+                f = Formula.from_string(value)
+            except (ValueError, TypeError):
+                return value
+            return str(f.reduced() if stype == 'formula' else f)
+        return value
+
+    @staticmethod
+    def key(search_spec):
+        # Normalised, hashable form of a search specification, or None if
+        # it can't be made into one (it's then left to build_search to
+        # complain about it)
+        try:
+            key = []
+            for src in search_spec:
+                args = search_arguments[src.get('type')]
+                key.append((src['type'], bool(src.get('negate_query')),
+                            tuple((a, QueryCache._freeze(
+                                QueryCache._canonical(src['type'], a,
+                                                      src['args'][a])))
+                                  for a in args)))
+            key = tuple(key)
+            hash(key)
+        except (KeyError, TypeError, AttributeError):
+            return None
+
+        return key
+
+    def get(self, search_spec, build):
+
+        key = self.key(search_spec)
+        if key is None:
+            return build(search_spec)
+
+        with self._lock:
+            search_dict = self._filters.get(key)
+            if search_dict is not None:
+                self._filters.move_to_end(key)
+                self.hits += 1
+        if search_dict is None:
+            search_dict = build(search_spec)
+            with self._lock:
+                self.misses += 1
+                self._filters[key] = search_dict
+                while len(self._filters) > self.maxsize:
+                    self._filters.popitem(last=False)
+
+        # Callers may change it
+        return copy.deepcopy(search_dict)
+
+    def clear(self):
+        with self._lock:
+            self._filters.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._filters),
+                    'hit_rate': self.hits/total if total > 0 else 0.0}
+
+
+query_cache = QueryCache()
 
 
 def build_search(search_spec):
+    # Cached
+    return query_cache.get(search_spec, _build_search)
+
+
+def _build_search(search_spec):
 
     search_dict = {
         '$and': [{'visible': True}]
@@ -294,7 +354,7 @@ def build_search(search_spec):
             raise ValueError('Invalid search type')
 
         # Find arguments
-        args = inspect.getfullargspec(search_func).args
+        args = search_arguments[src.get('type')]
         
         #Extract boolean choice to determine how to manipulate the query returned by search functions
         negate_query = src.get('negate_query')
@@ -2,17 +2,23 @@ import io
 import os
 import csv
 import json
+import zlib
 from datetime import timedelta
 from flask import Flask, Response, session, request, make_response, jsonify
-import requests
 from flask_mail import Mail, Message
 import zipfile
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 from ccpncdb.config import Config
 from ccpncdb.magresdb import MagresDB, MagresDBError
 from ccpncdb.log import Logger
 from ccpncdb.orcid import OrcidConnection, NoOrcidTokens, OrcidError
+from ccpncdb.crossref import CrossrefCache, CrossrefError, CrossrefPending
+from ccpncdb.resultcache import ResultCache, MemoryBackend, RedisBackend
 from ccpncdb.utils import split_data, get_name_from_orcid, get_schema_keys
 from ccpncdb.schemas import (magresRecordSchemaUser,
                              magresVersionSchemaUser, csvProperties)
@@ -20,6 +26,46 @@ from ccpncdb.archive import MagresArchive, MagresArchiveError
 from ccpncdb.metadataexport import MetadataExport
 
 
+class ZipStreamBuffer(io.RawIOBase):
+    """Write-only, unseekable buffer for a ZipFile, drained of its contents
+    as they are produced to stream an archive out"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def gzip_chunks(chunks):
+    # Compress a stream of chunks on the fly, as a gzip stream
+    comp = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = comp.compress(chunk)
+        if len(data) > 0:
+            yield data
+    yield comp.flush()
+
+
+def brotli_chunks(chunks):
+    # Compress a stream of chunks on the fly, as a brotli stream
+    comp = brotli.Compressor()
+    for chunk in chunks:
+        data = comp.process(chunk)
+        if len(data) > 0:
+            yield data
+    yield comp.finish()
+
+
 def make_csv_response(for_uploading=False):
     response = Response()
     props = list(csvProperties)
@@ -37,10 +83,14 @@ class MainServer(object):
 
     # Response codes
     HTTP_200_OK = 200
+    HTTP_206_PARTIAL_CONTENT = 206
+    HTTP_304_NOT_MODIFIED = 304
     HTTP_400_BAD_REQUEST = 400
     HTTP_401_UNAUTHORIZED = 401
     HTTP_404_NOT_FOUND = 404
+    HTTP_416_RANGE_NOT_SATISFIABLE = 416
     HTTP_500_INTERNAL_SERVER_ERROR = 500
+    HTTP_503_SERVICE_UNAVAILABLE = 503
 
     # Log types
     LOG_ADDRECORD = 0
@@ -80,11 +130,40 @@ class MainServer(object):
         self._dbname = self._config.db_name
 
         if db is None:
-            self._db = MagresDB(client=self._client, dbname=self._dbname)
+            search_cache = None
+            if self._config.search_cache_redis:
+                search_cache = ResultCache(RedisBackend.from_url(self._config.search_cache_redis),
+                                           max_ids=self._config.search_cache_max_ids)
+            elif self._config.search_cache_size > 0:
+                search_cache = ResultCache(MemoryBackend(self._config.search_cache_size),
+                                           max_ids=self._config.search_cache_max_ids)
+            self._db = MagresDB(client=self._client, dbname=self._dbname,
+                                parse_workers=self._config.archive_workers,
+                                parse_queue=self._config.archive_queue,
+                                parse_timeout=self._config.archive_timeout,
+                                stream_archives=self._config.archive_stream,
+                                archive_max_size=self._config.archive_max_size,
+                                archive_max_file_size=(
+                                    self._config.archive_max_file_size),
+                                file_compression=(
+                                    self._config.file_compression),
+                                id_block_size=self._config.id_block_size,
+                                search_cache=search_cache,
+                                extract_cache_size=(
+                                    self._config.extract_cache_size))
         else:
             self._db = db
 
-        self._logger = Logger(client=self._client, dbname=self._dbname)
+        self._logger = Logger(client=self._client, dbname=self._dbname,
+                              batch_size=self._config.log_batch_size,
+                              flush_interval=self._config.log_flush_interval,
+                              max_queue=self._config.log_queue_size,
+                              overflow=self._config.log_overflow,
+                              capped_size=self._config.log_capped_size,
+                              ttl=self._config.log_ttl)
+        self._crossref = CrossrefCache(client=self._client, dbname=self._dbname,
+                                       ttl=self._config.crossref_ttl,
+                                       timeout=self._config.crossref_timeout)
 
         # Load mail config
         with open(os.path.join(self._config_folder, 'smtpconfig.json')) as f:
@@ -192,7 +271,7 @@ class MainServer(object):
             for name, res in results.items():
 
                 if (res is None) or not res.successful:
-                    failed.append(f.name)
+                    failed.append(name)
                     successful.append(False)
                 else:
                     mdbrefs.append(res.mdbref)
@@ -268,20 +347,32 @@ class MainServer(object):
                     self.HTTP_500_INTERNAL_SERVER_ERROR)
     
     def get_author_info(self, doi):
+        """
+        Returns the authors of a DOI, from Crossref, as HTML. Lookups are cached in the database; a lookup 
+        that is still running, or that failed, gets a 503 so that the client tries again later.
+        """
+        if not isinstance(doi, str) or doi.strip() == '':
+            return jsonify('No DOI given'), self.HTTP_400_BAD_REQUEST
+
         try:
-            response = requests.get(f'https://api.crossref.org/works/{doi}')
-            response.raise_for_status()
-            data = response.json()
-            authors = data['message']['author']
-            orcid_authors = [
-                f'<a href="{author["ORCID"]}" target="_blank">{author["given"]} {author["family"]}</a>' if 'ORCID' in author else f"{author['given']} {author['family']}"
-                for author in authors
-                ]
-            authors_list = ',<br>'.join(orcid_authors)
-            return jsonify(authors_list), self.HTTP_200_OK
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching author information: {e}")
+            authors = self._crossref.get(doi)
+        except CrossrefPending:
+            return jsonify('Author information not available yet'), self.HTTP_503_SERVICE_UNAVAILABLE
+        except CrossrefError as e:
+            print(e)
+            return jsonify('Error fetching author information'), self.HTTP_503_SERVICE_UNAVAILABLE
+
+        if authors is None:
             return jsonify('Error fetching author information'), self.HTTP_404_NOT_FOUND
+
+        orcid_authors = []
+        for author in authors:
+            name = ' '.join(filter(None, [author.get('given'), author.get('family', author.get('name'))]))
+            if 'ORCID' in author:
+                name = f'<a href="{author["ORCID"]}" target="_blank">{name}</a>'
+            orcid_authors.append(name)
+        authors_list = ',<br>'.join(orcid_authors)
+        return jsonify(authors_list), self.HTTP_200_OK
     
     def unpack_file(self, file):
         """
@@ -300,7 +391,79 @@ class MainServer(object):
 
         return file_id, filename, db_record_json, version_num
 
-    def json_metadata_prepare(self, json_data, fs_id, version_num):
+    def resolve_selection(self, selection):
+        """
+        Resolves a selection of records from the database, for bulk downloads that only send the records' 
+        immutable IDs and versions instead of the whole records.
+
+        Args:
+            selection (list): A list of dictionaries with keys 'immutable_id' and 'version' (index in the 
+            version history).
+
+        Returns:
+            list: File dictionaries in the same form as unpack_file expects. Records that are not found or 
+            not visible, and versions that don't exist, are left out.
+
+        Raises:
+            ValueError: If the selection is malformed.
+        """
+        if not isinstance(selection, list):
+            raise ValueError('Invalid selection')
+        pairs = []
+        for sel in selection:
+            try:
+                mdbref = sel['immutable_id']
+                version_num = int(sel['version'])
+            except (TypeError, KeyError, ValueError):
+                raise ValueError('Invalid selection')
+            if not isinstance(mdbref, str) or version_num < 0:
+                raise ValueError('Invalid selection')
+            pairs.append((mdbref, version_num))
+
+        records = self._db.get_records_by_mdbref([mdbref for mdbref, _ in pairs], profile='export')
+
+        wanted = []
+        for mdbref, version_num in pairs:
+            rec = records.get(mdbref)
+            if rec is None or version_num >= rec['version_count']:
+                continue
+            wanted.append((rec, version_num))
+
+        # All versions in one query
+        versions = self._db.get_versions_bulk([(rec['_id'], n)
+                                               for rec, n in wanted])
+
+        files = []
+        for rec, version_num in wanted:
+            version = versions.get((rec['_id'], version_num))
+            if version is None:
+                continue
+            # The metadata export modifies the record in place, so copy it
+            files.append({'fileID': version['magresFilesID'],
+                          'filename': 'MRD' + rec['immutable_id'],
+                          'jsonData': dict(rec),
+                          'version': version_num,
+                          'versionData': version})
+
+        return files
+
+    def selection_files(self):
+        """
+        Reads the selection of files to download from the request. This is either a list of 'records' 
+        (immutable ID and version pairs) to be resolved on the server, or the legacy list of 'files' 
+        with the full record data posted by the client.
+
+        Returns:
+            list: File dictionaries, as unpack_file expects.
+
+        Raises:
+            ValueError: If the selection of records is malformed.
+        """
+        if 'records' in request.json:
+            return self.resolve_selection(request.json['records'])
+        return request.json['files']
+
+    def json_metadata_prepare(self, json_data, fs_id, version_num, version_data=None):
         """
         Prepare the JSON metadata for export to either an archive in bulk downloads or a standalone JSON file 
         download.
@@ -308,13 +471,22 @@ class MainServer(object):
         Args:
             json_data (dict): The JSON data to be prepared.
             fs_id (str): The ID of the corresponding Magres file.
-            is_archive (bool, optional): Indicates if the data is for an archive. Defaults to False.
+            version_num (int): The index of the version to export.
+            version_data (dict, optional): The version to export. If not given, it is taken from the record's 
+            'version_history' if the client sent one, or fetched from the database.
 
         Returns:
             json_final (dict): The prepared JSON metadata.
         """
+        if version_data is None:
+            history = json_data.get('version_history') or []
+            if int(version_num) < len(history) and history[int(version_num)]:
+                version_data = history[int(version_num)]
+            else:
+                version_data = self._db.get_version_by_mdbref(json_data['immutable_id'], version_num)
         json_cleaned = self.metadata_exporter.metadata_clearance(json_data) #Remove redundant metadata
-        json_final = self.metadata_exporter.metadata_cleanup(json_cleaned, version_num, fs_id) #Clean up - include relevant file version metadata
+        json_final = self.metadata_exporter.metadata_cleanup(json_cleaned, version_num, fs_id,
+                                                             version_data) #Clean up - include relevant file version metadata
 
         return json_final
     
@@ -333,14 +505,20 @@ class MainServer(object):
                 - An error message indicating the file retrieval error.
                 - HTTP status code 400 (Bad Request).
         """
-        file = request.json['files'][0] #Get the selected file from the request
-        fs_id, filename, json_data, version_num = self.unpack_file(file) #unpack file information
+        try:
+            files = self.selection_files() #Get the selected file from the request
+        except ValueError as e:
+            return str(e), self.HTTP_400_BAD_REQUEST
+        if len(files) == 0:
+            return 'Record not found', self.HTTP_400_BAD_REQUEST
+        fs_id, filename, json_data, version_num = self.unpack_file(files[0]) #unpack file information
 
         try:
             mfile = self._db.get_magres_file(fs_id) #Retrieve Magres file from database
             if isinstance(mfile, bytes): #Check if the file content is valid
                 # Preparing to write metadata to JSON file
-                json_final = self.json_metadata_prepare(json_data, fs_id, version_num)
+                json_final = self.json_metadata_prepare(json_data, fs_id, version_num,
+                                                        files[0].get('versionData'))
                 json_str = json.dumps(json_final, indent=1)
 
                 # Create a response object with the JSON data
@@ -361,19 +539,37 @@ class MainServer(object):
         CSV metadata file included.
         
         Returns:
-            A Response object containing the zip archive as the response content and the HTTP status code.
+            A Response object streaming the zip archive as the response content and the HTTP status code.
         
         Comments:
             - This function allows the user to download a selection of Magres files as a zip archive.
             - The files to be included in the archive are specified in the request JSON.
-            - The function creates a zip archive in memory and adds each selected file to the archive.
-            - It also prepares and includes metadata for each file in the archive.
-            - The function returns a Response object with the zip archive as the response content.
+            - The archive is written on the fly: each file is read from GridFS chunk by chunk and sent out 
+              as soon as it is compressed, so memory use does not grow with the selection size.
+            - Metadata for each file is collected on the way and appended at the end as JSON and CSV files.
             - The HTTP status code indicates the success or failure of the operation.
         """
         
-        files = request.json['files'] #Get the list of files from the request
-        archive = io.BytesIO() #Create an in-memory byte stream for the zip archive
+        try:
+            files = self.selection_files() #Get the list of files from the request
+        except ValueError as e:
+            return str(e), self.HTTP_400_BAD_REQUEST
+
+        return Response(self._generate_selection_zip(files),
+                        mimetype='application/zip',
+                        headers={'Content-Disposition': 'attachment;filename=selected_files.zip'}), self.HTTP_200_OK
+
+    def _generate_selection_zip(self, files):
+        """
+        Generator producing the bytes of the zip archive for download_selection_zip.
+
+        Args:
+            files (list): The list of file dictionaries sent with the request.
+
+        Yields:
+            bytes: Consecutive pieces of the zip archive.
+        """
+        buffer = ZipStreamBuffer() #Unseekable buffer, drained after every write
         json_metadata = {} #Create an empty dictionary to store the JSON metadata for each file
 
         # Create a CSV file in memory
@@ -382,30 +578,15 @@ class MainServer(object):
         writer = csv.DictWriter(csv_file, props, extrasaction='ignore') # Create a CSV writer object
         writer.writeheader() # Write the header to the CSV file
 
-        with zipfile.ZipFile(archive, 'w') as zipf:
+        with zipfile.ZipFile(buffer, 'w') as zipf:
             for file in files: # loop through the selected files
                 fs_id, filename, json_data, version_num = self.unpack_file(file) #Unpack file information
                 try:
-                    mfile = self._db.get_magres_file(fs_id) #Retrieve Magres file from database
-                    if isinstance(mfile, bytes): #Check if the file content is valid
-                        zipf.writestr(f"{filename}.magres", mfile)
-                    else: #Log error and continue to the next file
-                        self._logger.log('Error: Invalid file content', 
-                                         json_data['orcid']['path'], 
-                                         {'Magres_id': fs_id})
-                        continue
-
-                    # Preparing to write metadata to JSON file
-                    json_final = self.json_metadata_prepare(json_data, fs_id, version_num) #Prepare metadata for export
-                    json_metadata[f"{filename}.magres metadata"] = json_final  #Add metadata to the JSON metadata dictionary with filename as key
-
-                    #Preparing to write metadata to CSV file
-                    json_csv = json_final.copy() #Create a shallow copy of the JSON metadata
-                    json_csv['filename'] = filename #Add the filename to the JSON metadata
-                    csv_version = json_csv['version_metadata'] #Get the last version metadata
-                    row = dict(json_csv, **csv_version) #Combine the record and version metadata
-                    writer.writerow(row) #Write the metadata to the CSV file, as per the schema
-
+                    chunks = self._db.iter_magres_file(fs_id) #Find Magres file in database
+                    # Prepare metadata for export before writing anything, as looking up the
+                    # version may fail too (hidden or missing record or version)
+                    json_final = self.json_metadata_prepare(json_data, fs_id, version_num,
+                                                            file.get('versionData'))
                 except MagresDBError as e:
                     # Log error and continue to the next file
                     self._logger.log(f"Error retrieving file: {e}", 
@@ -413,29 +594,85 @@ class MainServer(object):
                                      {'Magres_id': fs_id})
                     continue
 
+                with zipf.open(f"{filename}.magres", 'w') as zf:
+                    for chunk in chunks: #Copy the file over one GridFS chunk at a time
+                        zf.write(chunk)
+                        yield buffer.drain()
+                yield buffer.drain()
+
+                # Preparing to write metadata to JSON file
+                json_metadata[f"{filename}.magres metadata"] = json_final  #Add metadata to the JSON metadata dictionary with filename as key
+
+                #Preparing to write metadata to CSV file
+                json_csv = json_final.copy() #Create a shallow copy of the JSON metadata
+                json_csv['filename'] = filename #Add the filename to the JSON metadata
+                csv_version = json_csv['version_metadata'] #Get the last version metadata
+                row = dict(json_csv, **csv_version) #Combine the record and version metadata
+                writer.writerow(row) #Write the metadata to the CSV file, as per the schema
+
             json_metadata_str = json.dumps(json_metadata, indent=1) #Convert the JSON metadata dictionary to a string
             zipf.writestr("Magres_metadata.json", json_metadata_str) #Write the JSON metadata to the archive
 
             # Move to the CSV file next
-            csv_file.seek(0) #Move the cursor to the beginning of the file
             zipf.writestr("Magres_metadata.csv", csv_file.getvalue()) #Write the CSV file to the archive
-        
-        archive.seek(0) #Move the cursor to the beginning of the archive
 
-        # Return the zip archive as a response object
-        return Response(archive.getvalue(),
-                        mimetype='application/zip',
-                        headers={'Content-Disposition': 'attachment;filename=selected_files.zip'}), self.HTTP_200_OK
+        # Closing the archive writes the central directory
+        yield buffer.drain()
 
     def search(self):
+        """
+        Search the database and stream the results as JSON.
+
+        The request JSON holds the 'search_spec' and optionally 'limit',
+        'skip', 'sort' and 'profile' (see MagresDB.search_record). The reply
+        is an envelope {"results": [...], "total": N, "has_more": bool};
+        results are written out as they come from the cursor.
+        """
 
         query = request.json['search_spec']
+        limit = request.json.get('limit')
+        skip = request.json.get('skip', 0)
+        sort = request.json.get('sort')
+        profile = request.json.get('profile', 'full')
+
         try:
-            results = list(self._db.search_record(query))
-        except MagresDBError as e:
-            results = []
+            limit = None if limit is None else int(limit)
+            skip = int(skip)
+        except (TypeError, ValueError):
+            return 'Invalid limit or skip', self.HTTP_400_BAD_REQUEST
+        if skip < 0 or (limit is not None and limit < 0):
+            return 'Invalid limit or skip', self.HTTP_400_BAD_REQUEST
+        if sort is not None and not (isinstance(sort, list) and
+                                     all(isinstance(s, list) and len(s) == 2
+                                         for s in sort)):
+            return 'Invalid sort', self.HTTP_400_BAD_REQUEST
 
-        return json.dumps(results, default=str), self.HTTP_200_OK
+        try:
+            results = self._db.search_record(query, limit=limit, skip=skip,
+                                             sort=sort, profile=profile)
+        except MagresDBError as e:
+            if str(e) != 'Empty query':
+                return str(e), self.HTTP_400_BAD_REQUEST
+            results = None
+
+        def generate():
+            yield '{"results": ['
+            n = 0
+            for rec in (results or []):
+                yield (',' if n > 0 else '') + json.dumps(rec, default=str)
+                n += 1
+            # Only count separately if the results might be truncated
+            if results is None:
+                total = 0
+            elif limit is None or (n < limit and (n > 0 or skip == 0)):
+                total = skip + n
+            else:
+                total = self._db.count_records(query)
+            yield '], "total": {0}, "has_more": {1}}}'.format(
+                total, json.dumps(skip + n < total))
+
+        return Response(generate(),
+                        mimetype='application/json'), self.HTTP_200_OK
 
     def get_record(self):
         mdbref = request.json['mdbref']
@@ -445,7 +682,10 @@ class MainServer(object):
         n = len(results)
 
         if n == 1:
-            return json.dumps(results[0], default=str), self.HTTP_200_OK
+            # The record page needs all the versions
+            record = results[0]
+            record['version_history'] = self._db.get_versions(record['_id'])
+            return json.dumps(record, default=str), self.HTTP_200_OK
         elif n == 0:
             return '{}', self.HTTP_400_BAD_REQUEST
         elif n > 1:
@@ -459,7 +699,7 @@ class MainServer(object):
         oid = request.args.get('oid')
         v = int(request.args.get('v'))
         record = self._db.get_record(oid)
-        version = record['version_history'][v]
+        version = self._db.get_version(oid, v)
         row = dict(record, **version)
 
         # Form a csv file
@@ -475,20 +715,83 @@ class MainServer(object):
         return resp, self.HTTP_200_OK
 
     def get_magres(self):
+        """
+        Sends a stored magres file, streamed (and decompressed) from GridFS.
+
+        Stored files never change (a new version is a new file), so the reply carries a strong ETag and 
+        can be cached forever. Conditional requests (If-None-Match) get a 304, a single byte Range gets 
+        a 206, and full replies are gzip or brotli compressed if the client accepts it.
+        """
         fs_id = request.args.get('magres_id')
 
         try:
-            mfile = self._db.get_magres_file(fs_id)
+            mfile_ref = self._db.open_magres_file(fs_id)
         except MagresDBError:
             return 'File not found', self.HTTP_400_BAD_REQUEST
         except:
             return 'Invalid ID', self.HTTP_400_BAD_REQUEST
 
-        resp = make_response(mfile)
-        resp.headers['Content-Type'] = 'text/plain'
-        resp.headers['Content-Disposition'] = 'attachment'
+        length = mfile_ref.length
+        etag = str(mfile_ref.etag)
+
+        # Byte range, if any (only a single one is supported, others are
+        # ignored and the whole file is sent)
+        byte_range = None
+        if request.range is not None and len(request.range.ranges) == 1:
+            if_range = request.if_range
+            if if_range.date is None and if_range.etag in (None, etag):
+                byte_range = request.range.range_for_length(length)
+                if byte_range is None:
+                    resp = make_response('')
+                    resp.headers['Content-Range'] = 'bytes */{0}'.format(length)
+                    return resp, self.HTTP_416_RANGE_NOT_SATISFIABLE
+
+        # Content encoding, only for whole files
+        encodings = ['gzip', 'identity']
+        if brotli is not None:
+            encodings = ['br'] + encodings
+        encoding = 'identity'
+        if byte_range is None:
+            encoding = request.accept_encodings.best_match(encodings, 'identity')
+        if encoding != 'identity':
+            etag += '-' + encoding
+
+        headers = {
+            'Content-Type': 'text/plain',
+            'Content-Disposition': 'attachment',
+            'Cache-Control': 'public, max-age=31536000, immutable',
+            'Accept-Ranges': 'bytes',
+            'Vary': 'Accept-Encoding',
+        }
+
+        if request.if_none_match.contains(etag):
+            resp = make_response('')
+            resp.headers.update(headers)
+            resp.set_etag(etag)
+            return resp, self.HTTP_304_NOT_MODIFIED
+
+        status = self.HTTP_200_OK
+        if byte_range is None:
+            chunks = mfile_ref.chunks()
+            if encoding == 'gzip':
+                chunks = gzip_chunks(chunks)
+            elif encoding == 'br':
+                chunks = brotli_chunks(chunks)
+        else:
+            start, stop = byte_range
+            chunks = mfile_ref.chunks(start, stop)
+            headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, stop-1, length)
+            status = self.HTTP_206_PARTIAL_CONTENT
+
+        resp = Response(chunks, headers=headers, direct_passthrough=True)
+        resp.set_etag(etag)
+        if encoding == 'identity':
+            resp.content_length = (length if byte_range is None
+                                   else byte_range[1]-byte_range[0])
+        else:
+            resp.headers['Content-Encoding'] = encoding
 
-        return resp, self.HTTP_200_OK
+        return resp, status
 
     def get_magres_archive(self):
 
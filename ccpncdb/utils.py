@@ -2,11 +2,14 @@ import re
 import numpy as np
 from io import StringIO
 from ase.io.magres import read_magres
-from soprano.properties.linkage import Molecules
-from soprano.properties.nmr.ms import MSIsotropy
-from soprano.properties.nmr.efg import EFGVzz
-from soprano.nmr import NMRTensor
+from ase.data import atomic_numbers
+from ase.neighborlist import neighbor_list
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from soprano.data import vdw_radii
 from soprano.nmr.utils import _haeb_sort
+from ccpncdb.schemas import schema_info
+from ccpncdb.formula import Formula
 
 
 def prime_factors(num):
@@ -16,7 +19,7 @@ def prime_factors(num):
     while num > 1:
         while num % n == 0:
             facs.append(n)
-            num = num/n
+            num //= n
         n += 1 + (n > 2)  # So past 2 test only odd numbers
 
     return sorted(facs)
@@ -40,20 +43,12 @@ def get_name_from_orcid(user_info):
 
 
 def get_schema_keys(schema):
-    # Extract a list of keys from a given schema
-    raw_keys = schema.schema.keys()
-    keys = []
-    for k in raw_keys:
-        if hasattr(k, 'schema'):
-            keys.append(k.schema)
-        else:
-            keys.append(k)
-
-    return sorted(keys)
+    # Extract a sorted list of keys from a given schema
+    return list(schema_info(schema).keys)
 
 
 def set_null_values(data, schema, pattern=''):
-    keys = get_schema_keys(schema)
+    keys = schema_info(schema).keys
 
     # Set as None all values that match pattern
     for k in keys:
@@ -66,8 +61,8 @@ def set_null_values(data, schema, pattern=''):
 def split_data(data, s1, s2):
     # Split data between two schemas
     sd1, sd2 = {}, {}
-    sk1 = get_schema_keys(s1)
-    sk2 = get_schema_keys(s2)
+    sk1 = schema_info(s1).keyset
+    sk2 = schema_info(s2).keyset
     for k, v in data.items():
         if k in sk1:
             sd1[k] = v
@@ -85,8 +80,70 @@ def tokenize_name(name):
     return tokens
 
 
-def read_magres_file(mfile):
-    # Read a magres file/string unifying the output into an ASE Atoms object
+def trigrams(text, prefix=''):
+    # Sorted, lowercased three character substrings of text, each with
+    # prefix prepended
+    text = text.lower()
+    return sorted({prefix + text[i:i+3] for i in range(len(text)-2)})
+
+
+# Version fields whose trigrams are kept on the record, prefixed by name
+VERSION_TRIGRAM_FIELDS = ('chemform', 'doi', 'extref_code')
+
+
+def version_trigrams(version_data):
+    # Trigrams of the searchable text fields of a version
+    tg = []
+    for field in VERSION_TRIGRAM_FIELDS:
+        value = version_data.get(field)
+        if value:
+            tg += trigrams(str(value), field + ':')
+    return tg
+
+
+def regex_literals(regex):
+    # Runs of literal characters that any string matched by regex must
+    # contain, or None if it's too complex to tell
+    runs = []
+    run = ''
+    i = 0
+    while i < len(regex):
+        c = regex[i]
+        lit = None
+        if c in '|[](){}':
+            return None
+        elif c == '\\':
+            if i+1 < len(regex) and not regex[i+1].isalnum():
+                lit = regex[i+1]
+            i += 1
+        elif c in '*+?':
+            # The previous character may be missing
+            run = run[:-1]
+        elif c not in '.^$':
+            lit = c
+        i += 1
+
+        if lit is None:
+            runs.append(run)
+            run = ''
+        else:
+            run += lit
+    runs.append(run)
+
+    return [r for r in runs if len(r) > 0]
+
+
+def regex_trigrams(regex, prefix=''):
+    # Trigrams that any string matched case-insensitively by regex must
+    # contain; an empty list if there are none to be sure of
+    runs = regex_literals(getattr(regex, 'pattern', regex))
+    if runs is None:
+        return []
+    return sorted({t for r in runs for t in trigrams(r, prefix)})
+
+
+def read_magres_string(mfile):
+    # Contents of a magres file/string/bytes, as a string
     if hasattr(mfile, 'read'):
         mstr = mfile.read()
     else:
@@ -94,6 +151,12 @@ def read_magres_file(mfile):
 
     if hasattr(mstr, 'decode'):
         mstr = mstr.decode('utf-8')
+    return mstr
+
+
+def read_magres_file(mfile):
+    # Read a magres file/string unifying the output into an ASE Atoms object
+    mstr = read_magres_string(mfile)
     matoms = read_magres(StringIO(mstr))
 
     return {'string': mstr, 'Atoms': matoms}
@@ -103,43 +166,52 @@ def extract_formula(magres=None, symbols=None):
     # Return a list describing the compound's formula
     if symbols is None:
         symbols = magres.get_chemical_symbols()
-    else:
-        symbols = list(symbols)
-    formula = [{'species': s, 'n': symbols.count(s)} for s in set(symbols)]
-    formula = sorted(formula, key=lambda x: x['species'])
 
-    return formula
+    return Formula.from_symbols(symbols).to_list()
 
 
 def extract_stochiometry(formula):
-    # Stochiometry from formula
-
-    counts = [prime_factors(x['n']) for x in formula]
-
-    c = 1
-    while all([len(x) > 0 for x in counts]):
-        ff = [x.pop(0) for x in counts]
-        if len(set(ff)) == 1:
-            c *= ff[0]
-        else:
-            break
-
-    stochio = []
-    for x in formula:
-        sx = {}
-        sx.update(x)
-        sx['n'] = int(sx['n']/c)
-        stochio.append(sx)
-
-    return stochio
-
+    # Stochiometry from formula: counts divided by their greatest common
+    # divisor
+    return Formula.from_list(formula).reduced().to_list()
+
+
+def bond_cutoffs(species, vdw_set='csd', vdw_scale=1.0, default_vdw=2.0,
+                 vdw_custom={}):
+    # Table {(el1, el2): cutoff} of bond lengths for every pair of species,
+    # as the mean of their Van der Waals radii (the same criterion as
+    # soprano's Bonds)
+    vdw_r = np.array(vdw_radii[vdw_set])*vdw_scale
+    vdw_r = np.where(np.isnan(vdw_r), default_vdw, vdw_r)
+    radii = {}
+    for s in set(species):
+        radii[s] = vdw_custom.get(s, vdw_r[atomic_numbers[s]])
+
+    return {(s1, s2): (r1+r2)/2.0 for s1, r1 in radii.items()
+            for s2, r2 in radii.items()}
+
+
+def extract_molecules(magres, cutoffs=None):
+    # Formulas of the bonded clusters of atoms, ordered by their first atom.
+    # Neighbours are found with a cell list, so this scales linearly with
+    # the number of atoms, periodic images included
+    syms = np.array(magres.get_chemical_symbols())
+    N = len(syms)
+    if N == 0:
+        return []
 
-def extract_molecules(magres):
+    if cutoffs is None:
+        cutoffs = bond_cutoffs(syms)
 
-    mols = Molecules.get(magres)
-    syms = np.array(magres.get_chemical_symbols())
+    i, j = neighbor_list('ij', magres, cutoffs)
+    graph = coo_matrix((np.ones(len(i), dtype=bool), (i, j)), shape=(N, N))
+    nmols, labels = connected_components(graph, directed=False)
 
-    mols_f = [extract_formula(symbols=syms[m.indices]) for m in mols]
+    # Labels are numbered in order of the first atom of each molecule
+    order = np.argsort(labels, kind='stable')
+    bounds = np.cumsum(np.bincount(labels, minlength=nmols))[:-1]
+    mols_f = [extract_formula(symbols=syms[m])
+              for m in np.split(order, bounds)]
 
     return mols_f
 
@@ -162,28 +234,67 @@ def extract_tensdata(tensor):
     return {'e_x': haeb_evals[0], 'e_y': haeb_evals[1], 'e_z': haeb_evals[2]}
 
 
+def extract_haeb_evals(tensors):
+    # Haeberlen-ordered eigenvalues for a whole (N, 3, 3) array of tensors,
+    # equivalent to calling extract_tensdata on each of them
+    tensors = np.asarray(tensors, dtype=float)
+    symm = (tensors + tensors.transpose(0, 2, 1))/2.0
+    # eigh rather than eigvalsh, as it matches NMRTensor to the last bit
+    evals = np.linalg.eigh(symm)[0]
+
+    return _haeb_sort(evals)
+
+
 def extract_nmrdata(magres):
 
-    # Chemical species
+    # Chemical species, grouped in one pass; a stable sort keeps the atoms
+    # of each species in their original order
     symbols = np.array(magres.get_chemical_symbols())
-    sp = {s: np.where(symbols == s) for s in set(symbols)}
+    species, sp_i = np.unique(symbols, return_inverse=True)
+    order = np.argsort(sp_i, kind='stable')
+    bounds = np.cumsum(np.bincount(sp_i, minlength=len(species)))[:-1]
+    sp = np.split(order, bounds)
 
-    species = sorted(sp.keys())
+    species = [str(s) for s in species]
     nmrdata = [{'species': s} for s in species]
 
     # Try adding individual nmr data
-    if magres.has('ms'):
-        ms = magres.get_array('ms')
-        ms = np.array([NMRTensor(T) for T in ms])
-        for i, s in enumerate(species):
-            inds = sp[s]
-            nmrdata[i]['ms'] = [extract_tensdata(T) for T in ms[inds]]
-
-    if magres.has('efg'):
-        efg = magres.get_array('efg')
-        efg = np.array([NMRTensor(T) for T in efg])
-        for i, s in enumerate(species):
-            inds = sp[s]
-            nmrdata[i]['efg'] = [extract_tensdata(T) for T in efg[inds]]
+    for tag, scalar, scalar_func in (('ms', 'msiso', tensdata_iso),
+                                     ('efg', 'efgvzz', tensdata_vzz)):
+        if not magres.has(tag):
+            continue
+        evals = extract_haeb_evals(magres.get_array(tag))
+        for i, inds in enumerate(sp):
+            tdata = [{'e_x': ev[0], 'e_y': ev[1], 'e_z': ev[2]}
+                     for ev in evals[inds]]
+            nmrdata[i][tag] = tdata
+            nmrdata[i][scalar] = [scalar_func(T) for T in tdata]
 
     return nmrdata
+
+
+def tensdata_iso(tdata):
+    # Isotropic value from Haeberlen-ordered eigenvalues
+    return float(np.average([tdata['e_x'], tdata['e_y'], tdata['e_z']]))
+
+
+def tensdata_vzz(tdata):
+    # Largest (Vzz) component from Haeberlen-ordered eigenvalues
+    return float(tdata['e_z'])
+
+
+def extract_nmrscalars(nmrdata):
+    # Flatten the per-species scalars into lists of {species, value}
+    # entries that can be searched with $elemMatch and indexed
+    msiso = []
+    efgvzz = []
+    for d in nmrdata:
+        s = d['species']
+        if 'ms' in d:
+            msiso += [{'species': s, 'value': tensdata_iso(T)}
+                      for T in d['ms']]
+        if 'efg' in d:
+            efgvzz += [{'species': s, 'value': tensdata_vzz(T)}
+                       for T in d['efg']]
+
+    return {'msiso': msiso, 'efgvzz': efgvzz}
@@ -32,6 +32,10 @@ parser.add_argument('-port', type=int, default=27017,
 parser.add_argument('-noorcid', action='store_true', default=False,
                     help='Do not use ORCID connections to retrieve user names'
                     '(speeds up debug)')
+parser.add_argument('-extract_cache', type=int, default=10000,
+                    help='Number of magres files whose automatic data is '
+                    'cached, so that re-running the conversion skips '
+                    'parsing them (0 disables)')
 
 args = parser.parse_args()
 
@@ -39,7 +43,7 @@ args = parser.parse_args()
 client = pymongo.MongoClient(host=args.url, port=args.port)
 olddb = client[args.olddb]
 mfiles_fs = GridFS(olddb, 'magresFilesFS')
-newdb = MagresDB(client, args.newdb)
+newdb = MagresDB(client, args.newdb, extract_cache_size=args.extract_cache)
 
 # Retrieve all entries in collection Metadata
 to_convert = [m for m in olddb.magresMetadata.find({})]
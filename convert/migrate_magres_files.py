@@ -0,0 +1,35 @@
+import os
+import sys
+import argparse as ap
+import pymongo
+
+path = os.path.split(__file__)[0]
+
+sys.path.append(os.path.join(path, '..'))
+
+try:
+    from ccpncdb.magresdb import MagresDB, MagresDBError
+except ImportError:
+    raise RuntimeError('Script must be located in its original path')
+
+parser = ap.ArgumentParser(description='Deduplicate and compress the stored'
+                           ' magres files')
+parser.add_argument('db', type=str,
+                    help='Name of database to update')
+parser.add_argument('-url', type=str, default='localhost',
+                    help='Database URL')
+parser.add_argument('-port', type=int, default=27017,
+                    help='Database port')
+
+args = parser.parse_args()
+
+client = pymongo.MongoClient(host=args.url, port=args.port)
+mdb = MagresDB(client, args.db)
+
+try:
+    report = mdb.migrate_magres_files()
+except MagresDBError as e:
+    sys.exit('{0}: run split_versions.py first'.format(e))
+print('{migrated} files migrated into {created} new files'.format(**report))
+print('{size_before} bytes before, {size_after} after: '
+      '{reclaimed} bytes reclaimed'.format(**report))
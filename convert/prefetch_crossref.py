@@ -0,0 +1,39 @@
+import os
+import sys
+import argparse as ap
+import pymongo
+
+path = os.path.split(__file__)[0]
+
+sys.path.append(os.path.join(path, '..'))
+
+try:
+    from ccpncdb.magresdb import MagresDB
+    from ccpncdb.crossref import CrossrefCache
+except ImportError:
+    raise RuntimeError('Script must be located in its original path')
+
+parser = ap.ArgumentParser(description='Fetch the authors of the DOIs of'
+                           ' all records from Crossref into the cache')
+parser.add_argument('db', type=str,
+                    help='Name of database to update')
+parser.add_argument('-url', type=str, default='localhost',
+                    help='Database URL')
+parser.add_argument('-port', type=int, default=27017,
+                    help='Database port')
+parser.add_argument('-workers', type=int, default=4,
+                    help='Number of parallel requests to Crossref')
+parser.add_argument('-refresh', action='store_true', default=False,
+                    help='Fetch again DOIs that are already cached')
+
+args = parser.parse_args()
+
+client = pymongo.MongoClient(host=args.url, port=args.port)
+mdb = MagresDB(client, args.db)
+
+crossref = CrossrefCache(client, args.db, workers=args.workers)
+
+dois = mdb.magresIndex.distinct('last_version.doi')
+report = crossref.prefetch(dois, refresh=args.refresh)
+print('{fetched} DOIs fetched, {cached} already cached, '
+      '{failed} failed'.format(**report))
@@ -0,0 +1,32 @@
+import os
+import sys
+import argparse as ap
+import pymongo
+
+path = os.path.split(__file__)[0]
+
+sys.path.append(os.path.join(path, '..'))
+
+try:
+    from ccpncdb.magresdb import MagresDB
+except ImportError:
+    raise RuntimeError('Script must be located in its original path')
+
+parser = ap.ArgumentParser(description='Move the version history of each'
+                           ' record to the magresVersions collection')
+parser.add_argument('db', type=str,
+                    help='Name of database to update')
+parser.add_argument('-url', type=str, default='localhost',
+                    help='Database URL')
+parser.add_argument('-port', type=int, default=27017,
+                    help='Database port')
+parser.add_argument('-batch', type=int, default=500,
+                    help='Number of versions per bulk write')
+
+args = parser.parse_args()
+
+client = pymongo.MongoClient(host=args.url, port=args.port)
+mdb = MagresDB(client, args.db)
+
+n = mdb.split_version_history(batch_size=args.batch)
+print('{0} records converted'.format(n))
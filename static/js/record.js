@@ -139,10 +139,22 @@ function addRecordDirective(ngApp) {
 
                 }
 
+                // Search results only carry the last version; the full
+                // history comes with the single record page
+                if (!scope.databaseRecord.version_history) {
+                    var n = parseInt(scope.databaseRecord.version_count);
+                    scope.databaseRecord.version_history = new Array(n);
+                    scope.databaseRecord.version_history[n-1] = scope.databaseRecord.last_version;
+                }
+
                 // Magres calc blocks
                 scope.mcalc_blocks = [];
 
                 for (var i = 0; i < scope.databaseRecord.version_history.length; ++i) {
+                    if (!scope.databaseRecord.version_history[i]) {
+                        scope.mcalc_blocks.push({});
+                        continue;
+                    }
                     // scope.mcalc_blocks.push(JSON.parse(scope.databaseRecord.version_history[i].magres_calc));
                     let calcString = scope.databaseRecord.version_history[i].magres_calc;
                     let calcStringUnwrap = JSON.parse(calcString);
@@ -2,10 +2,20 @@ function parseSearchResults(s) {
     // Try parsing as JSON; if not, print as error message
     results = null;
 
-    try {
-        results = JSON.parse(s);
-    } catch (e) {
-        console.log(s);
+    if (typeof s !== 'string') {
+        // Already parsed by jQuery from an application/json reply
+        results = s;
+    } else {
+        try {
+            results = JSON.parse(s);
+        } catch (e) {
+            console.log(s);
+        }
+    }
+
+    // Unwrap the paginated envelope
+    if (results != null && results.results !== undefined) {
+        results = results.results;
     }
 
     return results
@@ -10,6 +10,11 @@ function addSelectionService(ngApp) {
 
         const apiBaseUrl = ccpnc_config.server_app;
 
+        // Only the IDs and versions of the selected items are sent, the server looks up the records
+        function recordsOf(items) {
+            return items.map(item => ({ immutable_id: item.jsonData.immutable_id, version: item.version }));
+        }
+
         // This service is used to store the selected items in the selection page and to download the selected items 
         // as a zip archive or a single JSOn file depending on user selection
         var service = {
@@ -26,7 +31,7 @@ function addSelectionService(ngApp) {
             },
             //Method to create a zip archive of the selected items for download
             downloadSelectionZip: function() {
-                $http.post(`${apiBaseUrl}/download_selection_zip`, { files: this.selectedItems }, { responseType: 'arraybuffer' })
+                $http.post(`${apiBaseUrl}/download_selection_zip`, { records: recordsOf(this.selectedItems) }, { responseType: 'arraybuffer' })
                     .then(function(response) {
                         var blob = new Blob([response.data], { type: 'application/zip' });
                         var downloadUrl = window.URL.createObjectURL(blob);
@@ -44,7 +49,7 @@ function addSelectionService(ngApp) {
             },
             //Method to create a single JSON file of the selected record metadata for download
             downloadSelectionJSON: function() {
-                $http.post(`${apiBaseUrl}/download_selection_json`, { files: this.singleSelectJSON }, { responseType: 'json' })
+                $http.post(`${apiBaseUrl}/download_selection_json`, { records: recordsOf(this.singleSelectJSON) }, { responseType: 'json' })
                     .then(function(response) {
                         var jsonStr = JSON.stringify(response.data, null, 2);
                         var blob = new Blob([jsonStr], { type: 'application/json' });
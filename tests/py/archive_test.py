@@ -45,6 +45,44 @@ class ArchiveTest(unittest.TestCase):
 
             self.assertEqual(names, ['alanine.magres', 'ethanol.magres'])
 
+    def testStream(self):
+        from ccpncdb.archive import MagresArchive
+
+        for fname in ('test.csv.zip', 'test.tar'):
+            with open(os.path.join(data_path, fname), 'rb') as a:
+                with MagresArchive(a, version_data={'doi': '000'},
+                                   stream=True) as archive:
+                    # Nothing read until iterating
+                    self.assertEqual(archive._magres_files, {})
+                    names = []
+                    for f in archive.files():
+                        names.append(f.name)
+                        self.assertIn('atoms', f.contents)
+
+            self.assertEqual(names, ['alanine.magres', 'ethanol.magres'])
+
+        with open(os.path.join(data_path, 'test.csv.zip'), 'rb') as a:
+            with MagresArchive(a, version_data={'doi': '000'},
+                               stream=True) as archive:
+                doi = {f.name: f.version_data['doi']
+                       for f in archive.files()}
+        self.assertEqual(doi['alanine.magres'], '111')
+
+    def testSizeLimits(self):
+        from ccpncdb.archive import MagresArchive, MagresArchiveError
+
+        for fname in ('test.csv.zip', 'test.tar'):
+            with open(os.path.join(data_path, fname), 'rb') as a:
+                with self.assertRaises(MagresArchiveError):
+                    MagresArchive(a, max_file_size=8000)
+            with open(os.path.join(data_path, fname), 'rb') as a:
+                with self.assertRaises(MagresArchiveError):
+                    MagresArchive(a, stream=True, max_size=15000)
+            with open(os.path.join(data_path, fname), 'rb') as a:
+                archive = MagresArchive(a, max_size=20000,
+                                        max_file_size=11000)
+                self.assertEqual(len(list(archive.files())), 2)
+
     def testWriteZip(self):
         from ccpncdb.archive import MagresArchive
 
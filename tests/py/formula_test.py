@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import unittest
+import numpy as np
+
+file_path = os.path.split(__file__)[0]
+sys.path.append(os.path.abspath(os.path.join(file_path, '../../')))
+
+
+class FormulaTest(unittest.TestCase):
+
+    def testFormula(self):
+
+        from ccpncdb.formula import Formula
+
+        f = Formula.from_string('C2H6O')
+        self.assertEqual(str(f), 'C2H6O')
+        self.assertEqual(f.to_list(), [{'species': 'C', 'n': 2},
+                                       {'species': 'H', 'n': 6},
+                                       {'species': 'O', 'n': 1}])
+        self.assertEqual((f['H'], f['N'], f.natoms), (6, 0, 9))
+
+        # Canonical, whatever the order it's written in
+        for other in [Formula.from_string('CH3CH2OH'),
+                      Formula.from_string('O C2 H6'),
+                      Formula.from_symbols(['H', 'C', 'H', 'O', 'H', 'C',
+                                            'H', 'H', 'H']),
+                      Formula.from_symbols(np.array(['O'] + ['C']*2 +
+                                                    ['H']*6)),
+                      Formula.from_list(f.to_list()[::-1])]:
+            self.assertEqual(other, f)
+            self.assertEqual(hash(other), hash(f))
+        self.assertEqual(len({f, Formula.from_string('OH6C2')}), 1)
+
+        self.assertEqual(len(Formula.from_symbols(np.array([]))), 0)
+
+        # Reduction by the greatest common divisor
+        self.assertEqual(str(Formula.from_string('C6H9').reduced()), 'C2H3')
+        self.assertEqual(str(Formula.from_string('C4H12O2').reduced()),
+                         'C2H6O')
+        self.assertIs(f.reduced(), f)
+
+        for bad in ['', 'c2h6o', '2C', 'C2H6O!']:
+            with self.assertRaises(ValueError):
+                Formula.from_string(bad)
+        with self.assertRaises(ValueError):
+            Formula({'C': 1.5})
+
+        with self.assertRaises(AttributeError):
+            f._counts = ()
+
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -2,6 +2,7 @@
 
 import os
 import sys
+import time
 import unittest
 import numpy as np
 import subprocess as sp
@@ -39,12 +40,120 @@ class LoggerTest(unittest.TestCase):
     def testAddLog(self):
         
         # Test adding a single log message
-        self.logger.log('LOREM IPSUM', '0000-0000-0000', {'x': 0})
+        data = {'x': 0}
+        self.logger.log('LOREM IPSUM', '0000-0000-0000', data)
+        self.logger.flush()
 
         # Retrieve it
         ans = self.logger.logs.find_one({'x': 0})
 
         self.assertEqual(ans['message'], 'LOREM IPSUM')
+        # The caller's data is left alone
+        self.assertEqual(data, {'x': 0})
+
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testBatches(self):
+        from ccpncdb.log import Logger
+
+        # Written in the background, by size or by time
+        logger = Logger(self.logger.client, 'ccpnc-log-test', batch_size=5,
+                        flush_interval=0.05)
+        for i in range(12):
+            logger.log('Message', '0000-0000-0000', {'i': i})
+        for i in range(100):
+            if logger.logs.count_documents({}) == 12:
+                break
+            time.sleep(0.01)
+        self.assertEqual(sorted(e['i'] for e in logger.logs.find()),
+                         list(range(12)))
+        logger.close()
+
+        # Overflow policies
+        logger = Logger(self.logger.client, 'ccpnc-log-test', max_queue=2,
+                        overflow='drop')
+        logger._start = lambda: None     # No flusher
+        results = [logger.log('Drop', '0000-0000-0000') for i in range(3)]
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(logger.dropped, 1)
+        logger.close()
+        self.assertEqual(logger.logs.count_documents({'message': 'Drop'}), 2)
+
+        logger = Logger(self.logger.client, 'ccpnc-log-test', max_queue=2,
+                        overflow='sync')
+        logger._start = lambda: None
+        for i in range(3):
+            logger.log('Sync', '0000-0000-0000')
+        self.assertEqual(logger.logs.count_documents({'message': 'Sync'}), 1)
+        logger.close()
+        self.assertEqual(logger.logs.count_documents({'message': 'Sync'}), 3)
+
+        with self.assertRaises(ValueError):
+            Logger(self.logger.client, 'ccpnc-log-test', overflow='wait')
+
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testLifecycle(self):
+        import gc
+        import weakref
+        import threading
+        from unittest import mock
+        from ccpncdb.log import Logger, _loggers
+
+        # Only one flusher thread, however many log at once
+        logger = Logger(self.logger.client, 'ccpnc-log-test')
+        threads = [threading.Thread(target=logger.log,
+                                    args=('Start', '0000-0000-0000'))
+                   for i in range(8)]
+        with mock.patch('ccpncdb.log.threading.Thread',
+                        wraps=threading.Thread) as thread_cls:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(thread_cls.call_count, 1)
+        logger.close()
+        self.assertEqual(logger.logs.count_documents({'message': 'Start'}),
+                         8)
+
+        # Loggers that were never started don't outlive their users
+        logger = Logger(self.logger.client, 'ccpnc-log-test')
+        self.assertIn(logger, _loggers)
+        ref = weakref.ref(logger)
+        del logger
+        gc.collect()
+        self.assertIsNone(ref())
+
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testTTL(self):
+        from unittest import mock
+        from pymongo.errors import OperationFailure
+        from ccpncdb.log import Logger
+
+        # mongomock can't create capped collections, so only the TTL index
+        logger = Logger(self.logger.client, 'ccpnc-log-test', ttl=3600)
+        info = logger.logs.index_information()['ccpnc_log_ttl']
+        self.assertEqual(info['expireAfterSeconds'], 3600)
+
+        # Changing it doesn't fail: changed in place if the server can,
+        # rebuilt otherwise (mongomock can't run collMod at all)
+        with mock.patch('mongomock.database.Database.command') as command:
+            Logger(self.logger.client, 'ccpnc-log-test', ttl=3600)
+            command.assert_not_called()
+            Logger(self.logger.client, 'ccpnc-log-test', ttl=60)
+            cmd = command.call_args[0][0]
+            self.assertEqual(cmd['collMod'], 'databaseLogs')
+            self.assertEqual(cmd['index']['expireAfterSeconds'], 60)
+
+            command.side_effect = OperationFailure('collMod not allowed')
+            logger = Logger(self.logger.client, 'ccpnc-log-test', ttl=60)
+        info = logger.logs.index_information()['ccpnc_log_ttl']
+        self.assertEqual(info['expireAfterSeconds'], 60)
+
+        # And dropped when not wanted anymore
+        logger = Logger(self.logger.client, 'ccpnc-log-test')
+        self.assertNotIn('ccpnc_log_ttl', logger.logs.index_information())
 
 
 if __name__ == '__main__':
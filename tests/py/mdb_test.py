@@ -10,6 +10,8 @@ from hashlib import md5
 import zipfile
 import json
 import csv
+import threading
+import time
 import io
 import re
 from io import BytesIO
@@ -86,6 +88,16 @@ def clean_db(method):
     return clean_method
 
 
+def _allocate_ids(seed):
+    # Worker for testUniqueIDProcesses
+    import pymongo
+    from ccpncdb.idalloc import IDAllocator
+
+    client = pymongo.MongoClient('mongodb://localhost:27017')
+    alloc = IDAllocator(client['ccpnc-test-ids'].magresIDcount, block_size=5)
+    return sum([alloc.allocate(i % 3 + 1) for i in range(100)], [])
+
+
 class MagresDBTest(unittest.TestCase):
 
     @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
@@ -114,6 +126,25 @@ class MagresDBTest(unittest.TestCase):
         def download_selection_zip():
             return self.server.download_selection_zip()
         
+        # Add a route to simulate the get_magres flask endpoint
+        @self.app.route('/get_magres', methods=['GET'])
+        def get_magres():
+            return self.server.get_magres()
+
+        # Add a route to simulate the search flask endpoint
+        @self.app.route('/search', methods=['POST'])
+        def search():
+            return self.server.search()
+
+        # Add routes to simulate the get_record and get_csv flask endpoints
+        @self.app.route('/get_record', methods=['POST'])
+        def get_record():
+            return self.server.get_record()
+
+        @self.app.route('/get_csv', methods=['GET'])
+        def get_csv():
+            return self.server.get_csv()
+
         # Add a route to simulate the get_author_info flask endpoint
         @self.app.route('/get_authors', methods=['GET'])
         def get_author_info():
@@ -171,9 +202,238 @@ class MagresDBTest(unittest.TestCase):
         for rec in self.mdb.magresIndex.find({}):
             self.assertTrue('broken' not in rec['chemname'])
 
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testAddArchiveBulk(self):
+
+        self.mdb.ensure_indexes()
+
+        with open(os.path.join(data_path, 'test.csv.zip'), 'rb') as a:
+            results = self.mdb.add_archive(a, _fake_rdata, _fake_vdata)
+
+        # One counter increment, contiguous IDs in file order
+        self.assertEqual(results['alanine.magres'].mdbref, '0000001')
+        self.assertEqual(results['ethanol.magres'].mdbref, '0000002')
+        self.assertEqual(self.mdb.magresIDcount.find_one()['count'], 2)
+
+        for name, res in results.items():
+            self.assertTrue(res.successful)
+            rec = self.mdb.get_record(res.id)
+            self.assertEqual(rec['id'], res.id)
+            self.assertEqual(rec['version_count'], 1)
+            self.assertEqual(self.mdb.get_versions(res.id),
+                             [rec['last_version']])
+            fs_id = rec['last_version']['magresFilesID']
+            self.assertIn('atoms', self.mdb.get_magres_file(fs_id, True))
+
+        # A clash on one record only fails that one
+        self.mdb.magresIndex.insert_one({'immutable_id': '0000004'})
+        fs_files = self.mdb.client['ccpnc-test'].magresFilesFS.files
+        nfiles = fs_files.count_documents({})
+        with open(os.path.join(data_path, 'test.csv.zip'), 'rb') as a:
+            results = self.mdb.add_archive(a, _fake_rdata, _fake_vdata)
+
+        self.assertEqual(results['alanine.magres'].mdbref, '0000003')
+        self.assertIsNone(results['ethanol.magres'])
+        # Same contents as before, so no new files
+        self.assertEqual(fs_files.count_documents({}), nfiles)
+
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testAddArchiveStream(self):
+        from unittest import mock
+
+        self.mdb.stream_archives = True
+
+        with open(os.path.join(data_path, 'test.csv.zip'), 'rb') as a:
+            results = self.mdb.add_archive(a, _fake_rdata, _fake_vdata)
+
+        self.assertEqual(sorted(results), ['alanine.magres',
+                                           'ethanol.magres'])
+        self.assertTrue(all(res.successful for res in results.values()))
+
+        # Invalid files are reported one by one
+        with open(os.path.join(data_path, 'broken.zip'), 'rb') as a:
+            results = self.mdb.add_archive(a, _fake_rdata, _fake_vdata)
+
+        self.assertIsNone(results['fake.magres'])
+        self.assertTrue(results['real.magres'].successful)
+
+        # And files that aren't even text, serially and in parallel
+        with open(os.path.join(data_path, 'ethanol.magres'), 'rb') as f:
+            ethbytes = f.read()
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w') as z:
+            z.writestr('a.magres', ethbytes)
+            z.writestr('b.magres', b'\xff\xfe' + ethbytes)
+            z.writestr('c.magres', ethbytes)
+        for workers in [0, 2]:
+            self.mdb.parse_workers = workers
+            self.mdb.parse_queue = 1
+            try:
+                buf.seek(0)
+                results = self.mdb.add_archive(buf, _fake_rdata, _fake_vdata)
+            finally:
+                self.mdb._reset_pool()
+            self.assertIsNone(results['b.magres'])
+            self.assertTrue(results['a.magres'].successful)
+            self.assertTrue(results['c.magres'].successful)
+
+        # Valid files are pushed in batches
+        self.mdb.STREAM_BATCH = 2
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w') as z:
+            for name in 'abcde':
+                z.writestr(name + '.magres', ethbytes)
+        buf.seek(0)
+        with mock.patch.object(self.mdb.magresIndex, 'insert_many',
+                               wraps=self.mdb.magresIndex.insert_many) as im:
+            results = self.mdb.add_archive(buf, _fake_rdata, _fake_vdata)
+        self.assertEqual([len(c[0][0]) for c in im.call_args_list],
+                         [2, 2, 1])
+        self.assertEqual(list(results), [n + '.magres' for n in 'abcde'])
+        self.assertTrue(all(res.successful for res in results.values()))
+
+        # So are files that time out, without failing the whole upload
+        self.mdb.parse_workers = 2
+        self.mdb.parse_queue = 1
+        self.mdb.parse_timeout = 1e-6
+        try:
+            with open(os.path.join(data_path, 'test.csv.zip'), 'rb') as a:
+                results = self.mdb.add_archive(a, _fake_rdata, _fake_vdata)
+        finally:
+            self.mdb._reset_pool()
+        self.assertEqual(results, {'alanine.magres': None,
+                                   'ethanol.magres': None})
+
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testAddArchiveParallel(self):
+        from concurrent.futures import CancelledError
+        from concurrent.futures.process import BrokenProcessPool
+        from ccpncdb.magresdb import MagresDBError
+
+        with open(os.path.join(data_path, 'test.csv.zip'), 'rb') as a:
+            serial = self.mdb.add_archive(a, _fake_rdata, _fake_vdata)
+
+        self.mdb.parse_workers = 2
+        self.mdb.parse_queue = 1
+        try:
+            with open(os.path.join(data_path, 'test.csv.zip'), 'rb') as a:
+                parallel = self.mdb.add_archive(a, _fake_rdata, _fake_vdata)
+
+            # Same order and contents as the serial path
+            self.assertEqual(list(parallel), list(serial))
+            for name in serial:
+                rs = self.mdb.get_record(serial[name].id)
+                rp = self.mdb.get_record(parallel[name].id)
+                for k in ('chemname', 'formula', 'molecules', 'nmrdata',
+                          'msiso'):
+                    self.assertEqual(rs[k], rp[k])
+
+            with open(os.path.join(data_path, 'broken.zip'), 'rb') as a:
+                with self.assertRaises(MagresDBError):
+                    self.mdb.add_archive(a, _fake_rdata, _fake_vdata)
+
+            # A pool shut down by another thread is replaced
+            pool = self.mdb._get_pool()
+            pool.shutdown()
+            new_pool, future = self.mdb._submit(b'not a magres file')
+            self.assertIsNot(new_pool, pool)
+            with self.assertRaises(Exception):
+                future.result()
+
+            # Resetting kills workers stuck on a file
+            pool = self.mdb._get_pool()
+            future = pool.submit(time.sleep, 60)
+            while not future.running():
+                time.sleep(0.05)
+            queued = [pool.submit(time.sleep, 60) for i in range(4)]
+            procs = list(pool._processes.values())
+            self.mdb._reset_pool(pool)
+            for p in procs:
+                p.join(10)
+                self.assertFalse(p.is_alive())
+            # And what was waiting for them fails instead of hanging
+            for f in [future] + queued:
+                with self.assertRaises((BrokenProcessPool, CancelledError)):
+                    f.result(10)
+
+            # Workers can't even start in this time
+            self.mdb.parse_timeout = 1e-6
+            with open(os.path.join(data_path, 'test.csv.zip'), 'rb') as a:
+                with self.assertRaises(MagresDBError):
+                    self.mdb.add_archive(a, _fake_rdata, _fake_vdata)
+        finally:
+            self.mdb._reset_pool()
+
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testExtractCache(self):
+        from ccpncdb.magresdb import MagresDB
+
+        mdb = MagresDB(self.mdb.client, 'ccpnc-test', extract_cache_size=2)
+        cache = mdb.extract_cache
+
+        extracted = []
+        auto_rdata = mdb._auto_rdata
+
+        def counting_auto_rdata(matoms):
+            extracted.append(matoms.get_chemical_formula())
+            return auto_rdata(matoms)
+        mdb._auto_rdata = counting_auto_rdata
+
+        with open(os.path.join(data_path, 'ethanol.magres')) as f:
+            ethstr = f.read()
+
+        res_1 = mdb.add_record(ethstr, _fake_rdata, _fake_vdata)
+        self.assertEqual(extracted, ['C2H6O'])
+
+        # Same contents with different line endings: not even parsed
+        res_2 = mdb.add_record(ethstr.replace('\n', '\r\n'), _fake_rdata,
+                               _fake_vdata)
+        mdb.add_version(res_1.id, ethstr.encode('utf-8'), _fake_vdata)
+        self.assertEqual(extracted, ['C2H6O'])
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1,
+                                         'pruned': 0})
+
+        rec_1 = mdb.get_record(res_1.id)
+        rec_2 = mdb.get_record(res_2.id)
+        for k in ('formula', 'molecules', 'nmrdata', 'msiso', 'Z'):
+            self.assertEqual(rec_1[k], rec_2[k])
+        self.assertEqual(rec_1['last_version']['magres_calc'],
+                         rec_2['last_version']['magres_calc'])
+
+        # Results of older extractors are not used
+        old_cache = mdb.extract_cache
+        mdb.extract_cache = type(cache)(cache.collection, 2, 2)
+        mdb.add_record(ethstr, _fake_rdata, _fake_vdata)
+        self.assertEqual(extracted, ['C2H6O']*2)
+        mdb.extract_cache = old_cache
+
+        # Parsed in the workers, then straight from the cache: no workers
+        # are needed the second time
+        mdb.parse_workers = 2
+        try:
+            with open(os.path.join(data_path, 'test.csv.zip'), 'rb') as a:
+                first = mdb.add_archive(a, _fake_rdata, _fake_vdata)
+            mdb.parse_timeout = 1e-6
+            with open(os.path.join(data_path, 'test.csv.zip'), 'rb') as a:
+                second = mdb.add_archive(a, _fake_rdata, _fake_vdata)
+        finally:
+            mdb._reset_pool()
+        for name in first:
+            self.assertEqual(mdb.get_record(first[name].id)['nmrdata'],
+                             mdb.get_record(second[name].id)['nmrdata'])
+
+        # Least recently used entries are pruned
+        self.assertEqual(cache.collection.count_documents({}), 2)
+        self.assertGreater(cache.stats()['pruned'], 0)
+
     @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
     @clean_db
     def testAddVersion(self):
+        from ccpncdb.magresdb import MagresDBError
 
         r_id = None
         with open(os.path.join(data_path, 'ethanol.fake.magres')) as f:
@@ -212,6 +472,94 @@ class MagresDBTest(unittest.TestCase):
 
         self.assertEqual(rec['last_version']['license'], 'odc-by')
 
+        # Versions live in their own collection
+        self.assertNotIn('version_history', rec)
+        versions = self.mdb.get_versions(r_id)
+        self.assertEqual(len(versions), 3)
+        self.assertEqual(versions[-1], rec['last_version'])
+        self.assertEqual(self.mdb.get_version(r_id, 1)['magresFilesID'],
+                         versions[2]['magresFilesID'])
+        with self.assertRaises(MagresDBError):
+            self.mdb.get_version(r_id, 3)
+
+        # Many at once; missing ones are left out
+        bulk = self.mdb.get_versions_bulk([(r_id, 0), (r_id, 2), (r_id, 3)])
+        self.assertEqual(bulk, {(ObjectId(r_id), 0): versions[0],
+                                (ObjectId(r_id), 2): versions[2]})
+
+        # A version that can't be stored leaves the record as it was
+        self.mdb.ensure_indexes()
+        self.mdb.magresVersions.insert_one({'record_id': ObjectId(r_id),
+                                            'n': 3})
+        fs_files = self.mdb.client['ccpnc-test'].magresFilesFS.files
+        fs_id = ObjectId(rec['last_version']['magresFilesID'])
+        refcount = fs_files.find_one({'_id': fs_id})['metadata']['refcount']
+        with self.assertRaises(MagresDBError):
+            self.mdb.add_version(r_id, version_data={'license': 'cc-by'})
+        rec = self.mdb.get_record(r_id)
+        self.assertEqual(rec['version_count'], 3)
+        self.assertEqual(rec['last_version'], versions[2])
+        self.assertEqual(fs_files.find_one({'_id': fs_id})['metadata'][
+            'refcount'], refcount)
+        self.mdb.magresVersions.delete_one({'record_id': ObjectId(r_id),
+                                            'n': 3})
+
+        # Through the server
+        response = self.test_client.post('/get_record',
+                                         json={'mdbref': res.mdbref})
+        self.assertEqual(len(json.loads(response.data)['version_history']),
+                         3)
+        response = self.test_client.get('/get_csv', query_string={
+            'oid': r_id, 'v': 0})
+        self.assertEqual(response.status_code, 200)
+        rows = list(csv.DictReader(io.StringIO(response.data.decode())))
+        self.assertEqual(rows[0]['license'], _fake_vdata['license'])
+
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testSplitVersions(self):
+
+        with open(os.path.join(data_path, 'ethanol.magres')) as f:
+            res = self.mdb.add_record(f, _fake_rdata, _fake_vdata)
+        self.mdb.add_version(res.id, version_data={'license': 'odc-by'})
+        versions = self.mdb.get_versions(res.id)
+
+        # Put them back inside the record, as they used to be stored
+        self.mdb.magresVersions.delete_many({})
+        self.mdb.magresIndex.update_one({'_id': ObjectId(res.id)},
+                                        {'$set': {
+                                            'version_history': versions}})
+
+        # Still readable before the split
+        self.assertEqual(self.mdb.get_versions(res.id), versions)
+        self.assertEqual(self.mdb.get_version(res.id, 1), versions[1])
+        self.assertEqual(self.mdb.get_versions_bulk([(res.id, 0)]),
+                         {(ObjectId(res.id), 0): versions[0]})
+        self.assertEqual(self.mdb.get_version_by_mdbref(res.mdbref, 0),
+                         versions[0])
+
+        self.assertEqual(self.mdb.split_version_history(), 1)
+        self.assertEqual(self.mdb.get_versions(res.id), versions)
+        rec = self.mdb.get_record(res.id)
+        self.assertNotIn('version_history', rec)
+        self.assertEqual(rec['version_count'], 2)
+        self.assertEqual(self.mdb.split_version_history(), 0)
+
+        # A legacy record given a new version before the split keeps it
+        self.mdb.magresVersions.delete_many({})
+        self.mdb.magresIndex.update_one({'_id': ObjectId(res.id)},
+                                        {'$set': {
+                                            'version_history': versions}})
+        self.mdb.add_version(res.id, version_data={'license': 'cc-by'})
+        self.assertEqual(self.mdb.split_version_history(), 1)
+        self.mdb.add_version(res.id, version_data={'license': 'pddl'})
+        rec = self.mdb.get_record(res.id)
+        self.assertEqual(rec['version_count'], 4)
+        self.assertEqual([v['license'] for v in
+                          self.mdb.get_versions(res.id)],
+                         [v['license'] for v in versions] + ['cc-by', 'pddl'])
+        self.assertEqual(self.mdb.get_version(res.id, 3)['license'], 'pddl')
+
     @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
     @clean_db
     def testGetFile(self):
@@ -224,7 +572,7 @@ class MagresDBTest(unittest.TestCase):
             rec = self.mdb.magresIndex.find_one({'_id': ObjectId(res.id)})
             print(rec)  # Debugging print statement
             # Get file id
-            fs_id = rec['version_history'][-1]['magresFilesID']
+            fs_id = self.mdb.get_versions(res.id)[-1]['magresFilesID']
             print("File ID:", fs_id)  # Debugging print statement
 
             # Ensure fs_id is not None
@@ -235,6 +583,158 @@ class MagresDBTest(unittest.TestCase):
 
             self.assertEqual(fstr, fstr2)
 
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testFileDedupe(self):
+
+        with open(os.path.join(data_path, 'ethanol.magres')) as f:
+            fstr = f.read()
+        fs_files = self.mdb.client['ccpnc-test'].magresFilesFS.files
+
+        res1 = self.mdb.add_record(fstr, _fake_rdata, _fake_vdata)
+        res2 = self.mdb.add_record(fstr, _fake_rdata, _fake_vdata)
+        fs_id = self.mdb.get_record(res1.id)['last_version']['magresFilesID']
+        self.assertEqual(
+            self.mdb.get_record(res2.id)['last_version']['magresFilesID'],
+            fs_id)
+
+        fdoc = fs_files.find_one({'_id': ObjectId(fs_id)})
+        self.assertEqual(fs_files.count_documents({}), 1)
+        self.assertEqual(fdoc['metadata']['refcount'], 2)
+        self.assertEqual(fdoc['metadata']['length'], len(fstr))
+        self.assertLess(fdoc['length'], len(fstr))
+        self.assertEqual(self.mdb.get_magres_file(fs_id, True), fstr)
+        self.assertEqual(b''.join(self.mdb.iter_magres_file(fs_id, 10, 30)),
+                         fstr.encode('utf-8')[10:30])
+
+        # A version without a file keeps referencing the same one
+        self.mdb.add_version(res1.id, version_data={'license': 'odc-by'})
+        fdoc = fs_files.find_one({'_id': ObjectId(fs_id)})
+        self.assertEqual(fdoc['metadata']['refcount'], 3)
+
+        # Unless the same contents are stored again as it goes
+        store = self.mdb.magresFiles
+        delete_one = store.files.delete_one
+        taken = []
+
+        def racing_delete(*args, **kwargs):
+            taken.append(store.put(fstr))
+            return delete_one(*args, **kwargs)
+
+        store.files.delete_one = racing_delete
+        try:
+            for i in range(3):
+                store.release(fs_id)
+        finally:
+            del store.files.delete_one
+        self.assertEqual(taken, [ObjectId(fs_id)])
+        self.assertEqual(self.mdb.get_magres_file(fs_id, True), fstr)
+
+        # Releasing the last reference deletes the file
+        store.release(fs_id)
+        self.assertEqual(fs_files.count_documents({}), 0)
+        self.assertEqual(self.mdb.client['ccpnc-test'].magresFilesFS.chunks
+                         .count_documents({}), 0)
+
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testMigrateFiles(self):
+        from ccpncdb.magresdb import MagresDBError
+
+        with open(os.path.join(data_path, 'ethanol.magres')) as f:
+            fstr = f.read()
+        fs_files = self.mdb.client['ccpnc-test'].magresFilesFS.files
+
+        # Two records with identical files stored the old way
+        ids = []
+        for i in range(2):
+            res = self.mdb.add_record(fstr, _fake_rdata, _fake_vdata)
+            old_id = self.mdb.magresFilesFS.put(fstr, filename=res.id,
+                                                encoding='UTF-8')
+            self.mdb.magresIndex.update_one(
+                {'_id': ObjectId(res.id)},
+                {'$set': {'last_version.magresFilesID': str(old_id)}})
+            self.mdb.magresVersions.update_one(
+                {'record_id': ObjectId(res.id), 'n': 0},
+                {'$set': {'magresFilesID': str(old_id)}})
+            ids.append(res.id)
+        # Legacy files are still readable
+        self.assertEqual(self.mdb.get_magres_file(str(old_id), True), fstr)
+
+        report = self.mdb.migrate_magres_files()
+        self.assertEqual(report['migrated'], 2)
+        self.assertEqual(report['created'], 0)
+        self.assertEqual(report['size_before'], 2*len(fstr))
+        self.assertEqual(report['reclaimed'], 2*len(fstr))
+
+        self.assertEqual(fs_files.count_documents({}), 1)
+        fdoc = fs_files.find_one()
+        self.assertEqual(fdoc['metadata']['refcount'], 2)
+        for r_id in ids:
+            rec = self.mdb.get_record(r_id)
+            fs_id = rec['last_version']['magresFilesID']
+            self.assertEqual(fs_id, str(fdoc['_id']))
+            self.assertEqual(self.mdb.get_version(r_id, 0)['magresFilesID'],
+                             fs_id)
+            self.assertEqual(self.mdb.get_magres_file(fs_id, True), fstr)
+
+        # Nothing left to do
+        self.assertEqual(self.mdb.migrate_magres_files()['migrated'], 0)
+
+        # Embedded versions wouldn't be repointed
+        self.mdb.magresIndex.update_one({'_id': ObjectId(ids[0])},
+                                        {'$set': {'version_history': []}})
+        with self.assertRaises(MagresDBError):
+            self.mdb.migrate_magres_files()
+
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testGetFileHTTP(self):
+        import gzip
+
+        with open(os.path.join(data_path, 'ethanol.magres')) as f:
+            fstr = f.read()
+        res = self.mdb.add_record(fstr, _fake_rdata, _fake_vdata)
+        fs_id = self.mdb.get_record(res.id)['last_version']['magresFilesID']
+        fbytes = fstr.encode('utf-8')
+        query = {'magres_id': fs_id}
+
+        resp = self.test_client.get('/get_magres', query_string=query)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, fbytes)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        etag = resp.headers['ETag']
+
+        # Conditional request
+        resp = self.test_client.get('/get_magres', query_string=query,
+                                    headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+
+        # Byte ranges
+        resp = self.test_client.get('/get_magres', query_string=query,
+                                    headers={'Range': 'bytes=10-29'})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, fbytes[10:30])
+        self.assertEqual(resp.headers['Content-Range'],
+                         'bytes 10-29/{0}'.format(len(fbytes)))
+
+        resp = self.test_client.get('/get_magres', query_string=query,
+                                    headers={'Range': 'bytes=100000-'})
+        self.assertEqual(resp.status_code, 416)
+
+        # Compression
+        resp = self.test_client.get('/get_magres', query_string=query,
+                                    headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.assertEqual(gzip.decompress(resp.data), fbytes)
+
+        resp = self.test_client.get('/get_magres',
+                                    query_string={'magres_id': '0'*24})
+        self.assertEqual(resp.status_code, 400)
+
     @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
     @clean_db
     def testSearch(self):
@@ -460,20 +960,31 @@ class MagresDBTest(unittest.TestCase):
         self.assertEqual(str(found[0]['_id']), res_3.id) # the returned rcord should be res_3
 
         # Test by MS
+        found = self.mdb.search_record([{
+            'type': 'msRange',
+            'args': {'sp': 'N', 'minms': 100.0, 'maxms': 200.0},
+            'negate_query': False
+        }])
+        found = list(found)
 
-        if isinstance(self.mdb.client, mongomock.MongoClient):
-            import warnings
-            warnings.warn("MongoDB mock does not support this search, skipping test case")
-        else:
-            found = self.mdb.search_record([{
-                'type': 'msRange',
-                'args': {'sp': 'N', 'minms': 100.0, 'maxms': 200.0},
-                'negate_query': False
-            }])
-            found = list(found)
+        self.assertEqual(len(found), 1)
+        self.assertEqual(found[0]['chemname'], 'alanine')
 
-            self.assertEqual(len(found), 1)
-            self.assertEqual(found[0]['chemname'], 'alanine')
+        # Records stored before the scalars existed need a backfill
+        self.mdb.magresIndex.update_many({}, {'$unset': {'msiso': '',
+                                                         'efgvzz': ''}})
+        self.assertEqual(self.mdb.backfill_nmrscalars(batch_size=1), 3)
+        found = self.mdb.search_record([{
+            'type': 'msRange',
+            'args': {'sp': 'N', 'minms': 100.0, 'maxms': 200.0},
+            'negate_query': False
+        }])
+        self.assertEqual(len(list(found)), 1)
+        self.mdb.magresIndex.update_many({}, {'$unset': {'msiso': '',
+                                                         'efgvzz': ''}})
+        self.mdb.magresBackfills.delete_many({})
+        self.assertEqual(self.mdb.run_backfills()['nmrscalars'], 3)
+        self.assertEqual(self.mdb.run_backfills(), {})
 
         # External reference
         vdata = dict(_fake_vdata)
@@ -531,6 +1042,264 @@ class MagresDBTest(unittest.TestCase):
         self.assertEqual(len(found), 1) # One record where refcode is 'ABC456' should be returned
         self.assertEqual(str(found[0]['last_version']['extref_code']), 'ABC456') #verfiy that the returned record's refcode is indeed 'ABC456'
 
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testSearchPaging(self):
+        from ccpncdb.magresdb import MagresDBError
+
+        with open(os.path.join(data_path, 'ethanol.magres')) as f:
+            ethstr = f.read()
+
+        for i in range(5):
+            self.mdb.add_record(ethstr, _fake_rdata, _fake_vdata)
+
+        spec = [{
+            'type': 'license',
+            'args': {'license': 'cc-by'},
+            'negate_query': False
+        }]
+
+        found = list(self.mdb.search_record(spec, limit=2, skip=1,
+                                            sort=[('immutable_id', -1)],
+                                            profile='summary'))
+        self.assertEqual([r['immutable_id'] for r in found],
+                         ['0000004', '0000003'])
+        self.assertNotIn('version_history', found[0])
+        self.assertNotIn('nmrdata', found[0])
+        self.assertEqual(self.mdb.count_records(spec), 5)
+
+        # Through the server, with the total/has_more envelope
+        response = self.test_client.post('/search', json={
+            'search_spec': spec, 'limit': 2, 'skip': 2,
+            'sort': [['immutable_id', 1]], 'profile': 'ids'})
+        self.assertEqual(response.status_code, 200)
+        ans = json.loads(response.data)
+        self.assertEqual([r['immutable_id'] for r in ans['results']],
+                         ['0000003', '0000004'])
+        self.assertEqual(ans['total'], 5)
+        self.assertTrue(ans['has_more'])
+
+        response = self.test_client.post('/search', json={
+            'search_spec': spec})
+        ans = json.loads(response.data)
+        self.assertEqual(len(ans['results']), 5)
+        self.assertIn('last_version', ans['results'][0])
+        self.assertNotIn('version_history', ans['results'][0])
+        self.assertFalse(ans['has_more'])
+
+        response = self.test_client.post('/search', json={
+            'search_spec': spec, 'sort': [['chemname_tokens', 1]]})
+        self.assertEqual(response.status_code, 400)
+        # Malformed paging and sorting are bad requests too
+        for bad in [{'skip': -1}, {'limit': -5}, {'sort': 'abc'},
+                    {'sort': [['x']]}, {'sort': [['chemname', 'up']]},
+                    {'sort': [[['chemname'], 1]]}]:
+            response = self.test_client.post('/search', json=dict(
+                bad, search_spec=spec))
+            self.assertEqual(response.status_code, 400)
+        for bad in ['abc', [['x']], [('chemname', None)]]:
+            with self.assertRaises(MagresDBError):
+                self.mdb._check_sort(bad)
+
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testTrigramSearch(self):
+        from datetime import datetime, timedelta
+        from ccpncdb.magresdb import MagresDB
+        from ccpncdb.search import build_search
+
+        with open(os.path.join(data_path, 'ethanol.magres')) as f:
+            ethstr = f.read()
+
+        rdata = dict(_fake_rdata, chemname='Ethanol')
+        vdata = dict(_fake_vdata, chemform='C2H6O', doi='10.1010/ABCD123456',
+                     extref_type='dbname', extref_code='1234567')
+        res_1 = self.mdb.add_record(ethstr, rdata, vdata)
+
+        rec = self.mdb.get_record(res_1.id)
+        self.assertIn('eth', rec['chemname_trigrams'])
+        self.assertIn('chemform:c2h', rec['version_trigrams'])
+        self.assertIn('doi:abc', rec['version_trigrams'])
+        self.assertIn('extref_code:123', rec['version_trigrams'])
+
+        # A new version updates them
+        self.mdb.add_version(res_1.id, version_data=dict(vdata,
+                                                         chemform='CH3CH2OH'))
+        rec = self.mdb.get_record(res_1.id)
+        self.assertIn('chemform:ch3', rec['version_trigrams'])
+        self.assertNotIn('chemform:c2h', rec['version_trigrams'])
+
+        # Wildcard searches carry a prefilter on them
+        spec = [{'type': 'chemform', 'args': {'pattern': '*CH3*'},
+                 'negate_query': False}]
+        query = build_search(spec)
+        self.assertEqual(query['$and'][1]['version_trigrams'],
+                         {'$all': ['chemform:ch3']})
+        self.assertEqual(self.mdb.count_records(spec), 1)
+
+        spec = [{'type': 'doi', 'args': {'doi': '*abcd1234*'},
+                 'negate_query': False}]
+        self.assertEqual(self.mdb.count_records(spec), 1)
+        spec[0]['negate_query'] = True
+        self.assertEqual(self.mdb.count_records(spec), 0)
+
+        spec = [{'type': 'chemname', 'args': {'pattern': '"thano"'},
+                 'negate_query': False}]
+        self.assertEqual(self.mdb.count_records(spec), 1)
+
+        spec = [{'type': 'extref',
+                 'args': {'reftype': 'dbname', 'refcode': '12*67',
+                          'other_reftype': None},
+                 'negate_query': False}]
+        self.assertEqual(self.mdb.count_records(spec), 1)
+
+        # Records stored before trigrams were introduced need a backfill
+        self.mdb.magresIndex.update_many({}, {'$unset': {
+            'chemname_trigrams': 1, 'version_trigrams': 1}})
+        spec = [{'type': 'chemform', 'args': {'pattern': 'CH3*'},
+                 'negate_query': False}]
+        self.assertEqual(self.mdb.count_records(spec), 0)
+        self.assertEqual(self.mdb.backfill_trigrams(), 1)
+        self.assertEqual(self.mdb.count_records(spec), 1)
+        self.assertEqual(self.mdb.backfill_trigrams(), 0)
+
+        # Which happens on startup, once per database
+        self.mdb.magresIndex.update_many({}, {'$unset': {
+            'chemname_trigrams': 1, 'version_trigrams': 1}})
+        mdb = MagresDB(self.mdb.client, 'ccpnc-test')
+        self.assertEqual(mdb.count_records(spec), 1)
+        self.assertEqual(mdb.run_backfills(), {})
+
+        # Only by one process at a time; claims of dead ones expire
+        mdb.magresBackfills.update_one({'_id': 'trigrams'}, {'$set': {
+            'state': 'running', 'started': datetime.utcnow()}})
+        self.assertEqual(mdb.run_backfills(), {})
+        mdb.magresBackfills.update_one({'_id': 'trigrams'}, {'$set': {
+            'started': datetime.utcnow() - timedelta(seconds=7200)}})
+        self.assertEqual(mdb.run_backfills(), {'trigrams': 0})
+        self.assertEqual(mdb.magresBackfills.find_one(
+            {'_id': 'trigrams'})['state'], 'done')
+
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testBackfillStochiometry(self):
+
+        with open(os.path.join(data_path, 'ethanol.magres')) as f:
+            ethstr = f.read()
+        res = self.mdb.add_record(ethstr, _fake_rdata, _fake_vdata)
+        self.assertEqual(self.mdb.backfill_stochiometry(), 0)
+
+        # Stored unreduced, as the old reduction left some
+        self.mdb.magresIndex.update_one(
+            {'immutable_id': res.mdbref},
+            {'$set': {'stochiometry': [{'species': 'C', 'n': 4},
+                                       {'species': 'H', 'n': 12},
+                                       {'species': 'O', 'n': 2}]}})
+        spec = [{'type': 'formula',
+                 'args': {'formula': 'CH3CH2OH', 'subset': False},
+                 'negate_query': False}]
+        self.assertEqual(self.mdb.count_records(spec), 0)
+        self.assertEqual(self.mdb.backfill_stochiometry(), 1)
+        self.assertEqual(self.mdb.count_records(spec), 1)
+
+        # Which happens on startup, once per database
+        self.mdb.magresIndex.update_one(
+            {'immutable_id': res.mdbref},
+            {'$set': {'stochiometry': [{'species': 'C', 'n': 4},
+                                       {'species': 'H', 'n': 12},
+                                       {'species': 'O', 'n': 2}]}})
+        self.assertEqual(self.mdb.run_backfills()['stochiometry'], 1)
+        self.assertEqual(self.mdb.count_records(spec), 1)
+        self.assertEqual(self.mdb.run_backfills(), {})
+
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testSearchCache(self):
+        from ccpncdb.magresdb import MagresDBError
+        from ccpncdb.search import QueryCache
+        from ccpncdb.resultcache import (ResultCache, MemoryBackend,
+                                         RedisBackend)
+
+        class FakeRedis(object):
+            # Stand-in for a redis.Redis client
+            def __init__(self):
+                self.data = {}
+
+            def get(self, key):
+                return self.data.get(key)
+
+            def set(self, key, value, ex=None):
+                self.data[key] = value
+
+        with open(os.path.join(data_path, 'ethanol.magres')) as f:
+            ethstr = f.read()
+
+        spec = [{
+            'type': 'license',
+            'args': {'license': 'cc-by'},
+            'negate_query': False
+        }]
+        sort = [('immutable_id', -1)]
+
+        for backend in [MemoryBackend(), RedisBackend(FakeRedis())]:
+            self.mdb.magresIndex.delete_many({})
+            cache = ResultCache(backend)
+            self.mdb.search_cache = cache
+
+            ids = [self.mdb.add_record(ethstr, _fake_rdata, _fake_vdata).id
+                   for i in range(3)]
+
+            found = self.mdb.search_record(spec, sort=sort, limit=2,
+                                           profile='summary')
+            self.assertEqual([r['id'] for r in found], ids[:0:-1])
+            self.assertNotIn('nmrdata', found[0])
+            found = self.mdb.search_record(spec, sort=sort, skip=2)
+            self.assertEqual([r['id'] for r in found], ids[:1])
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # Writes invalidate the cache
+            self.mdb.set_visibility(ids[1], False)
+            found = self.mdb.search_record(spec, sort=sort)
+            self.assertEqual([r['id'] for r in found], [ids[2], ids[0]])
+            ids.append(self.mdb.add_record(ethstr, _fake_rdata,
+                                           _fake_vdata).id)
+            self.assertEqual(self.mdb.count_records(spec), 3)
+            self.mdb.add_version(ids[0], version_data={'license': 'odc-by'})
+            self.assertEqual(self.mdb.count_records(spec), 2)
+            self.assertEqual(self.mdb.count_records(spec), 2)
+            self.assertEqual(cache.stats()['hits'], 2)
+
+        # Searches matching too many records use the database
+        cache = ResultCache(MemoryBackend(), max_ids=1)
+        self.mdb.search_cache = cache
+        found = self.mdb.search_record(spec, sort=sort, skip=1, limit=1)
+        self.assertEqual([r['id'] for r in found], [ids[2]])
+        self.assertIs(cache.get((QueryCache.key(spec),
+                                 tuple(self.mdb._check_sort(sort))),
+                                self.mdb._generation()), False)
+        found = self.mdb.search_record(spec, sort=sort)
+        self.assertEqual(len(list(found)), 2)
+
+        # Negative paging is refused rather than taken from the end
+        for paging in [{'skip': -1}, {'limit': -1}]:
+            with self.assertRaises(MagresDBError):
+                self.mdb.search_record(spec, sort=sort, **paging)
+
+        self.mdb.search_cache = None
+
+        # The memory budget is kept by evicting the oldest entries
+        backend = MemoryBackend(max_bytes=1000)
+        cache = ResultCache(backend)
+        for i in range(5):
+            cache.set(('q', i), 0, ['0'*24]*5)
+        self.assertEqual(backend.stats()['evictions'], 3)
+        self.assertIsNone(cache.get(('q', 0), 0))
+        self.assertEqual(cache.get(('q', 4), 0), ['0'*24]*5)
+        self.assertIsNone(cache.get(('q', 4), 1))
+        # Too large to store at all
+        cache.set(('q', 5), 0, ['0'*24]*20)
+        self.assertIsNone(cache.get(('q', 5), 0))
+
     @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
     @clean_db
     def testUniqueID(self):
@@ -539,6 +1308,94 @@ class MagresDBTest(unittest.TestCase):
         self.assertEqual(self.mdb.generate_id(), '0000002')
         self.assertEqual(self.mdb.generate_id(), '0000003')
 
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testUniqueIDBlocks(self):
+        from ccpncdb.idalloc import IDAllocator
+
+        alloc = IDAllocator(self.mdb.magresIDcount, block_size=10)
+        self.assertEqual(alloc.allocate(3), [1, 2, 3])
+        self.assertEqual(self.mdb.magresIDcount.find_one()['count'], 10)
+        # Larger than what's left: the rest of the block, then a new one
+        self.assertEqual(alloc.allocate(9), list(range(4, 13)))
+        self.assertEqual(self.mdb.magresIDcount.find_one()['count'], 20)
+
+        # Another process gets its own block
+        other = IDAllocator(self.mdb.magresIDcount, block_size=10)
+        self.assertEqual(other.allocate(), [21])
+        # A forked child drops the block inherited from its parent
+        other._pid = -1
+        self.assertEqual(other.allocate(), [31])
+
+        # Hammer it from many threads, with several allocators standing in
+        # for separate processes sharing the counter
+        allocs = [IDAllocator(self.mdb.magresIDcount, block_size=7)
+                  for i in range(4)]
+        ids = []
+
+        def work(a):
+            for i in range(50):
+                ids.extend(a.allocate(i % 3 + 1))
+
+        threads = [threading.Thread(target=work, args=(allocs[i % 4],))
+                   for i in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # 17 single, 17 double and 16 triple allocations per thread
+        self.assertEqual(len(ids), 16*99)
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertGreater(min(ids), 31)
+
+    def testUniqueIDProcesses(self):
+        # Needs a real server, since processes can't share a mock one
+        import pymongo
+        import multiprocessing as mp
+        from pymongo.errors import ServerSelectionTimeoutError
+
+        client = pymongo.MongoClient('mongodb://localhost:27017',
+                                     serverSelectionTimeoutMS=500)
+        try:
+            client.server_info()
+        except ServerSelectionTimeoutError:
+            self.skipTest('No MongoDB server available')
+
+        client.drop_database('ccpnc-test-ids')
+        with mp.get_context('spawn').Pool(4) as pool:
+            blocks = pool.map(_allocate_ids, range(8))
+        client.drop_database('ccpnc-test-ids')
+
+        ids = sum(blocks, [])
+        self.assertEqual(len(set(ids)), len(ids))
+
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testIndexes(self):
+        from pymongo.errors import DuplicateKeyError
+
+        created, dropped = self.mdb.ensure_indexes()
+        self.assertEqual(len(created), len(self.mdb.INDEXES) +
+                         len(self.mdb.VERSION_INDEXES))
+        self.assertEqual(dropped, [])
+
+        # Running again should do nothing
+        self.assertEqual(self.mdb.ensure_indexes(), ([], []))
+
+        # Stale indexes from older versions get dropped
+        self.mdb.magresIndex.create_index('chemname', name='ccpnc_v0_old')
+        _, dropped = self.mdb.ensure_indexes()
+        self.assertEqual(dropped, ['ccpnc_v0_old'])
+
+        # Placeholder IDs can coexist, real ones must be unique
+        with open(os.path.join(data_path, 'ethanol.magres')) as f:
+            ethstr = f.read()
+        self.mdb.add_record(ethstr, _fake_rdata, _fake_vdata)
+        self.mdb.add_record(ethstr, _fake_rdata, _fake_vdata)
+        with self.assertRaises(DuplicateKeyError):
+            self.mdb.magresIndex.insert_one({'immutable_id': '0000001'})
+
     @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
     @clean_db
     def testBulkDownload(self):
@@ -638,6 +1495,164 @@ class MagresDBTest(unittest.TestCase):
             magres_data = magres_file.read().decode('utf-8') #decode the binary file object from read() to a string
             magres_check(filename2, magres_data, should_raise_error=True)
 
+        # A version that can't be found is skipped, not a broken archive
+        rec2.pop('version_history', None)
+        selectedItems['files'][1]['version'] = 5
+        response = self.test_client.post('/download_selection_zip', json=selectedItems)
+        self.assertEqual(response.status_code, 200)
+        archive = zipfile.ZipFile(BytesIO(response.data))
+        self.assertIn(f"{filename1}.magres", archive.namelist())
+        self.assertNotIn(f"{filename2}.magres", archive.namelist())
+        with archive.open('Magres_metadata.json') as json_file:
+            json_metadata = json.load(json_file)
+            self.assertNotIn(f"{filename2}.magres metadata", json_metadata)
+
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testBulkDownloadRecords(self):
+
+        with open(os.path.join(data_path, 'ethanol.magres')) as f:
+            res1 = self.mdb.add_record(f, _fake_rdata, _fake_vdata_bulk1)
+        with open(os.path.join(data_path, 'alanine.magres')) as f:
+            res2 = self.mdb.add_record(f, _fake_rdata2, _fake_vdata_bulk2)
+        with open(os.path.join(data_path, 'alanine.magres')) as f:
+            self.mdb.add_version(res2.id, f, _fake_vdata_bulk1)
+
+        records = self.mdb.get_records_by_mdbref([res1.mdbref, res2.mdbref,
+                                                  '9999999'],
+                                                 profile='export')
+        self.assertEqual(sorted(records), [res1.mdbref, res2.mdbref])
+        self.assertNotIn('chemname_tokens', records[res1.mdbref])
+
+        # Only IDs and versions are sent
+        selection = {'records': [{'immutable_id': res1.mdbref, 'version': 0},
+                                 {'immutable_id': res2.mdbref, 'version': 1},
+                                 {'immutable_id': res2.mdbref, 'version': 5},
+                                 {'immutable_id': '9999999', 'version': 0}]}
+        response = self.test_client.post('/download_selection_zip',
+                                         json=selection)
+        self.assertEqual(response.status_code, 200)
+
+        archive = zipfile.ZipFile(BytesIO(response.data))
+        with archive.open('Magres_metadata.csv') as csv_file:
+            text_csv = io.TextIOWrapper(csv_file, encoding='utf-8')
+            rows = list(csv.DictReader(text_csv))
+
+        self.assertEqual([r['filename'] for r in rows],
+                         ['MRD' + res1.mdbref, 'MRD' + res2.mdbref])
+        # The requested version, not the first one
+        self.assertEqual([r['notes'] for r in rows],
+                         [_fake_vdata_bulk1['notes']]*2)
+
+        # Malformed selections are rejected, not a server error
+        for records in [{'immutable_id': res1.mdbref}, [res1.mdbref],
+                        [{'version': 0}], [{'immutable_id': 1, 'version': 0}],
+                        [{'immutable_id': res1.mdbref, 'version': 'x'}],
+                        [{'immutable_id': res1.mdbref, 'version': None}],
+                        [{'immutable_id': res1.mdbref, 'version': -1}]]:
+            response = self.test_client.post('/download_selection_zip',
+                                             json={'records': records})
+            self.assertEqual(response.status_code, 400)
+
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testBulkDownloadStream(self):
+
+        with open(os.path.join(data_path, 'ethanol.magres')) as f:
+            ethstr = f.read()
+        res = self.mdb.add_record(ethstr, _fake_rdata, _fake_vdata_bulk1)
+        rec = self.mdb.magresIndex.find_one({'_id': ObjectId(res.id)})
+        # As it would come from the client
+        rec = json.loads(json.dumps(rec, default=str))
+        fs_id = rec['last_version']['magresFilesID']
+
+        files = [{'fileID': fs_id, 'filename': 'good', 'jsonData': rec,
+                  'version': 0},
+                 {'fileID': '0'*24, 'filename': 'missing',
+                  'jsonData': dict(rec), 'version': 0}]
+
+        # The archive comes out in several pieces
+        pieces = list(self.server._generate_selection_zip(files))
+        self.assertGreater(len([p for p in pieces if len(p) > 0]), 2)
+
+        # Missing files are left out
+        archive = zipfile.ZipFile(BytesIO(b''.join(pieces)))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(sorted(archive.namelist()),
+                         ['Magres_metadata.csv', 'Magres_metadata.json',
+                          'good.magres'])
+        self.assertEqual(archive.read('good.magres').decode('utf-8'), ethstr)
+
+    @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
+    @clean_db
+    def testAuthorCache(self):
+        import threading
+        from ccpncdb.crossref import CrossrefCache, CrossrefError
+
+        release = threading.Event()
+
+        class FakeCrossref(CrossrefCache):
+            # Crossref knows only one DOI, and answers when released
+            fetched = []
+
+            def _fetch(self, doi):
+                release.wait(5)
+                self.fetched.append(doi)
+                if doi == 'offline':
+                    raise CrossrefError('Offline')
+                if doi.lower() != '10.1010/abcd':
+                    return None
+                return [{'given': 'John', 'family': 'Smith',
+                         'ORCID': 'https://orcid.org/0000'},
+                        {'given': 'Jane', 'family': 'Doe'}]
+
+        crossref = FakeCrossref(self.mdb.client, 'ccpnc-test', wait=0.01)
+        self.server._crossref = crossref
+
+        # Slow answers are left running in the background
+        response = self.test_client.get('/get_authors?doi=10.1010/ABCD')
+        self.assertEqual(response.status_code, 503)
+        release.set()
+        for future in list(crossref._pending.values()):
+            future.result()
+
+        # And then cached
+        for doi in ['10.1010/ABCD', '10.1010/abcd']:
+            response = self.test_client.get('/get_authors?doi=' + doi)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('John Smith</a>', response.data.decode())
+            self.assertIn('Jane Doe', response.data.decode())
+        self.assertEqual(len(crossref.fetched), 1)
+
+        # Unknown DOIs are cached too
+        crossref.wait = 5
+        for i in range(2):
+            response = self.test_client.get('/get_authors?doi=111')
+            self.assertEqual(response.status_code, 404)
+        self.assertEqual(len(crossref.fetched), 2)
+        response = self.test_client.get('/get_authors?doi=offline')
+        self.assertEqual(response.status_code, 503)
+
+        # No DOI at all is the client's mistake, and not looked up
+        for query in ['', '?doi=', '?doi=%20']:
+            response = self.test_client.get('/get_authors' + query)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(crossref.fetched), 3)
+
+        # Expired entries are served while refreshed
+        crossref.ttl = 0
+        self.assertEqual(len(crossref.get('10.1010/abcd')), 2)
+        for future in list(crossref._pending.values()):
+            future.result()
+        self.assertEqual(len(crossref.fetched), 4)
+        self.assertEqual(crossref.stats()['stale'], 1)
+
+        # Prefetching
+        crossref = FakeCrossref(self.mdb.client, 'ccpnc-test')
+        report = crossref.prefetch(['10.1010/ABCD', '111', '222',
+                                    'offline', None])
+        self.assertEqual(report, {'fetched': 1, 'cached': 2, 'failed': 1})
+
     @mongomock.patch("mongodb://localhost:27017", on_new="pymongo")
     @clean_db
     def testFetchAuthorInfo(self):
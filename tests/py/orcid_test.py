@@ -55,6 +55,77 @@ class OrcidTest(unittest.TestCase):
         self.assertTrue(self.c.is_admin('0000-0000-0000-0000'))
         self.assertFalse(self.c.is_admin('0000-0000-0000-0001'))
 
+    def testRecordCache(self):
+        from requests import ConnectionError
+        from ccpncdb.orcid import OrcidRecordCache
+
+        client_info = {'orcid': '0000-0000-0000-0000',
+                       'access_token': 'XXX'}
+        self.c.request_tokens('123456')
+
+        # Cached after the first request
+        for i in range(3):
+            info = self.c.request_info(client_info)
+        self.assertEqual(info['orcid-identifier']['path'],
+                         client_info['orcid'])
+        self.assertEqual(self.c.fetches, 1)
+        self.assertEqual(self.c.cache.stats()['hits'], 2)
+
+        # Expired records are fetched again, or served stale if ORCID is
+        # down
+        self.c.cache.ttl = 0
+        self.c.request_info(client_info)
+        self.assertEqual(self.c.fetches, 2)
+        self.c.offline = True
+        info = self.c.request_info(client_info)
+        self.assertEqual(info['orcid-identifier']['path'],
+                         client_info['orcid'])
+        self.assertEqual(self.c.cache.stats()['stale'], 1)
+
+        # Unless too stale
+        self.c.cache.stale_ttl = 0
+        with self.assertRaises(ConnectionError):
+            self.c.request_info(client_info)
+
+        # Least recently used records are evicted
+        cache = OrcidRecordCache(maxsize=2)
+        for orcid in ['a', 'b', 'a', 'c']:
+            cache.get(orcid, lambda: orcid.upper())
+        self.assertEqual(cache.get('a', lambda: None), 'A')
+        self.assertIsNone(cache.get('b', lambda: None))
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+    def testListCache(self):
+        import time
+        import tempfile
+        from ccpncdb.orcid import UserList
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'list.yaml')
+            with open(path, 'w') as f:
+                f.write('- 0000-0000-0000-0000\n')
+            self.c._banpath = path
+
+            ulist = UserList.get(path)
+            self.assertTrue(self.c.is_banned('0000-0000-0000-0000'))
+            self.assertFalse(self.c.is_banned('0000-0000-0000-0001'))
+            self.assertTrue(self.c.is_banned('0000-0000-0000-0000'))
+            self.assertEqual(ulist.stats(), {'hits': 2, 'misses': 1,
+                                             'reloads': 1, 'size': 1})
+
+            # Changing the file reloads it
+            time.sleep(0.01)
+            with open(path, 'w') as f:
+                f.write('- 0000-0000-0000-0001\n')
+            self.assertTrue(self.c.is_banned('0000-0000-0000-0001'))
+            self.assertFalse(self.c.is_banned('0000-0000-0000-0000'))
+            self.assertEqual(ulist.reloads, 2)
+
+            # And so does asking for it
+            UserList.reload_all()
+            self.assertTrue(self.c.is_banned('0000-0000-0000-0001'))
+            self.assertEqual(ulist.reloads, 3)
+
 if __name__ == "__main__":
 
     unittest.main()
\ No newline at end of file
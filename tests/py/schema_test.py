@@ -51,6 +51,131 @@ class SchemaTest(unittest.TestCase):
         self.assertFalse(res.result)
         self.assertEqual(res.invalid, 'chemname')
 
+    def testSchemaInfo(self):
+
+        from schema import Schema, Optional
+        from ccpncdb.schemas import (magresVersionSchemaUser,
+                                     magresRecordSchema, schema_info)
+        from ccpncdb.utils import split_data, set_null_values
+
+        info = schema_info(magresVersionSchemaUser)
+        self.assertIs(info, schema_info(magresVersionSchemaUser))
+        self.assertEqual(info.required, {'license'})
+        self.assertIn('doi', info.optional)
+        self.assertEqual(info.keys, tuple(sorted(info.keyset)))
+        self.assertEqual(len(info.defaults), 0)
+        with self.assertRaises(TypeError):
+            info.defaults['doi'] = 'x'
+
+        self.assertIn('chemname', schema_info(magresRecordSchema).required)
+
+        # Not in the registry
+        info = schema_info(Schema({'a': str, Optional('b', default=1): int}))
+        self.assertEqual(info.keys, ('a', 'b'))
+        self.assertEqual(dict(info.defaults), {'b': 1})
+
+        rdata, vdata = split_data({'chemname': 'x', 'doi': 'y', 'other': 1},
+                                  magresRecordSchema, magresVersionSchemaUser)
+        self.assertEqual(rdata, {'chemname': 'x'})
+        self.assertEqual(vdata, {'doi': 'y'})
+
+        vdata = set_null_values({'license': 'cc-by', 'notes': ''},
+                                magresVersionSchemaUser)
+        self.assertEqual(vdata['license'], 'cc-by')
+        self.assertIsNone(vdata['notes'])
+        self.assertIsNone(vdata['doi'])
+
+    def _full_record(self):
+        from datetime import datetime
+        from ccpncdb.utils import read_magres_file
+        from ccpncdb.magresdb import auto_rdata
+
+        with open(os.path.join(data_path, 'alanine.magres')) as f:
+            m = read_magres_file(f)['Atoms']
+
+        rdata = {
+            'chemname': 'Alanine',
+            'orcid': dict(_fake_orcid),
+            'id': 'NONE',
+            'type': 'magres',
+            'visible': True,
+            'chemname_tokens': ['alanine'],
+            'chemname_trigrams': ['ala'],
+            'version_trigrams': [],
+            'last_modified': datetime.utcnow(),
+            'immutable_id': '0000000',
+            'version_count': 0,
+            'last_version': {'license': 'cc-by', 'date': datetime.utcnow(),
+                             'magresFilesID': '000', 'magres_calc': None}
+        }
+        rdata.update(auto_rdata(m))
+        return rdata
+
+    def testCompiledSchema(self):
+        import copy
+        from ccpncdb.schemas import (magresRecordSchema, validate_with,
+                                     _validate_with_schema,
+                                     magresRecordValidator)
+
+        rdata = self._full_record()
+
+        def broken(path, value=None, delete=False):
+            d = copy.deepcopy(rdata)
+            target = d
+            for k in path[:-1]:
+                target = target[k]
+            if delete:
+                del target[path[-1]]
+            else:
+                target[path[-1]] = value
+            return d
+
+        cases = [
+            rdata,
+            broken(['chemname'], delete=True),
+            broken(['chemname'], ''),
+            broken(['chemname'], 'α'),
+            broken(['orcid', 'path'], 'nope'),
+            broken(['orcid', 'host'], delete=True),
+            broken(['nelements'], True),
+            broken(['Z'], 2.0),
+            broken(['user_name'], 'John'),
+            broken(['user_name'], ''),
+            broken(['extra'], 1),
+            broken(['nmrdata', 1, 'ms', 3, 'e_x'], 1),
+            broken(['nmrdata', 1, 'ms', 3, 'e_w'], 1.0),
+            broken(['molecules', 0, 0, 'n'], '1'),
+            broken(['last_version', 'license'], 'gpl'),
+            broken(['last_version'], None),
+            broken(['last_version', 'doi'], None),
+            broken(['elements'], ('C', 'H', 'O')),
+        ]
+        for d in cases:
+            self.assertEqual(validate_with(d, magresRecordSchema),
+                             _validate_with_schema(d, magresRecordSchema))
+        for d in cases[:2]:
+            self.assertEqual(magresRecordValidator.validate(d),
+                             _validate_with_schema(d, magresRecordSchema))
+
+        # Missing keys come back sorted
+        d = broken(['orcid'], delete=True)
+        del d['Z']
+        res = validate_with(d, magresRecordSchema)
+        self.assertEqual(res.missing, ['Z', 'orcid'])
+
+        # The automatic arrays are only spot checked...
+        n = len(rdata['nmrdata'][1]['ms'])
+        self.assertEqual(n, 28)
+        d = broken(['nmrdata', 1, 'ms', 1, 'e_x'], 'bad')
+        self.assertTrue(magresRecordValidator.validate(d).result)
+        self.assertFalse(validate_with(d, magresRecordSchema).result)
+        d = broken(['nmrdata', 1, 'ms', n-1, 'e_x'], 'bad')
+        self.assertEqual(magresRecordValidator.validate(d).invalid,
+                         'nmrdata')
+        # ...but user data isn't
+        d = broken(['orcid', 'path'], 'nope')
+        self.assertEqual(magresRecordValidator.validate(d).invalid, 'orcid')
+
 
 
 if __name__ == "__main__":
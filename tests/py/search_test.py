@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import unittest
+
+file_path = os.path.split(__file__)[0]
+sys.path.append(os.path.abspath(os.path.join(file_path, '../../')))
+
+
+class SearchTest(unittest.TestCase):
+
+    def testQueryCache(self):
+
+        from ccpncdb.search import (build_search, _build_search,
+                                    query_cache, QueryCache)
+
+        query_cache.clear()
+
+        spec = [{'type': 'formula',
+                 'args': {'formula': 'C2H6O', 'subset': False},
+                 'negate_query': False},
+                {'type': 'license', 'args': {'license': 'cc-by'}}]
+
+        q1 = build_search(spec)
+        self.assertEqual(q1, _build_search(spec))
+        self.assertEqual(query_cache.stats()['misses'], 1)
+
+        # Extra arguments and a missing negate_query don't make it different
+        spec2 = [dict(spec[0], negate_query=None),
+                 {'type': 'license', 'args': {'license': 'cc-by',
+                                              'unused': 1}}]
+        self.assertEqual(QueryCache.key(spec), QueryCache.key(spec2))
+        q2 = build_search(spec2)
+        self.assertEqual(q1, q2)
+        self.assertEqual(query_cache.stats()['hits'], 1)
+
+        # Changing the result doesn't change the cache
+        q2['$and'].append({'x': 1})
+        self.assertEqual(build_search(spec), q1)
+        self.assertEqual(query_cache.stats()['hit_rate'], 2/3)
+
+        # Errors aren't cached
+        for bad in [[{'type': 'nothing', 'args': {}}],
+                    [{'type': 'license', 'args': {}}],
+                    [{'type': 'formula',
+                      'args': {'formula': 'c2', 'subset': False}}]]:
+            with self.assertRaises(ValueError):
+                build_search(bad)
+            with self.assertRaises(ValueError):
+                build_search(bad)
+
+        # Formulas giving the same query share a key
+        def fspec(stype, formula):
+            return [{'type': stype,
+                     'args': {'formula': formula, 'subset': False}}]
+        self.assertEqual(QueryCache.key(fspec('formula', 'C2H6O')),
+                         QueryCache.key(fspec('formula', 'CH3CH2OH')))
+        self.assertEqual(QueryCache.key(fspec('formula', 'C2H6O')),
+                         QueryCache.key(fspec('formula', 'C4H12O2')))
+        self.assertNotEqual(QueryCache.key(fspec('molecule', 'C2H6O')),
+                            QueryCache.key(fspec('molecule', 'C4H12O2')))
+        self.assertEqual(build_search(fspec('molecule', 'OC2H6')),
+                         _build_search(fspec('molecule', 'C2H6O')))
+
+        # Least recently used filters go first
+        cache = QueryCache(maxsize=2)
+        for lic in ['a', 'b', 'a', 'c', 'a']:
+            cache.get([{'type': 'license', 'args': {'license': lic}}],
+                      _build_search)
+        self.assertEqual(cache.stats()['size'], 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+
+
+if __name__ == '__main__':
+
+    unittest.main()
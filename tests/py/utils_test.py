@@ -82,6 +82,13 @@ class UtilsTest(unittest.TestCase):
                               {'species': 'N', 'n': 1},
                               {'species': 'O', 'n': 2}])
 
+        # Reduced by the greatest common divisor, not just matching
+        # smallest prime factors
+        self.assertEqual(extract_stochiometry([{'species': 'C', 'n': 6},
+                                               {'species': 'H', 'n': 9}]),
+                         [{'species': 'C', 'n': 2},
+                          {'species': 'H', 'n': 3}])
+
     def testMolecules(self):
 
         from ccpncdb.utils import read_magres_file, extract_molecules
@@ -96,6 +103,28 @@ class UtilsTest(unittest.TestCase):
                                   {'species': 'N', 'n': 1},
                                   {'species': 'O', 'n': 2}])
 
+        # Same as soprano's, on a supercell with molecules across the
+        # boundaries
+        from ase import Atoms
+        from soprano.properties.linkage import Molecules
+        from ccpncdb.utils import extract_formula
+
+        sc = m.repeat((2, 1, 2))
+        sc.positions += sc.cell[0]*0.5
+        sc.wrap()
+        syms = np.array(sc.get_chemical_symbols())
+        ref = [extract_formula(symbols=syms[mol.indices])
+               for mol in Molecules.get(sc)]
+        self.assertEqual(extract_molecules(sc), ref)
+        self.assertEqual(len(ref), 16)
+
+        # Not periodic
+        h2o = Atoms('OHHO', positions=[[0, 0, 0], [0.96, 0, 0],
+                                       [-0.24, 0.93, 0], [10, 0, 0]])
+        self.assertEqual(extract_molecules(h2o),
+                         [[{'species': 'H', 'n': 2}, {'species': 'O', 'n': 1}],
+                          [{'species': 'O', 'n': 1}]])
+
     def testNMR(self):
 
         from ccpncdb.utils import read_magres_file, extract_nmrdata
@@ -128,6 +157,26 @@ class UtilsTest(unittest.TestCase):
                                                efg_tens[i].eigenvalues
                                                ).all())
 
+    def testNMRBatched(self):
+
+        from ccpncdb.utils import (read_magres_file, extract_nmrdata,
+                                   extract_tensdata)
+
+        # The batched path must reproduce the per-tensor one exactly
+        with open(os.path.join(data_path, 'alanine.magres')) as f:
+            m = read_magres_file(f)['Atoms']
+            symbols = np.array(m.get_chemical_symbols())
+
+            nmrdata = extract_nmrdata(m)
+            self.assertEqual([d['species'] for d in nmrdata],
+                             sorted(set(symbols)))
+            for eldata in nmrdata:
+                inds = np.where(symbols == eldata['species'])[0]
+                for tag in ('ms', 'efg'):
+                    ref = [extract_tensdata(NMRTensor(T))
+                           for T in m.get_array(tag)[inds]]
+                    self.assertEqual(eldata[tag], ref)
+
     def testTokenize(self):
 
         from ccpncdb.utils import tokenize_name
@@ -145,6 +194,31 @@ class UtilsTest(unittest.TestCase):
         self.assertEqual(tokens, ['dimethyl', 'hydroxy', 'tetra',
                                   'azatetracyclo', 'pentadecane', 'tetraone'])
 
+    def testTrigrams(self):
+
+        from ccpncdb.utils import trigrams, regex_literals, regex_trigrams
+
+        self.assertEqual(trigrams('C2H6O'), ['2h6', 'c2h', 'h6o'])
+        self.assertEqual(trigrams('ab', 'doi:'), [])
+        self.assertEqual(trigrams('Abab', 'x:'), ['x:aba', 'x:bab'])
+
+        # Literal runs that any match must contain
+        self.assertEqual(regex_literals('^10\\.1010/abcd$'),
+                         ['10.1010/abcd'])
+        self.assertEqual(regex_literals('.*1010/AB.*'), ['1010/AB'])
+        self.assertEqual(regex_literals('C2H.O'), ['C2H', 'O'])
+        # Optional characters don't count
+        self.assertEqual(regex_literals('abc?d'), ['ab', 'd'])
+        self.assertEqual(regex_literals('\\d+ab'), ['ab'])
+        # Too complex
+        self.assertIsNone(regex_literals('ab(c|d)'))
+        self.assertIsNone(regex_literals('[abc]def'))
+
+        self.assertEqual(regex_trigrams('.*1010/A.*', 'doi:'),
+                         ['doi:0/a', 'doi:010', 'doi:10/', 'doi:101'])
+        self.assertEqual(regex_trigrams('a.*b'), [])
+        self.assertEqual(regex_trigrams('ab|cde'), [])
+
 
 if __name__ == "__main__":
 